@@ -16,6 +16,7 @@ class GraphAgent(object):
             if not os.path.isdir(directory):
                 os.mkdir(directory)
         self.path = os.path.join(self.graph_dir, 'graph.pkl.gz')
+        self.columnar_path = os.path.join(self.graph_dir, 'graph.columnar')
     
     def get(self):
         if not hasattr(self, 'graph'):
@@ -23,7 +24,9 @@ class GraphAgent(object):
         return self.graph
     
     def _read(self):
-        """ """
+        """Read the columnar graph if it exists, otherwise the pickle."""
+        if os.path.isdir(self.columnar_path):
+            return readwrite.graph.read_columnar(self.columnar_path)
         return readwrite.graph.read_pickle(self.path)
     
     def set(self, graph):
@@ -33,8 +36,14 @@ class GraphAgent(object):
     def _write(self):
         """ """
         readwrite.graph.write_pickle(self.graph, self.path)
+        # keep an existing columnar graph from shadowing the new pickle
+        if os.path.isdir(self.columnar_path):
+            self.write_columnar()
         #print datetime.datetime.now().time().isoformat()
 
+    def write_columnar(self):
+        readwrite.graph.write_columnar(self.graph, self.columnar_path)
+
     def write_additional_formats(self):
         #yaml_path = os.path.join(self.graph_dir, 'graph.yaml.gz')
         #readwrite.graph.write_yaml(self.graph, yaml_path)
@@ -1,23 +1,46 @@
+import bisect
 import collections
 import itertools
+import math
 import operator
 import random
+import time
+
+import numpy
+import scipy.stats
 
 import hetnet
+import hetnet.graph
 import hetnet.agents
 
         
-def path_degree_product(path, damping_exponent, exclude_edges=set(), exclude_masked=True):
-    """ """
+def get_exclusion_counts(exclude_edges, exclude_masked=True, view=None):
+    """Return exclusion counts from the degree index or from view."""
+    if view is None:
+        return hetnet.graph.DegreeIndex.exclusion_counts(exclude_edges, exclude_masked)
+    return view.exclusion_counts(exclude_edges, exclude_masked)
+
+def get_degree(node, metaedge, exclude_masked=True, exclusion_counts=None, view=None):
+    """Return the degree of node, under the masks of view if not None."""
+    if view is None:
+        return node.get_degree(metaedge, exclude_masked, exclusion_counts)
+    return view.get_degree(node, metaedge, exclude_masked, exclusion_counts)
+
+def path_degree_product(path, damping_exponent, exclude_edges=set(), exclude_masked=True,
+                        exclusion_counts=None, view=None):
+    """
+    Degrees are read from the graph's degree index. exclusion_counts, as
+    returned by hetnet.graph.DegreeIndex.exclusion_counts(exclude_edges,
+    exclude_masked), may be passed to avoid recomputing it for every path.
+    When a hetnet.graph.MaskView is passed as view, masks are taken from it.
+    """
+    if exclusion_counts is None:
+        exclusion_counts = get_exclusion_counts(exclude_edges, exclude_masked, view)
     degrees = list()
     for edge in path:
-        source_edges = edge.source.get_edges(edge.metaedge, exclude_masked)
-        target_edges = edge.target.get_edges(edge.metaedge.inverse, exclude_masked)
-        if exclude_edges:
-            source_edges -= exclude_edges
-            target_edges -= exclude_edges
-        source_degree = len(source_edges)
-        target_degree = len(target_edges)
+        metaedge = edge.metaedge
+        source_degree = get_degree(edge.source, metaedge, exclude_masked, exclusion_counts, view)
+        target_degree = get_degree(edge.target, metaedge.inverse, exclude_masked, exclusion_counts, view)
         degrees.append(source_degree)
         degrees.append(target_degree)
 
@@ -25,33 +48,277 @@ def path_degree_product(path, damping_exponent, exclude_edges=set(), exclude_mas
     degree_product = reduce(operator.mul, damped_degrees)
     return degree_product
 
+def count(paths):
+    """Return the number of paths, consuming paths if it is an iterator."""
+    if hasattr(paths, '__len__'):
+        return len(paths)
+    return sum(1 for path in paths)
+
 def PCs(paths_s):
-    return len(paths_s)
+    return count(paths_s)
 
 def PCt(paths_t):
-    return len(paths_t)
+    return count(paths_t)
 
 def PC(paths):
-    return len(paths)
+    return count(paths)
 
 def NPC(paths_s, paths_t):
-    if len(paths_t) == 0:
-        paths = list()
+    """paths_s and paths_t may be lists or iterables, such as generators."""
+    target = None
+    count_t = 0
+    for path in paths_t:
+        if target is None:
+            target = path.source()
+        count_t += 1
+    count_s = 0
+    count_st = 0
+    for path in paths_s:
+        count_s += 1
+        if target is not None and path.target() == target:
+            count_st += 1
+    denom = count_s + count_t
+    if denom:
+        return 2.0 * count_st / denom
     else:
-        target = paths_t[0].source()
-        paths = [path for path in paths_s if path.target() == target]
-    denom = len(paths_s) + len(paths_t)
+        return None
+
+def PCs_count(count_s):
+    return count_s
+
+def PCt_count(count_t):
+    return count_t
+
+def NPC_count(count, count_s, count_t):
+    """
+    NPC from path counts, as returned by Graph.count_paths_between and
+    Graph.count_paths_from, rather than from lists of paths.
+    """
+    denom = count_s + count_t
     if denom:
-        return 2.0 * len(paths) / denom
+        return 2.0 * count / denom
     else:
         return None
 
-def DWPC(paths, damping_exponent, exclude_edges=set(), exclude_masked=True):
-    degree_products = (path_degree_product(path, damping_exponent, exclude_edges=exclude_edges, exclude_masked=exclude_masked) for path in paths)
+def DWPC(paths, damping_exponent, exclude_edges=set(), exclude_masked=True, view=None):
+    exclusion_counts = get_exclusion_counts(exclude_edges, exclude_masked, view)
+    if isinstance(paths, hetnet.graph.PathArray):
+        degree_products = paths.degree_products(damping_exponent, exclude_masked, exclusion_counts, view)
+        if not degree_products.all():
+            raise ZeroDivisionError('path with a degree of zero')
+        return (1.0 / degree_products).sum()
+    degree_products = (path_degree_product(path, damping_exponent, exclusion_counts=exclusion_counts, exclude_masked=exclude_masked, view=view) for path in paths)
     path_weights = (1.0 / degree_product for degree_product in degree_products)
     dwpc = sum(path_weights)
     return dwpc
 
+def path_log_degree_sum(path, exclude_masked=True, exclusion_counts={}, view=None):
+    """
+    Return the sum of the natural logs of the degrees that path_degree_product
+    multiplies, so that path_degree_product equals
+    exp(damping_exponent * path_log_degree_sum) for any damping_exponent.
+    Raises ZeroDivisionError for a degree of zero, as DWPC does.
+    """
+    log_sum = 0.0
+    for edge in path:
+        metaedge = edge.metaedge
+        source_degree = get_degree(edge.source, metaedge, exclude_masked, exclusion_counts, view)
+        target_degree = get_degree(edge.target, metaedge.inverse, exclude_masked, exclusion_counts, view)
+        if not source_degree or not target_degree:
+            raise ZeroDivisionError('path with a degree of zero')
+        log_sum += math.log(source_degree) + math.log(target_degree)
+    return log_sum
+
+def DWPC_exponents(paths, damping_exponents, exclude_edges=set(), exclude_masked=True, view=None):
+    """
+    Return a numpy array with the DWPC at each of damping_exponents. Each
+    path's log-degree sum is computed once and reused for every exponent.
+    """
+    exclusion_counts = get_exclusion_counts(exclude_edges, exclude_masked, view)
+    if isinstance(paths, hetnet.graph.PathArray):
+        log_sums = paths.log_degree_sums(exclude_masked, exclusion_counts, view)
+    else:
+        log_sums = numpy.array([path_log_degree_sum(path, exclude_masked, exclusion_counts, view)
+                                for path in paths], dtype=numpy.float64)
+    exponents = numpy.asarray(damping_exponents, dtype=numpy.float64)
+    path_weights = numpy.exp(-numpy.outer(log_sums, exponents))
+    return path_weights.sum(axis=0)
+
+def walk_totals(graph, source, target, metapath, damping_exponent,
+                masked=True, exclude_nodes=set(), exclude_edges=set(), exclude_masked=True):
+    """
+    Sum path weights and counts over walks from source to target following
+    metapath, which unlike paths may repeat nodes, by a backward pass over
+    nodes from target. Returns (reach, counts), lists of dictionaries where
+    reach[i][node] is the total weight of walks from node at position i to
+    target and counts[i][node] their number. Costs one visit per edge rather
+    than per path. As DWPC does for paths, raises ZeroDivisionError when a
+    walk from source crosses an edge with a degree of zero, which can only
+    be traversed when masked.
+    """
+    exclusion_counts = hetnet.graph.DegreeIndex.exclusion_counts(exclude_edges, exclude_masked)
+    length = len(metapath)
+    reach = [dict() for i in range(length + 1)]
+    counts = [dict() for i in range(length + 1)]
+    # nodes with a walk to target crossing an edge with a degree of zero
+    undefined = [set() for i in range(length + 1)]
+    if target in exclude_nodes or (not masked and target.masked):
+        return reach, counts
+    reach[length][target] = 1.0
+    counts[length][target] = 1
+    for i in reversed(range(length)):
+        metaedge = metapath[i]
+        for node in set(reach[i + 1]) | undefined[i + 1]:
+            completion = reach[i + 1].get(node, 0.0)
+            completion_count = counts[i + 1].get(node, 0)
+            node_undefined = node in undefined[i + 1]
+            target_degree = node.get_degree(metaedge.inverse, exclude_masked, exclusion_counts)
+            for edge in node.edges[metaedge.inverse]:
+                # edge.inverse is the edge as traversed from source
+                edge_target = edge.target
+                if edge_target in exclude_nodes or edge.inverse in exclude_edges:
+                    continue
+                if not masked and (node.masked or edge.inverse.masked):
+                    continue
+                source_degree = edge_target.get_degree(metaedge, exclude_masked, exclusion_counts)
+                if node_undefined or not source_degree or not target_degree:
+                    undefined[i].add(edge_target)
+                    continue
+                weight = 1.0 / (source_degree * target_degree) ** damping_exponent
+                reach[i][edge_target] = reach[i].get(edge_target, 0.0) + weight * completion
+                counts[i][edge_target] = counts[i].get(edge_target, 0) + completion_count
+    if source in undefined[0]:
+        raise ZeroDivisionError('walk with a degree of zero')
+    return reach, counts
+
+def DWPC_sample(graph, source, target, metapath, damping_exponent,
+                relative_error=0.05, confidence=0.95, max_walks=100000, max_seconds=None,
+                exact_threshold=10000, batch_size=1000, seed=None,
+                duplicates=False, masked=True, exclude_nodes=set(), exclude_edges=set(),
+                exclude_masked=True):
+    """
+    Estimate the DWPC between source and target for metapath by sampling
+    random walks, for metapaths with too many paths to enumerate.
+
+    walk_totals gives W, the DWPC summed over walks, which may repeat nodes.
+    Each step samples an edge with probability proportional to its
+    degree-normalised weight times the walk weight remaining from its target.
+    A walk is therefore drawn with probability equal to its share of W. The
+    fraction of walks without repeated nodes, times W, is an unbiased
+    estimate of the DWPC. Its confidence interval is W times the Wilson
+    interval of that fraction.
+
+    Walks are drawn in batches until the half-width of the returned
+    interval is within relative_error of its center, max_walks is reached
+    or max_seconds passes. When there are at most exact_threshold walks,
+    which bounds the number of paths, or when duplicates is True, the DWPC
+    is computed exactly instead. It is also computed exactly when a walk
+    crosses a degree of zero, so ZeroDivisionError is raised exactly when a
+    path does, as by DWPC. Returns an OrderedDict of dwpc, lower, upper, exact,
+    walks (the number sampled) and walk_count.
+    """
+    if not isinstance(source, hetnet.graph.Node):
+        source = graph.node_dict[source]
+    if not isinstance(target, hetnet.graph.Node):
+        target = graph.node_dict[target]
+    result = collections.OrderedDict()
+
+    def exact(dwpc):
+        result['dwpc'] = result['lower'] = result['upper'] = dwpc
+        result['exact'] = True
+        result['walks'] = 0
+        return result
+
+    try:
+        reach, counts = walk_totals(graph, source, target, metapath, damping_exponent,
+                                    masked, exclude_nodes, exclude_edges, exclude_masked)
+    except ZeroDivisionError:
+        # whether a path, rather than only a walk, crosses the zero degree
+        result['walk_count'] = None
+        paths = graph.path_array(source, target, metapath, duplicates, masked,
+                                 exclude_nodes, exclude_edges)
+        return exact(DWPC(paths, damping_exponent, exclude_edges, exclude_masked))
+    total = reach[0].get(source, 0.0)
+    walk_count = counts[0].get(source, 0)
+    result['walk_count'] = walk_count
+
+    if not total or source in exclude_nodes or (not masked and source.masked):
+        return exact(0.0)
+    if duplicates:
+        return exact(total)
+    if walk_count <= exact_threshold:
+        paths = graph.path_array(source, target, metapath, duplicates, masked,
+                                 exclude_nodes, exclude_edges)
+        return exact(DWPC(paths, damping_exponent, exclude_edges, exclude_masked))
+
+    # cumulative sampling weights of the edges leaving a node at a position
+    exclusion_counts = hetnet.graph.DegreeIndex.exclusion_counts(exclude_edges, exclude_masked)
+    choices = dict()
+
+    def get_choices(node, i):
+        key = node, i
+        if key not in choices:
+            metaedge = metapath[i]
+            completions = reach[i + 1]
+            source_degree = node.get_degree(metaedge, exclude_masked, exclusion_counts)
+            edges = list()
+            weights = list()
+            for edge in node.edges[metaedge]:
+                completion = completions.get(edge.target)
+                if completion is None or edge in exclude_edges:
+                    continue
+                if not masked and edge.masked:
+                    continue
+                target_degree = edge.target.get_degree(metaedge.inverse, exclude_masked, exclusion_counts)
+                if not source_degree or not target_degree:
+                    raise ZeroDivisionError('walk with a degree of zero')
+                edges.append(edge)
+                weights.append(completion / (source_degree * target_degree) ** damping_exponent)
+            choices[key] = edges, numpy.cumsum(weights).tolist()
+        return choices[key]
+
+    rng = random.Random(seed)
+    z = scipy.stats.norm.ppf(0.5 + confidence / 2.0)
+    length = len(metapath)
+    start = time.time()
+    walks = 0
+    hits = 0
+    while True:
+        for walk in xrange(batch_size):
+            node = source
+            visited = {source}
+            for i in xrange(length):
+                edges, cumulative = get_choices(node, i)
+                position = bisect.bisect_right(cumulative, rng.random() * cumulative[-1])
+                node = edges[min(position, len(edges) - 1)].target
+                if node in visited:
+                    break
+                visited.add(node)
+            else:
+                hits += 1
+        walks += batch_size
+        fraction = float(hits) / walks
+        center = (fraction + z ** 2 / (2 * walks)) / (1 + z ** 2 / walks)
+        half_width = z / (1 + z ** 2 / walks) * math.sqrt(
+            fraction * (1 - fraction) / walks + z ** 2 / (4 * walks ** 2))
+        if hits and half_width <= relative_error * center:
+            break
+        if walks >= max_walks:
+            break
+        if max_seconds is not None and time.time() - start >= max_seconds:
+            break
+
+    result['dwpc'] = total * fraction
+    result['lower'] = total * max(center - half_width, 0.0)
+    result['upper'] = total * min(center + half_width, 1.0)
+    result['exact'] = False
+    result['walks'] = walks
+    return result
+
+def get_metric_names(metric):
+    """Return the feature names a metric produces, one per value it returns."""
+    return metric.get('names', [metric['name']])
+
 def get_metrics():
     """ """
     metrics = list()
@@ -65,33 +332,34 @@ def get_metrics():
 
     metric = collections.OrderedDict()
     metric['name'] = 'PCs'
-    metric['fxn'] = PCs
+    metric['fxn'] = PCs_count
     metric['algorithm'] = 'PCs'
-    metric['arguments'] = {'paths_s': None}
+    metric['arguments'] = {'count_s': None}
     metrics.append(metric)
 
     metric = collections.OrderedDict()
     metric['name'] = 'PCt'
     metric['algorithm'] = 'PCt'
-    metric['fxn'] = PCt
-    metric['arguments'] = {'paths_t': None}
+    metric['fxn'] = PCt_count
+    metric['arguments'] = {'count_t': None}
     metrics.append(metric)
 
     metric = collections.OrderedDict()
     metric['name'] = 'NPC'
     metric['algorithm'] = 'NPC'
-    metric['fxn'] = NPC
-    metric['arguments'] = {'paths_s': None, 'paths_t': None}
+    metric['fxn'] = NPC_count
+    metric['arguments'] = {'count': None, 'count_s': None, 'count_t': None}
     metrics.append(metric)
 
+    # DWPC at every exponent is computed by a single DWPC_exponents call
     dwpc_exponents = [x / 10.0 for x in range(0, 11)]
-    for damping_exponent in dwpc_exponents:
-        metric = collections.OrderedDict()
-        metric['name'] = 'DWPC_{}'.format(damping_exponent)
-        metric['algorithm'] = 'DWPC'
-        metric['fxn'] = DWPC
-        metric['arguments'] = {'paths': None, 'damping_exponent': damping_exponent, 'exclude_edges': None}
-        metrics.append(metric)
+    metric = collections.OrderedDict()
+    metric['name'] = 'DWPC'
+    metric['names'] = ['DWPC_{}'.format(damping_exponent) for damping_exponent in dwpc_exponents]
+    metric['algorithm'] = 'DWPC'
+    metric['fxn'] = DWPC_exponents
+    metric['arguments'] = {'paths': None, 'damping_exponents': dwpc_exponents, 'exclude_edges': None}
+    metrics.append(metric)
 
     return metrics
 
@@ -0,0 +1,638 @@
+import array
+import collections
+import gc
+import multiprocessing
+import random
+
+import numpy
+
+import hetnet.graph
+
+
+class CompactGraph(hetnet.graph.Graph):
+
+    def __init__(self, metagraph, data=dict()):
+        """
+        Graph storing nodes as interned integers and the edges of each
+        MetaEdge as CSR arrays (indptr, indices) plus an int array mapping
+        each edge to its inverse. Nodes and edges are returned as lightweight
+        CompactNode and CompactEdge views that are created on access, so
+        hetnet.graph.Graph traversal methods such as paths_from and
+        paths_between_tree work unchanged. Edges added with add_edge are
+        buffered and compiled into CSR arrays on first access. Edge tables
+        and predicate masks (Graph.get_edge_table and Graph.mask_edges) are
+        not supported; mask CompactEdge views instead. Edges cannot be
+        removed, so changes are not recorded (Graph.record_changes) and only
+        changelogs without removed edges can be applied.
+        """
+        hetnet.graph.BaseGraph.__init__(self)
+        self.metagraph = metagraph
+        self.data = data
+
+        # node table
+        self.id_to_int = dict()
+        self.node_ids = list()
+        self.node_metanodes = list()
+        self.node_data = list()
+        self.node_masked = numpy.zeros(0, dtype=bool)
+
+        # edge buffers and compiled edge arrays
+        self.pending = collections.OrderedDict()
+        self.metaedge_to_indptr = dict()
+        self.metaedge_to_indices = dict()
+        self.metaedge_to_inverse = dict()
+        self.metaedge_to_data = dict()
+        self.metaedge_to_masked = dict()
+        self.metaedge_to_inverted = dict()
+        self.metanode_counts = None
+        self.metaedge_to_table = dict()
+
+        self.node_dict = NodeDict(self)
+        self.edge_dict = EdgeDict(self)
+
+    def add_node(self, id_, kind, data=dict()):
+        """ """
+        metanode = self.metagraph.node_dict[kind]
+        index = len(self.node_ids)
+        self.metanode_counts = None
+        self.id_to_int[id_] = index
+        self.node_ids.append(id_)
+        self.node_metanodes.append(metanode)
+        self.node_data.append(data)
+        return CompactNode(self, index)
+
+    def add_edge(self, source_id, target_id, kind, direction, data=dict()):
+        """
+        Buffer an edge. Unlike Graph.add_edge, edge views are not returned
+        since the edge arrays are only compiled on first access.
+        """
+        source = self.id_to_int[source_id]
+        target = self.id_to_int[target_id]
+        metaedge_id = (self.node_metanodes[source].id_,
+                       self.node_metanodes[target].id_, kind, direction)
+        metaedge = self.metagraph.edge_dict[metaedge_id]
+        if metaedge.inverted:
+            metaedge = metaedge.inverse
+            source, target = target, source
+        if metaedge not in self.pending:
+            self.pending[metaedge] = array.array('l'), array.array('l'), list()
+        sources, targets, edge_data = self.pending[metaedge]
+        sources.append(source)
+        targets.append(target)
+        edge_data.append(data)
+
+    def get_edge_table(self, metaedge):
+        raise NotImplementedError('CompactGraph does not support edge tables')
+
+    def mask_edges(self, metaedge, predicate):
+        raise NotImplementedError('CompactGraph does not support predicate masks, '
+                                  'set masked on CompactEdge views instead')
+
+    def remove_edge(self, source_id, target_id, kind, direction):
+        raise NotImplementedError('CompactGraph does not support removing edges')
+
+    def record_changes(self):
+        raise NotImplementedError('CompactGraph does not record changes, '
+                                  'use GraphChangelog.from_graphs instead')
+
+    def share_node_table(self, other):
+        """
+        Use the node table of other, a CompactGraph with the same metagraph,
+        instead of adding nodes. Node masks are not shared. Nodes must not
+        be added to either graph afterwards.
+        """
+        assert not self.node_ids
+        assert self.metagraph is other.metagraph
+        self.id_to_int = other.id_to_int
+        self.node_ids = other.node_ids
+        self.node_metanodes = other.node_metanodes
+        self.node_data = other.node_data
+        self.node_masked = numpy.zeros(len(self.node_ids), dtype=bool)
+        self.metanode_counts = None
+
+    @staticmethod
+    def from_graph(graph):
+        """Return a CompactGraph copy of a hetnet.graph.Graph."""
+        compact = CompactGraph(graph.metagraph, graph.data)
+        for node in graph.node_dict.itervalues():
+            compact.add_node(node.id_, node.metanode.id_, node.data)
+        for edge in graph.get_edges(exclude_inverts=True):
+            source_id, target_id, kind, direction = edge.get_id()
+            compact.add_edge(source_id, target_id, kind, direction, edge.data)
+        compact.compile()
+        return compact
+
+    def compile(self):
+        """Compile buffered edges into the CSR arrays of each metaedge."""
+        n_nodes = len(self.node_ids)
+        if len(self.node_masked) != n_nodes:
+            node_masked = numpy.zeros(n_nodes, dtype=bool)
+            n_old = min(len(self.node_masked), n_nodes)
+            node_masked[:n_old] = self.node_masked[:n_old]
+            self.node_masked = node_masked
+        if not self.pending:
+            return
+        for metaedge in self.metagraph.get_edges(exclude_inverts=True):
+            if metaedge not in self.pending:
+                continue
+            sources, targets, edge_data = self.pending.pop(metaedge)
+            # merge with previously compiled edges of metaedge
+            if metaedge in self.metaedge_to_indptr:
+                old_sources, old_targets, old_data = self.forward_pairs(metaedge)
+                sources = numpy.concatenate([old_sources, sources])
+                targets = numpy.concatenate([old_targets, targets])
+                edge_data = old_data + edge_data
+            sources = numpy.asarray(sources, dtype=numpy.int32)
+            targets = numpy.asarray(targets, dtype=numpy.int32)
+            self.set_pairs(metaedge, sources, targets, edge_data)
+        self.pending.clear()
+
+    def set_pairs(self, metaedge, sources, targets, edge_data=None):
+        """
+        Store the edges of the non-inverted metaedge given as arrays of
+        source and target node integers. Replaces existing edges of metaedge
+        and its inverse. edge_data is an optional list of data dictionaries
+        aligned with the pairs.
+        """
+        n_nodes = len(self.node_ids)
+        n_edges = len(sources)
+        inverse = metaedge.inverse
+        if inverse is metaedge:
+            rows = numpy.concatenate([sources, targets])
+            cols = numpy.concatenate([targets, sources])
+            indptr, indices, positions = build_csr(rows, cols, n_nodes)
+            original = numpy.arange(2 * n_edges)
+            inverse_positions = numpy.empty_like(positions)
+            inverse_positions[positions] = positions[(original + n_edges) % (2 * n_edges)]
+            self.metaedge_to_indptr[metaedge] = indptr
+            self.metaedge_to_indices[metaedge] = indices
+            self.metaedge_to_inverse[metaedge] = inverse_positions.astype(numpy.int32)
+            self.metaedge_to_masked[metaedge] = numpy.zeros(2 * n_edges, dtype=bool)
+            inverted = numpy.zeros(2 * n_edges, dtype=bool)
+            inverted[positions[n_edges:]] = True
+            self.metaedge_to_inverted[metaedge] = inverted
+            if edge_data is not None and any(edge_data):
+                data = [None] * (2 * n_edges)
+                for i, position in enumerate(positions):
+                    data[position] = edge_data[i % n_edges]
+                self.metaedge_to_data[metaedge] = data
+            else:
+                self.metaedge_to_data.pop(metaedge, None)
+            return
+
+        forward = build_csr(sources, targets, n_nodes)
+        backward = build_csr(targets, sources, n_nodes)
+        for me, (indptr, indices, positions), other_positions in (
+            (metaedge, forward, backward[2]), (inverse, backward, forward[2])):
+            inverse_positions = numpy.empty_like(positions)
+            inverse_positions[positions] = other_positions
+            self.metaedge_to_indptr[me] = indptr
+            self.metaedge_to_indices[me] = indices
+            self.metaedge_to_inverse[me] = inverse_positions.astype(numpy.int32)
+            self.metaedge_to_masked[me] = numpy.zeros(n_edges, dtype=bool)
+            if edge_data is not None and any(edge_data):
+                data = [None] * n_edges
+                for i, position in enumerate(positions):
+                    data[position] = edge_data[i]
+                self.metaedge_to_data[me] = data
+            else:
+                self.metaedge_to_data.pop(me, None)
+
+    def forward_pairs(self, metaedge):
+        """
+        Return (sources, targets, edge_data) for the compiled edges of the
+        non-inverted metaedge, with each undirected edge reported once.
+        """
+        indptr, indices = self.get_csr(metaedge)
+        sources = numpy.repeat(numpy.arange(len(indptr) - 1, dtype=numpy.int32),
+                               numpy.diff(indptr))
+        targets = indices
+        data = self.metaedge_to_data.get(metaedge)
+        if metaedge.inverse is metaedge:
+            keep = ~self.metaedge_to_inverted[metaedge]
+            sources, targets = sources[keep], targets[keep]
+            if data is not None:
+                data = [d for d, k in zip(data, keep) if k]
+        if data is None:
+            data = [dict()] * len(sources)
+        return sources, targets, list(data)
+
+    def get_csr(self, metaedge):
+        """Return the (indptr, indices) arrays for metaedge."""
+        if self.pending or len(self.node_masked) != len(self.node_ids):
+            self.compile()
+        if metaedge not in self.metaedge_to_indptr:
+            n_nodes = len(self.node_ids)
+            self.metaedge_to_indptr[metaedge] = numpy.zeros(n_nodes + 1, dtype=numpy.int64)
+            self.metaedge_to_indices[metaedge] = numpy.zeros(0, dtype=numpy.int32)
+            self.metaedge_to_inverse[metaedge] = numpy.zeros(0, dtype=numpy.int32)
+            self.metaedge_to_masked[metaedge] = numpy.zeros(0, dtype=bool)
+            self.metaedge_to_inverted[metaedge] = numpy.zeros(0, dtype=bool)
+        return self.metaedge_to_indptr[metaedge], self.metaedge_to_indices[metaedge]
+
+    def metanode_count(self, metanode):
+        """Return the number of nodes of metanode."""
+        if getattr(self, 'metanode_counts', None) is None:
+            self.metanode_counts = collections.Counter(self.node_metanodes)
+        return self.metanode_counts[metanode]
+
+    def mean_degree(self, metaedge, exclude_masked=True):
+        """Return the mean degree for metaedge from the CSR arrays."""
+        n_nodes = self.metanode_count(metaedge.source)
+        if not n_nodes:
+            return 0.0
+        indptr, indices = self.get_csr(metaedge)
+        n_edges = len(indices)
+        if exclude_masked:
+            masked = self.metaedge_to_masked[metaedge] | self.node_masked[indices]
+            n_edges -= int(masked.sum())
+        return float(n_edges) / n_nodes
+
+    def degree_array(self, metaedge, exclude_masked=True):
+        """Return an int64 array of the degree for metaedge of every node."""
+        indptr, indices = self.get_csr(metaedge)
+        degrees = numpy.diff(indptr).astype(numpy.int64)
+        if exclude_masked:
+            rows = numpy.repeat(numpy.arange(len(degrees)), degrees)
+            masked = self.metaedge_to_masked[metaedge] | self.node_masked[indices]
+            degrees -= numpy.bincount(rows[masked], minlength=len(degrees))
+        return degrees
+
+    def node_from_index(self, metanode, index):
+        """Return the view of node index, which indexes every node."""
+        return CompactNode(self, index)
+
+    def edge_index(self, edge):
+        """Return the CSR position of edge for PathArrays."""
+        return edge.position
+
+    def edge_from_index(self, metaedge, index, source_index):
+        """Return the view of the edge at CSR position index of metaedge."""
+        return CompactEdge(self, metaedge, index, source_index)
+
+    def get_node_edges(self, index, metaedge):
+        """Return a list of CompactEdge views from node index for metaedge."""
+        indptr, indices = self.get_csr(metaedge)
+        return [CompactEdge(self, metaedge, position, index)
+                for position in xrange(indptr[index], indptr[index + 1])]
+
+    def find_edge(self, source, target, metaedge):
+        """Return the CSR position of the edge source to target or None."""
+        indptr, indices = self.get_csr(metaedge)
+        start, stop = indptr[source], indptr[source + 1]
+        position = start + numpy.searchsorted(indices[start:stop], target)
+        if position < stop and indices[position] == target:
+            return int(position)
+        return None
+
+    def unmask(self):
+        """Unmask all nodes and edges contained within the graph"""
+        self.compile()
+        self.node_masked[:] = False
+        for masked in self.metaedge_to_masked.itervalues():
+            masked[:] = False
+
+    def nbytes(self):
+        """Return the bytes held by the node and edge arrays."""
+        arrays = [self.node_masked]
+        for dictionary in (self.metaedge_to_indptr, self.metaedge_to_indices,
+                           self.metaedge_to_inverse, self.metaedge_to_masked,
+                           self.metaedge_to_inverted):
+            arrays.extend(dictionary.values())
+        return sum(a.nbytes for a in arrays)
+
+
+def build_csr(rows, cols, n_rows):
+    """
+    Return (indptr, indices, positions) for the pairs (rows, cols), where
+    positions[i] is the CSR position of the ith pair. Indices are sorted
+    within each row.
+    """
+    rows = numpy.asarray(rows, dtype=numpy.int64)
+    cols = numpy.asarray(cols, dtype=numpy.int64)
+    order = numpy.lexsort((cols, rows))
+    indices = cols[order].astype(numpy.int32)
+    counts = numpy.bincount(rows, minlength=n_rows)
+    indptr = numpy.zeros(n_rows + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=indptr[1:])
+    positions = numpy.empty(len(rows), dtype=numpy.int64)
+    positions[order] = numpy.arange(len(rows))
+    return indptr, indices, positions
+
+
+class NodeDict(object):
+    """Mapping from node id_ to CompactNode views."""
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, id_):
+        return CompactNode(self.graph, self.graph.id_to_int[id_])
+
+    def get(self, id_, default=None):
+        index = self.graph.id_to_int.get(id_)
+        return default if index is None else CompactNode(self.graph, index)
+
+    def __contains__(self, id_):
+        return id_ in self.graph.id_to_int
+
+    def __len__(self):
+        return len(self.graph.node_ids)
+
+    def __iter__(self):
+        return iter(self.graph.node_ids)
+
+    def keys(self):
+        return list(self.graph.node_ids)
+
+    def itervalues(self):
+        for index in xrange(len(self.graph.node_ids)):
+            yield CompactNode(self.graph, index)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for node in self.itervalues():
+            yield node.id_, node
+
+    def items(self):
+        return list(self.iteritems())
+
+
+class EdgeDict(object):
+    """Mapping from edge id tuples to CompactEdge views."""
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, edge_id):
+        edge = self.get(edge_id)
+        if edge is None:
+            raise KeyError(edge_id)
+        return edge
+
+    def get(self, edge_id, default=None):
+        source_id, target_id, kind, direction = edge_id
+        graph = self.graph
+        source = graph.id_to_int.get(source_id)
+        target = graph.id_to_int.get(target_id)
+        if source is None or target is None:
+            return default
+        metaedge_id = (graph.node_metanodes[source].id_,
+                       graph.node_metanodes[target].id_, kind, direction)
+        metaedge = graph.metagraph.edge_dict.get(metaedge_id)
+        if metaedge is None:
+            return default
+        position = graph.find_edge(source, target, metaedge)
+        if position is None:
+            return default
+        return CompactEdge(graph, metaedge, position)
+
+    def __contains__(self, edge_id):
+        return self.get(edge_id) is not None
+
+    def __len__(self):
+        self.graph.compile()
+        return sum(len(indices) for indices in self.graph.metaedge_to_indices.itervalues())
+
+    def itervalues(self):
+        graph = self.graph
+        for metaedge in graph.metagraph.edge_dict.itervalues():
+            indptr, indices = graph.get_csr(metaedge)
+            for position in xrange(len(indices)):
+                yield CompactEdge(graph, metaedge, position)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for edge in self.itervalues():
+            yield edge.get_id(), edge
+
+    def items(self):
+        return list(self.iteritems())
+
+
+class NodeEdges(object):
+    """Mapping from metaedge to the list of CompactEdge views of a node."""
+
+    __slots__ = ('node', )
+
+    def __init__(self, node):
+        self.node = node
+
+    def __getitem__(self, metaedge):
+        if metaedge not in self.node.metanode.edges:
+            raise KeyError(metaedge)
+        return self.node.graph.get_node_edges(self.node.index, metaedge)
+
+    def keys(self):
+        return list(self.node.metanode.edges)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.node.metanode.edges)
+
+    def values(self):
+        return [self[metaedge] for metaedge in self.keys()]
+
+    def items(self):
+        return [(metaedge, self[metaedge]) for metaedge in self.keys()]
+
+    iteritems = items
+    itervalues = values
+
+
+class CompactNode(hetnet.graph.Node):
+
+    __slots__ = ('graph', 'index')
+
+    def __init__(self, graph, index):
+        """View of node index in a CompactGraph."""
+        self.graph = graph
+        self.index = index
+
+    @property
+    def id_(self):
+        return self.graph.node_ids[self.index]
+
+    @property
+    def metanode(self):
+        return self.graph.node_metanodes[self.index]
+
+    @property
+    def data(self):
+        return self.graph.node_data[self.index]
+
+    @property
+    def edges(self):
+        return NodeEdges(self)
+
+    @property
+    def masked(self):
+        graph = self.graph
+        if len(graph.node_masked) != len(graph.node_ids):
+            graph.compile()
+        return bool(graph.node_masked[self.index])
+
+    @masked.setter
+    def masked(self, value):
+        graph = self.graph
+        if len(graph.node_masked) != len(graph.node_ids):
+            graph.compile()
+        graph.node_masked[self.index] = value
+
+    def get_degree(self, metaedge, exclude_masked=True, exclusion_counts=None):
+        """Return the degree of self for metaedge from the CSR arrays."""
+        graph = self.graph
+        indptr, indices = graph.get_csr(metaedge)
+        start, stop = indptr[self.index], indptr[self.index + 1]
+        degree = int(stop - start)
+        if exclude_masked:
+            masked = (graph.metaedge_to_masked[metaedge][start:stop] |
+                      graph.node_masked[indices[start:stop]])
+            degree -= int(masked.sum())
+        if exclusion_counts:
+            degree -= exclusion_counts.get((self, metaedge), 0)
+        return degree
+
+
+class CompactEdge(hetnet.graph.Edge):
+
+    __slots__ = ('graph', 'metaedge', 'position', 'source_index')
+
+    def __init__(self, graph, metaedge, position, source_index=None):
+        """View of the edge at position in the CSR arrays of metaedge."""
+        self.graph = graph
+        self.metaedge = metaedge
+        self.position = position
+        self.source_index = source_index
+
+    @property
+    def source(self):
+        if self.source_index is None:
+            indptr = self.graph.metaedge_to_indptr[self.metaedge]
+            index = numpy.searchsorted(indptr, self.position, side='right') - 1
+            self.source_index = int(index)
+        return CompactNode(self.graph, self.source_index)
+
+    @property
+    def target(self):
+        index = self.graph.metaedge_to_indices[self.metaedge][self.position]
+        return CompactNode(self.graph, int(index))
+
+    @property
+    def inverse(self):
+        position = self.graph.metaedge_to_inverse[self.metaedge][self.position]
+        return CompactEdge(self.graph, self.metaedge.inverse, int(position))
+
+    @property
+    def inverted(self):
+        if self.metaedge.inverse is self.metaedge:
+            return bool(self.graph.metaedge_to_inverted[self.metaedge][self.position])
+        return self.metaedge.inverted
+
+    @property
+    def data(self):
+        data = self.graph.metaedge_to_data.get(self.metaedge)
+        if data is None:
+            return dict()
+        return data[self.position]
+
+    @property
+    def masked(self):
+        return bool(self.graph.metaedge_to_masked[self.metaedge][self.position])
+
+    @masked.setter
+    def masked(self, value):
+        self.graph.metaedge_to_masked[self.metaedge][self.position] = value
+
+    def __hash__(self):
+        return hash((self.metaedge, self.position))
+
+    def __eq__(self, other):
+        return (isinstance(other, CompactEdge) and self.position == other.position
+                and self.metaedge == other.metaedge and self.graph is other.graph)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def synthetic_writable(n_genes=20000, n_diseases=300, n_tissues=250, n_sets=10000,
+                       mean_degrees=None, seed=0):
+    """
+    Return a list of node tuples and a list of edge tuples resembling the
+    gene-disease hetnet. mean_degrees maps each metaedge tuple to the mean
+    degree of its source nodes.
+    """
+    random.seed(seed)
+    if mean_degrees is None:
+        mean_degrees = collections.OrderedDict([
+            (('disease', 'gene', 'association', 'both'), 25),
+            (('gene', 'gene', 'interaction', 'both'), 8),
+            (('gene', 'tissue', 'expression', 'both'), 40),
+            (('disease', 'tissue', 'localization', 'both'), 20),
+            (('gene', 'c5.bp', 'membership', 'both'), 50)])
+    kind_to_count = {'gene': n_genes, 'disease': n_diseases,
+                     'tissue': n_tissues, 'c5.bp': n_sets}
+    nodes = list()
+    kind_to_ids = dict()
+    for kind, count in kind_to_count.items():
+        ids = ['{}:{}'.format(kind, i) for i in xrange(count)]
+        kind_to_ids[kind] = ids
+        nodes.extend((id_, kind) for id_ in ids)
+    edges = list()
+    for metaedge_tuple, mean_degree in mean_degrees.items():
+        source_kind, target_kind, kind, direction = metaedge_tuple
+        sources, targets = kind_to_ids[source_kind], kind_to_ids[target_kind]
+        pairs = set()
+        for source in sources:
+            for i in xrange(mean_degree):
+                target = random.choice(targets)
+                if target == source or (target, source) in pairs:
+                    continue
+                pairs.add((source, target))
+        edges.extend((s, t, kind, direction) for s, t in pairs)
+    return mean_degrees.keys(), nodes, edges
+
+
+def _build_rss_delta(args):
+    """Build a graph class from the writable and return the RSS increase in MB."""
+    graph_class, metaedge_tuples, nodes, edges = args
+    from hetnet.pathtools import memory_usage
+    gc.collect()
+    before = memory_usage()
+    metagraph = hetnet.graph.MetaGraph.from_edge_tuples(metaedge_tuples)
+    graph = graph_class(metagraph)
+    for id_, kind in nodes:
+        graph.add_node(id_, kind)
+    for edge in edges:
+        graph.add_edge(*edge)
+    if isinstance(graph, CompactGraph):
+        graph.compile()
+    gc.collect()
+    return memory_usage() - before
+
+
+def compare_memory(**kwargs):
+    """
+    Compare the resident memory of a hetnet.graph.Graph and a CompactGraph
+    holding the same synthetic network. Each graph is built in a fresh
+    forked process. Keyword arguments are passed to synthetic_writable.
+    """
+    metaedge_tuples, nodes, edges = synthetic_writable(**kwargs)
+    print '{} nodes, {} edges'.format(len(nodes), len(edges))
+    pool = multiprocessing.Pool(processes=1, maxtasksperchild=1)
+    for graph_class in hetnet.graph.Graph, CompactGraph:
+        args = graph_class, metaedge_tuples, nodes, edges
+        delta = pool.apply(_build_rss_delta, (args, ))
+        print '{}: {:.1f} MB'.format(graph_class.__name__, delta)
+    pool.close()
+    pool.join()
+
+
+if __name__ == '__main__':
+    compare_memory()
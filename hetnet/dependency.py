@@ -0,0 +1,173 @@
+import collections
+
+import numpy
+import scipy.sparse
+
+
+class DependencyTracker(object):
+
+    def __init__(self, graph, changelog):
+        """
+        Finds which stored features, keyed by (source_id, target_id,
+        metapath), are affected by changelog, a hetnet.graph.GraphChangelog
+        leading to graph. The DWPC between source and target changes only if
+        one of its paths, before or after the changes, passes a node whose
+        degree for the metaedge entering or leaving it at that position
+        changed. Such nodes are touched. Paths using an added or removed edge
+        always pass a touched node, as the edge changes the degrees of its
+        endpoints.
+
+        Paths are followed over the union of graph and the removed edges, so
+        both versions of the graph are covered without keeping the old one.
+        For each position with touched nodes, source by touched and touched
+        by target reachability matrices are built from sparse products
+        starting at the touched nodes. Reachability is by walks, so a row
+        whose only walks through a touched node repeat a node is reported
+        although none of its paths changed. Masks are ignored in the same
+        conservative way. No affected row is missed.
+        """
+        self.graph = graph
+        self.changelog = changelog
+        self.metanode_to_nodes = dict()
+        self.metanode_to_index = dict()
+        self.metaedge_to_adjacency = dict()
+        self.metaedge_to_touched = collections.defaultdict(set)
+        self.metapath_to_affected = dict()
+        self.removed_nodes = set(changelog.removed_nodes)
+
+        # sorted nodes of graph, followed by removed nodes, give matrix order
+        for node in graph.node_dict.itervalues():
+            self.metanode_to_nodes.setdefault(node.metanode, list()).append(node)
+        metanode_to_removed = dict()
+        for id_, (kind, data) in changelog.removed_nodes.iteritems():
+            metanode_to_removed.setdefault(kind, list()).append(id_)
+        for metanode in graph.metagraph.get_nodes():
+            nodes = self.metanode_to_nodes.setdefault(metanode, list())
+            nodes.sort()
+            index = {node.id_: i for i, node in enumerate(nodes)}
+            for id_ in sorted(metanode_to_removed.get(metanode.id_, list())):
+                index[id_] = len(index)
+            self.metanode_to_index[metanode] = index
+
+        self.metaedge_to_removed = collections.defaultdict(list)
+        for metaedge_id, source_id, target_id, added in changelog.get_changed_edges():
+            metaedge = graph.metagraph.edge_dict[metaedge_id]
+            self.metaedge_to_touched[metaedge].add(source_id)
+            self.metaedge_to_touched[metaedge.inverse].add(target_id)
+            if not added:
+                self.metaedge_to_removed[metaedge].append((source_id, target_id))
+
+    def get_index(self, metanode):
+        """Return a dictionary of node id to matrix position for metanode."""
+        return self.metanode_to_index[metanode]
+
+    def get_adjacency(self, metaedge):
+        """
+        Return the binary source by target csr_matrix for metaedge over the
+        edges of graph and the removed edges.
+        """
+        if metaedge in self.metaedge_to_adjacency:
+            return self.metaedge_to_adjacency[metaedge]
+        if metaedge.inverted:
+            adjacency = self.get_adjacency(metaedge.inverse).T.tocsr()
+            self.metaedge_to_adjacency[metaedge] = adjacency
+            return adjacency
+        source_index = self.get_index(metaedge.source)
+        target_index = self.get_index(metaedge.target)
+        rows = list()
+        cols = list()
+        for i, node in enumerate(self.metanode_to_nodes[metaedge.source]):
+            for edge in node.edges[metaedge]:
+                rows.append(i)
+                cols.append(target_index[edge.target.id_])
+        for source_id, target_id in self.metaedge_to_removed.get(metaedge, list()):
+            rows.append(source_index[source_id])
+            cols.append(target_index[target_id])
+            if metaedge.inverse is metaedge:
+                rows.append(target_index[target_id])
+                cols.append(source_index[source_id])
+        shape = len(source_index), len(target_index)
+        adjacency = scipy.sparse.csr_matrix((numpy.ones(len(rows)), (rows, cols)), shape=shape)
+        adjacency.data[:] = 1
+        self.metaedge_to_adjacency[metaedge] = adjacency
+        return adjacency
+
+    def node_touched(self, node_id, metaedge):
+        """Return whether the degree of node_id for metaedge changed."""
+        return node_id in self.metaedge_to_touched.get(metaedge, ())
+
+    def touched_positions(self, metapath, i):
+        """Return the sorted matrix positions of touched nodes at position i."""
+        touched = set()
+        if i < len(metapath):
+            touched |= self.metaedge_to_touched.get(metapath[i], set())
+        if i > 0:
+            touched |= self.metaedge_to_touched.get(metapath[i - 1].inverse, set())
+        index = self.get_index(metapath.get_nodes()[i])
+        return numpy.array(sorted(index[id_] for id_ in touched), dtype=numpy.int64)
+
+    @staticmethod
+    def binarize(matrix):
+        matrix = matrix.tocsr()
+        matrix.data[:] = 1
+        return matrix
+
+    def affected_matrix(self, metapath):
+        """
+        Return the source by target csr_matrix whose nonzero entries are pairs
+        with a walk following metapath through a touched node, or None when no
+        position of metapath has touched nodes.
+        """
+        if metapath in self.metapath_to_affected:
+            return self.metapath_to_affected[metapath]
+        affected = None
+        for i in range(len(metapath) + 1):
+            positions = self.touched_positions(metapath, i)
+            if not len(positions):
+                continue
+            n_nodes = len(self.get_index(metapath.get_nodes()[i]))
+            selector = scipy.sparse.csr_matrix(
+                (numpy.ones(len(positions)), (positions, numpy.arange(len(positions)))),
+                shape=(n_nodes, len(positions)))
+            head = selector
+            for metaedge in reversed(metapath[:i]):
+                head = self.binarize(self.get_adjacency(metaedge).dot(head))
+            tail = selector.T.tocsr()
+            for metaedge in metapath[i:]:
+                tail = self.binarize(tail.dot(self.get_adjacency(metaedge)))
+            term = head.dot(tail)
+            affected = term if affected is None else affected + term
+        if affected is not None:
+            affected = self.binarize(affected)
+        self.metapath_to_affected[metapath] = affected
+        return affected
+
+    def affected(self, keys):
+        """
+        Return the list of keys, (source_id, target_id, metapath) tuples,
+        whose features are affected by the changes, in the order of keys.
+        Keys onto nodes that were removed or are not in graph are affected.
+        """
+        metapath_to_keys = collections.OrderedDict()
+        for key in keys:
+            metapath_to_keys.setdefault(key[2], list()).append(key)
+        affected = set()
+        for metapath, metapath_keys in metapath_to_keys.iteritems():
+            source_index = self.get_index(metapath.source())
+            target_index = self.get_index(metapath.target())
+            known = list()
+            for key in metapath_keys:
+                source_id, target_id = key[:2]
+                if (source_id in self.removed_nodes or target_id in self.removed_nodes or
+                        source_id not in source_index or target_id not in target_index):
+                    affected.add(key)
+                else:
+                    known.append(key)
+            matrix = self.affected_matrix(metapath)
+            if matrix is None or not known:
+                continue
+            rows = [source_index[key[0]] for key in known]
+            cols = [target_index[key[1]] for key in known]
+            values = numpy.asarray(matrix[rows, cols]).ravel()
+            affected.update(key for key, value in zip(known, values) if value)
+        return [key for key in keys if key in affected]
@@ -1,7 +1,11 @@
 # daniel.himmelstein@gmail.com
+import array
+import heapq
 import itertools
 import collections
 
+import numpy
+
 import readwrite
 
 direction_to_inverse = {'forward': 'backward',
@@ -66,6 +70,9 @@ class BaseNode(ElemMask):
     def __eq__(self, other):
         return self.id_ == other.id_
 
+    def __ne__(self, other):
+        return not isinstance(other, BaseNode) or self.id_ != other.id_
+
     def __repr__(self):
         return self.id_    
 
@@ -359,19 +366,400 @@ class Tree(object):
         return nodes
 
 
+class DegreeIndex(object):
+
+    def __init__(self):
+        """
+        Per-metaedge int arrays of node degrees, indexed by node.index (the
+        position of a node within its metanode). degrees counts all edges and
+        unmasked counts edges that are neither masked nor onto a masked node,
+        matching len(node.get_edges(metaedge, exclude_masked)). Nodes and
+        edges update the index as they are added, masked and unmasked.
+        Per-metaedge totals of both are kept for mean_degree.
+        """
+        self.metanode_to_count = dict()
+        self.metanode_to_nodes = dict()
+        self.metanode_to_masked = dict()
+        self.metaedge_to_degrees = dict()
+        self.metaedge_to_unmasked = dict()
+        self.metaedge_to_total = collections.Counter()
+        self.metaedge_to_unmasked_total = collections.Counter()
+
+    def add_node(self, node):
+        """Assign node its index and zero degrees for its metaedges."""
+        metanode = node.metanode
+        node.index = self.metanode_to_count.get(metanode, 0)
+        self.metanode_to_count[metanode] = node.index + 1
+        self.metanode_to_nodes.setdefault(metanode, list()).append(node)
+        self.metanode_to_masked.setdefault(metanode, array.array('b')).append(bool(node.masked))
+        node.degree_index = self
+        for metaedge in metanode.edges:
+            for dictionary in self.metaedge_to_degrees, self.metaedge_to_unmasked:
+                if metaedge not in dictionary:
+                    dictionary[metaedge] = array.array('l')
+                dictionary[metaedge].append(0)
+
+    def add_edge(self, edge):
+        """Count edge towards the degree of its source."""
+        index = edge.source.index
+        self.metaedge_to_degrees[edge.metaedge][index] += 1
+        self.metaedge_to_total[edge.metaedge] += 1
+        if not edge.masked and not edge.target.masked:
+            self.metaedge_to_unmasked[edge.metaedge][index] += 1
+            self.metaedge_to_unmasked_total[edge.metaedge] += 1
+
+    def remove_edge(self, edge):
+        """Stop counting edge towards the degree of its source."""
+        index = edge.source.index
+        self.metaedge_to_degrees[edge.metaedge][index] -= 1
+        self.metaedge_to_total[edge.metaedge] -= 1
+        if not edge.masked and not edge.target.masked:
+            self.metaedge_to_unmasked[edge.metaedge][index] -= 1
+            self.metaedge_to_unmasked_total[edge.metaedge] -= 1
+
+    def edge_masking(self, edge, masked):
+        """Update degrees for edge changing its masked status to masked."""
+        if edge.target.masked:
+            return
+        change = -1 if masked else 1
+        self.metaedge_to_unmasked[edge.metaedge][edge.source.index] += change
+        self.metaedge_to_unmasked_total[edge.metaedge] += change
+
+    def node_masking(self, node, masked):
+        """Update degrees of edges onto node as node changes its masked status."""
+        change = -1 if masked else 1
+        self.metanode_to_masked[node.metanode][node.index] = bool(masked)
+        for edges in node.edges.itervalues():
+            for edge in edges:
+                inverse = edge.inverse
+                if inverse.masked:
+                    continue
+                self.metaedge_to_unmasked[inverse.metaedge][inverse.source.index] += change
+                self.metaedge_to_unmasked_total[inverse.metaedge] += change
+
+    def table_masking(self, table, mask):
+        """
+        Update degrees for the edges of an EdgeTable changing their predicate
+        mask from table.mask to mask, using array operations over the table.
+        """
+        metaedge = table.metaedge
+        source_masked = numpy.array(self.metanode_to_masked[metaedge.source], dtype=bool)[table.sources]
+        target_masked = numpy.array(self.metanode_to_masked[metaedge.target], dtype=bool)[table.targets]
+        changed = mask != table.mask
+        directions = ((metaedge, table.sources, table.element_masked, target_masked),
+                      (metaedge.inverse, table.targets, table.inverse_element_masked, source_masked))
+        for direction, sources, element_masked, onto_masked in directions:
+            counted = changed & ~element_masked & ~onto_masked
+            if not counted.any():
+                continue
+            changes = numpy.where(mask[counted], -1, 1)
+            deltas = numpy.bincount(sources[counted], weights=changes)
+            unmasked = self.metaedge_to_unmasked[direction]
+            for index in numpy.flatnonzero(deltas):
+                unmasked[index] += int(deltas[index])
+            self.metaedge_to_unmasked_total[direction] += int(changes.sum())
+
+    def get(self, node, metaedge, exclude_masked=True):
+        """Return the degree of node for metaedge."""
+        dictionary = self.metaedge_to_unmasked if exclude_masked else self.metaedge_to_degrees
+        return dictionary[metaedge][node.index]
+
+    def mean_degree(self, metaedge, exclude_masked=True):
+        """Return the mean degree for metaedge over nodes of its source."""
+        n_nodes = self.metanode_to_count.get(metaedge.source, 0)
+        if not n_nodes:
+            return 0.0
+        totals = self.metaedge_to_unmasked_total if exclude_masked else self.metaedge_to_total
+        return float(totals[metaedge]) / n_nodes
+
+    @staticmethod
+    def exclusion_counts(exclude_edges, exclude_masked=True):
+        """
+        Return a dictionary of (node, metaedge) to the number of edges in
+        exclude_edges that count towards that degree, so that degrees
+        excluding exclude_edges are found by an O(1) decrement.
+        """
+        counts = dict()
+        for edge in exclude_edges:
+            if exclude_masked and (edge.masked or edge.target.masked):
+                continue
+            key = edge.source, edge.metaedge
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+
+class EdgeTable(object):
+
+    def __init__(self, metaedge, edges):
+        """
+        Columnar table of the edges of a non-inverted metaedge. An edge and its
+        inverse share the row given by edge.table_position. Indexing the table
+        by an edge data key returns that column as a float64 array (NaN where
+        missing), built on first access. mask is a boolean array of edges
+        masked in both directions by a vectorised predicate (see
+        Graph.mask_edges). element_masked and inverse_element_masked mirror
+        the masked status set on the edge objects of each direction.
+        """
+        self.metaedge = metaedge
+        self.edges = list()
+        self.columns = dict()
+        self.sources = numpy.zeros(0, dtype=numpy.int64)
+        self.targets = numpy.zeros(0, dtype=numpy.int64)
+        self.mask = numpy.zeros(0, dtype=bool)
+        self.element_masked = numpy.zeros(0, dtype=bool)
+        self.inverse_element_masked = numpy.zeros(0, dtype=bool)
+        self.extend(edges)
+
+    def extend(self, edges):
+        """Append rows for edges, which are unmasked by predicate."""
+        edges = list(edges)
+        for position, edge in enumerate(edges, len(self.edges)):
+            for direction in edge, edge.inverse:
+                direction.edge_table = self
+                direction.table_position = position
+        self.edges.extend(edges)
+        self.columns.clear()
+        self.sources = numpy.append(self.sources, [edge.source.index for edge in edges]).astype(numpy.int64)
+        self.targets = numpy.append(self.targets, [edge.target.index for edge in edges]).astype(numpy.int64)
+        self.mask = numpy.append(self.mask, numpy.zeros(len(edges), dtype=bool))
+        self.element_masked = numpy.append(
+            self.element_masked, [edge._masked for edge in edges]).astype(bool)
+        self.inverse_element_masked = numpy.append(
+            self.inverse_element_masked, [edge.inverse._masked for edge in edges]).astype(bool)
+
+    def remove(self, edge):
+        """Delete the row of edge, of either direction, shifting later rows."""
+        position = edge.table_position
+        for direction in edge, edge.inverse:
+            direction.edge_table = None
+            del direction.table_position
+        del self.edges[position]
+        for later_position, later in enumerate(self.edges[position:], position):
+            later.table_position = later_position
+            later.inverse.table_position = later_position
+        self.columns.clear()
+        self.sources = numpy.delete(self.sources, position)
+        self.targets = numpy.delete(self.targets, position)
+        self.mask = numpy.delete(self.mask, position)
+        self.element_masked = numpy.delete(self.element_masked, position)
+        self.inverse_element_masked = numpy.delete(self.inverse_element_masked, position)
+
+    def element_masking(self, edge, masked):
+        """Record edge, of either direction, having its masked status set."""
+        element_masked = self.inverse_element_masked if edge.inverted else self.element_masked
+        element_masked[edge.table_position] = bool(masked)
+
+    def __len__(self):
+        return len(self.edges)
+
+    def __getitem__(self, key):
+        if key not in self.columns:
+            self.columns[key] = numpy.array(
+                [edge.data.get(key, numpy.nan) for edge in self.edges], dtype=numpy.float64)
+        return self.columns[key]
+
+
+class MaskView(object):
+
+    def __init__(self, nodes=(), edges=()):
+        """
+        A mask configuration held apart from the graph, so that queries with
+        different masks can run concurrently against one graph. Traversal and
+        degree methods accepting a view use its masks in place of the masked
+        status of nodes and edges, which the view ignores. Edges are masked in
+        both directions. Degrees are the unmasked degrees of the graph's
+        DegreeIndex less decrements the view keeps as it is masked, so
+        creating and discarding a view do not touch the graph.
+        """
+        self.masked_nodes = set()
+        self.masked_edges = set()
+        self.decrements = dict()
+        for node in nodes:
+            self.mask_node(node)
+        for edge in edges:
+            self.mask_edge(edge)
+
+    def decrement(self, edge, change):
+        """Change the decrement of the degree edge counts towards."""
+        key = edge.source, edge.metaedge
+        self.decrements[key] = self.decrements.get(key, 0) + change
+
+    def mask_node(self, node):
+        if node in self.masked_nodes:
+            return
+        self.masked_nodes.add(node)
+        for edges in node.edges.itervalues():
+            for edge in edges:
+                if edge.inverse not in self.masked_edges:
+                    self.decrement(edge.inverse, 1)
+
+    def unmask_node(self, node):
+        if node not in self.masked_nodes:
+            return
+        self.masked_nodes.remove(node)
+        for edges in node.edges.itervalues():
+            for edge in edges:
+                if edge.inverse not in self.masked_edges:
+                    self.decrement(edge.inverse, -1)
+
+    def mask_edge(self, edge):
+        for direction in edge, edge.inverse:
+            if direction in self.masked_edges:
+                continue
+            self.masked_edges.add(direction)
+            if direction.target not in self.masked_nodes:
+                self.decrement(direction, 1)
+
+    def unmask_edge(self, edge):
+        for direction in edge, edge.inverse:
+            if direction not in self.masked_edges:
+                continue
+            self.masked_edges.remove(direction)
+            if direction.target not in self.masked_nodes:
+                self.decrement(direction, -1)
+
+    def node_masked(self, node):
+        return node in self.masked_nodes
+
+    def edge_blocked(self, edge):
+        """Whether edge or its target is masked in the view."""
+        return edge in self.masked_edges or edge.target in self.masked_nodes
+
+    def get_degree(self, node, metaedge, exclude_masked=True, exclusion_counts=None):
+        """Return the degree of node for metaedge under the view's masks."""
+        degree = node.get_degree(metaedge, exclude_masked=False)
+        if exclude_masked:
+            degree -= self.decrements.get((node, metaedge), 0)
+        if exclusion_counts:
+            degree -= exclusion_counts.get((node, metaedge), 0)
+        return degree
+
+    def exclusion_counts(self, exclude_edges, exclude_masked=True):
+        """As DegreeIndex.exclusion_counts, with masks from the view."""
+        counts = dict()
+        for edge in exclude_edges:
+            if exclude_masked and self.edge_blocked(edge):
+                continue
+            key = edge.source, edge.metaedge
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+
+class GraphChangelog(object):
+
+    def __init__(self):
+        """
+        Nodes and edges added to or removed from a graph. Edges are recorded
+        by the id of their non-inverted metaedge as (source_id, target_id)
+        pairs in the orientation of that metaedge, with the pair sorted for
+        metaedges from a metanode onto itself in both directions. Ids rather
+        than objects are kept so a changelog applies to any copy of a graph.
+        Adding an edge that was removed, or the reverse, cancels the change.
+        metaedge_to_added maps pairs to edge data so changes can be replayed
+        with Graph.apply_changelog. added_nodes and removed_nodes map node
+        ids to (kind, data).
+        """
+        self.added_nodes = dict()
+        self.removed_nodes = dict()
+        self.metaedge_to_added = dict()
+        self.metaedge_to_removed = dict()
+
+    @staticmethod
+    def from_graphs(old_graph, new_graph):
+        """
+        Return the changelog turning old_graph into new_graph, such as graphs
+        created from two releases of a resource. Edges are compared by id, so
+        edges whose data changed are not recorded.
+        """
+        changelog = GraphChangelog()
+        for id_, node in new_graph.node_dict.iteritems():
+            if id_ not in old_graph.node_dict:
+                changelog.add_node(id_, node.metanode.id_, node.data)
+        for id_, node in old_graph.node_dict.iteritems():
+            if id_ not in new_graph.node_dict:
+                changelog.remove_node(id_, node.metanode.id_, node.data)
+        for edge in new_graph.get_edges(exclude_inverts=True):
+            if edge.get_id() not in old_graph.edge_dict:
+                changelog.add_edge(edge)
+        for edge in old_graph.get_edges(exclude_inverts=True):
+            if edge.get_id() not in new_graph.edge_dict:
+                changelog.remove_edge(edge)
+        return changelog
+
+    @staticmethod
+    def edge_key(edge):
+        """Return the metaedge id and node id pair recording edge."""
+        if edge.inverted:
+            edge = edge.inverse
+        metaedge = edge.metaedge
+        pair = edge.source.id_, edge.target.id_
+        if metaedge.inverse is metaedge:
+            pair = tuple(sorted(pair))
+        return metaedge.get_id(), pair
+
+    def add_node(self, id_, kind, data):
+        if self.removed_nodes.pop(id_, None) is None:
+            self.added_nodes[id_] = kind, data
+
+    def remove_node(self, id_, kind, data):
+        if self.added_nodes.pop(id_, None) is None:
+            self.removed_nodes[id_] = kind, data
+
+    def add_edge(self, edge):
+        metaedge_id, pair = self.edge_key(edge)
+        removed = self.metaedge_to_removed.setdefault(metaedge_id, set())
+        if pair in removed:
+            removed.remove(pair)
+        else:
+            self.metaedge_to_added.setdefault(metaedge_id, dict())[pair] = edge.data
+
+    def remove_edge(self, edge):
+        metaedge_id, pair = self.edge_key(edge)
+        added = self.metaedge_to_added.setdefault(metaedge_id, dict())
+        if pair in added:
+            del added[pair]
+        else:
+            self.metaedge_to_removed.setdefault(metaedge_id, set()).add(pair)
+
+    def get_changed_edges(self):
+        """Generate (metaedge_id, source_id, target_id, added) for each change."""
+        for metaedge_to_pairs, added in (self.metaedge_to_added, True), (self.metaedge_to_removed, False):
+            for metaedge_id, pairs in metaedge_to_pairs.iteritems():
+                for source_id, target_id in pairs:
+                    yield metaedge_id, source_id, target_id, added
+
+    def __len__(self):
+        n_edges = sum(len(pairs) for pairs in self.metaedge_to_added.itervalues())
+        n_edges += sum(len(pairs) for pairs in self.metaedge_to_removed.itervalues())
+        return len(self.added_nodes) + len(self.removed_nodes) + n_edges
+
+    def __repr__(self):
+        return '{} node and {} edge changes'.format(
+            len(self.added_nodes) + len(self.removed_nodes),
+            len(self) - len(self.added_nodes) - len(self.removed_nodes))
+
+
 class Graph(BaseGraph):
+
+    # GraphChangelog recording changes, set by record_changes
+    changelog = None
     
     def __init__(self, metagraph, data=dict()):
         """ """
         BaseGraph.__init__(self)
         self.metagraph = metagraph
         self.data = data        
+        self.degree_index = DegreeIndex()
+        self.metaedge_to_table = dict()
 
     def add_node(self, id_, kind, data=dict()):
         """ """
         metanode = self.metagraph.node_dict[kind]
         node = Node(id_, metanode, data)
         self.node_dict[id_] = node
+        self.degree_index.add_node(node)
+        if self.changelog is not None:
+            self.changelog.add_node(id_, kind, data)
         return node
     
     def add_edge(self, source_id, target_id, kind, direction, data=dict()):
@@ -391,24 +779,119 @@ class Graph(BaseGraph):
 
         edge.inverse = inverse
         inverse.inverse = edge
+
+        self.degree_index.add_edge(edge)
+        self.degree_index.add_edge(inverse)
+
+        table = self.metaedge_to_table.get(metaedge.inverse if metaedge.inverted else metaedge)
+        if table is not None:
+            table.extend([inverse if edge.inverted else edge])
+
+        if self.changelog is not None:
+            self.changelog.add_edge(edge)
         
         return edge, inverse
 
+    def remove_edge(self, source_id, target_id, kind, direction):
+        """
+        Remove the edge, and its inverse, added by the add_edge call with
+        these arguments (or by the inverse call). Returns the removed edge.
+        """
+        source = self.node_dict[source_id]
+        target = self.node_dict[target_id]
+        edge = self.edge_dict[(source_id, target_id, kind, direction)]
+        inverse = edge.inverse
+        self.degree_index.remove_edge(edge)
+        self.degree_index.remove_edge(inverse)
+        if edge.edge_table is not None:
+            edge.edge_table.remove(edge)
+        source.edges[edge.metaedge].remove(edge)
+        target.edges[inverse.metaedge].remove(inverse)
+        del self.edge_dict[edge.get_id()]
+        del self.edge_dict[inverse.get_id()]
+        if self.changelog is not None:
+            self.changelog.remove_edge(edge)
+        return edge
+
+    def record_changes(self):
+        """
+        Start recording nodes and edges added to and removed from the graph
+        in a new GraphChangelog, which is returned. Set graph.changelog to
+        None to stop recording.
+        """
+        self.changelog = GraphChangelog()
+        return self.changelog
+
+    def apply_changelog(self, changelog):
+        """
+        Apply the edge changes and node additions of changelog, as recorded on
+        another copy of the graph. Nodes in changelog.removed_nodes must have
+        no remaining edges and are left in the graph. Edges are removed
+        first, so a graph that cannot remove edges is left unchanged.
+        """
+        for metaedge_id, pairs in changelog.metaedge_to_removed.iteritems():
+            source_kind, target_kind, kind, direction = metaedge_id
+            for source_id, target_id in pairs:
+                self.remove_edge(source_id, target_id, kind, direction)
+        for id_, (kind, data) in changelog.added_nodes.iteritems():
+            self.add_node(id_, kind, data)
+        for metaedge_id, pair_to_data in changelog.metaedge_to_added.iteritems():
+            source_kind, target_kind, kind, direction = metaedge_id
+            for (source_id, target_id), data in pair_to_data.iteritems():
+                self.add_edge(source_id, target_id, kind, direction, data)
+
+    def get_edge_table(self, metaedge):
+        """
+        Return the EdgeTable of metaedge (or its non-inverted inverse),
+        creating it on first access.
+        """
+        if metaedge.inverted:
+            metaedge = metaedge.inverse
+        if metaedge not in self.metaedge_to_table:
+            edges = [edge for edge in self.get_edges(exclude_inverts=True) if edge.metaedge == metaedge]
+            self.metaedge_to_table[metaedge] = EdgeTable(metaedge, edges)
+        return self.metaedge_to_table[metaedge]
+
+    def mask_edges(self, metaedge, predicate):
+        """
+        Mask the edges of metaedge, in both directions, for which predicate is
+        False. predicate is called with the EdgeTable of metaedge so columns
+        are compared as arrays, for example
+        lambda table: table['log10_expr'] >= 2.1. Replaces the previous
+        predicate mask of metaedge. Masking by predicate does not change the
+        masked status set on edges, but edge.masked, traversal and degrees
+        respect it. Returns the number of edges masked by predicate.
+        """
+        table = self.get_edge_table(metaedge)
+        mask = ~numpy.asarray(predicate(table), dtype=bool)
+        assert mask.shape == table.mask.shape
+        self.degree_index.table_masking(table, mask)
+        table.mask = mask
+        return int(mask.sum())
+
+    def clear_edge_masks(self):
+        """Remove the predicate masks of all edge tables."""
+        for table in self.metaedge_to_table.itervalues():
+            mask = numpy.zeros(len(table), dtype=bool)
+            self.degree_index.table_masking(table, mask)
+            table.mask = mask
+
     def paths_tree(self, source, metapath,
                    duplicates=False, masked=True,
-                   exclude_nodes=set(), exclude_edges=set()):
+                   exclude_nodes=set(), exclude_edges=set(), view=None):
         """
         Return a list of Paths starting with source and following metapath.
         Setting duplicates False disallows paths with repeated nodes.
         Setting masked False disallows paths which traverse a masked node or edge.
         exclude_nodes and exclude_edges allow specification of additional nodes
-        and edges beyond (or independent of) masked nodes and edges.
+        and edges beyond (or independent of) masked nodes and edges. When a
+        MaskView is passed as view, masks are taken from it.
         """
 
         if not isinstance(source, Node):
             source = self.node_dict[source]
 
-        if masked and source.masked:
+        if masked and (source.masked if view is None else view.node_masked(source)):
             return None
 
         if source in exclude_nodes:
@@ -421,7 +904,7 @@ class Graph(BaseGraph):
                 continue
             if edge_target in exclude_nodes or edge in exclude_edges:
                 continue
-            if not masked and (edge_target.masked or edge.masked):
+            if not masked and (view.edge_blocked(edge) if view else edge_target.masked or edge.masked):
                 continue
             tree = Tree(parent=None, edge=edge)
             leaves.append(tree)
@@ -437,7 +920,7 @@ class Graph(BaseGraph):
                         continue
                     if edge_target in exclude_nodes or edge in exclude_edges:
                         continue
-                    if not masked and (edge_target.masked or edge.masked):
+                    if not masked and (view.edge_blocked(edge) if view else edge_target.masked or edge.masked):
                         continue
 
                     tree = Tree(parent=parent, edge=edge)
@@ -448,30 +931,119 @@ class Graph(BaseGraph):
 
         return leaves
 
+    def plan_split(self, source, target, metapath, masked=True, view=None):
+        """
+        Choose where paths_between_tree splits metapath. Splitting at index k
+        expands metapath[:k] from source and the remaining metaedges from
+        target, joining the two trees on the nodes where they meet. k equal
+        to len(metapath) or 0 traverses the whole metapath from one side. The
+        size of each tree level is estimated from the actual degree of the
+        root and the mean degrees of later metaedges, and the join by the
+        product of the meeting levels over the number of nodes they can meet
+        on. Returns a dictionary of the chosen split_index, the estimated
+        cost of every split and the statistics behind them.
+        """
+        if not isinstance(source, Node):
+            source = self.node_dict[source]
+        if not isinstance(target, Node):
+            target = self.node_dict[target]
+        exclude_masked = not masked
+        length = len(metapath)
+
+        def get_degree(node, metaedge):
+            if view is not None:
+                return view.get_degree(node, metaedge, exclude_masked)
+            return node.get_degree(metaedge, exclude_masked)
+
+        def mean_degree(metaedge):
+            return self.mean_degree(metaedge, exclude_masked)
+
+        def level_sizes(root, metaedges):
+            sizes = [1.0]
+            for i, metaedge in enumerate(metaedges):
+                degree = get_degree(root, metaedge) if i == 0 else mean_degree(metaedge)
+                sizes.append(sizes[-1] * degree)
+            return sizes
+
+        inverse_metaedges = [metaedge.inverse for metaedge in reversed(metapath)]
+        head_sizes = level_sizes(source, metapath)
+        tail_sizes = level_sizes(target, inverse_metaedges)
+        costs = list()
+        for k in range(length + 1):
+            cost = sum(head_sizes[1:k + 1]) + sum(tail_sizes[1:length - k + 1])
+            if 0 < k < length:
+                n_meet = self.metanode_count(metapath[k].source)
+                cost += head_sizes[k] * tail_sizes[length - k] / max(n_meet, 1)
+            costs.append(cost)
+        default = length if length <= 2 else length / 2
+        split_index = min(range(length + 1), key=lambda k: (costs[k], k != default))
+        plan = {'split_index': split_index, 'default_index': default, 'costs': costs,
+                'head_sizes': head_sizes, 'tail_sizes': tail_sizes,
+                'mean_degrees': [mean_degree(metaedge) for metaedge in metapath]}
+        return plan
+
+    def metanode_count(self, metanode):
+        """Return the number of nodes of metanode."""
+        return self.degree_index.metanode_to_count.get(metanode, 0)
+
+    def mean_degree(self, metaedge, exclude_masked=True):
+        """Return the mean degree for metaedge over nodes of its source."""
+        return self.degree_index.mean_degree(metaedge, exclude_masked)
+
+    def degree_array(self, metaedge, exclude_masked=True):
+        """Return an int64 array of the degree for metaedge by node.index."""
+        dictionary = self.degree_index.metaedge_to_unmasked if exclude_masked else self.degree_index.metaedge_to_degrees
+        return numpy.array(dictionary.get(metaedge, ()), dtype=numpy.int64)
+
     def paths_between_tree(self, source, target, metapath,
                       duplicates=False, masked=True,
-                      exclude_nodes=set(), exclude_edges=set()):
+                      exclude_nodes=set(), exclude_edges=set(), view=None,
+                      split_index=None, explain=None):
         """
         Retreive the paths starting with the node source and ending on the
-        node target. Future implementations should split the metapath, computing
-        paths_from the source and target and look for the intersection at the
-        intermediary Node position.
+        node target. Unless split_index is given, the metapath is split where
+        plan_split estimates traversal is cheapest: paths are expanded from the
+        source and the target and joined where they meet, or expanded from
+        one side only. explain, if given, is called with the plan. Paths are
+        returned with every edge oriented from source to target.
         """
-        split_threshold = 2
-        if len(metapath) <= split_threshold:
-            leaves = self.paths_tree(source, metapath, duplicates, masked, exclude_nodes, exclude_edges)
+        if explain is not None or split_index is None:
+            plan = self.plan_split(source, target, metapath, masked, view)
+            if split_index is None:
+                split_index = plan['split_index']
+            plan['split_index'] = split_index
+            if explain is not None:
+                explain(plan)
+
+        if not isinstance(target, Node):
+            target = self.node_dict[target]
+        if not isinstance(source, Node):
+            source = self.node_dict[source]
+
+        # paths_tree does not check its root, so a masked endpoint would
+        # otherwise be allowed or not depending on the split
+        if not masked:
+            node_masked = (lambda node: node.masked) if view is None else view.node_masked
+            if node_masked(source) or node_masked(target):
+                return list()
+
+        get_metapath = self.metagraph.get_metapath
+        if split_index == len(metapath):
+            leaves = self.paths_tree(source, metapath, duplicates, masked, exclude_nodes, exclude_edges, view)
             leaves = filter(lambda leaf: leaf.edge.target == target, leaves)
             paths = [leaf.path_to_root() for leaf in leaves]
             return paths
 
+        metapath_tail = get_metapath(tuple(mp.inverse for mp in reversed(metapath[split_index:])))
+        if split_index == 0:
+            leaves = self.paths_tree(target, metapath_tail, duplicates, masked, exclude_nodes, exclude_edges, view)
+            leaves = filter(lambda leaf: leaf.edge.target == source, leaves)
+            paths = [Path(leaf.path_to_root().inverse_edges()) for leaf in leaves]
+            return paths
 
-        split_index = len(metapath) / 2
-
-        get_metapath = self.metagraph.get_metapath
         metapath_head = get_metapath(metapath[:split_index])
-        metapath_tail = get_metapath(tuple(mp.inverse for mp in reversed(metapath[split_index:])))
-        head_leaves = self.paths_tree(source, metapath_head, duplicates, masked, exclude_nodes, exclude_edges)
-        tail_leaves = self.paths_tree(target, metapath_tail, duplicates, masked, exclude_nodes, exclude_edges)
+        head_leaves = self.paths_tree(source, metapath_head, duplicates, masked, exclude_nodes, exclude_edges, view)
+        tail_leaves = self.paths_tree(target, metapath_tail, duplicates, masked, exclude_nodes, exclude_edges, view)
 
         head_leaf_targets = {head_leaf.edge.target for head_leaf in head_leaves}
         tail_leaf_targets = {tail_leaf.edge.target for tail_leaf in tail_leaves}
@@ -489,14 +1061,14 @@ class Graph(BaseGraph):
         tail_dict = dict()
         for leaf in tail_leaves:
             path = leaf.path_to_root()
-            tail_dict.setdefault(leaf.edge.target, list()).append(path)
+            tail_dict.setdefault(leaf.edge.target, list()).append(path.inverse_edges())
 
         paths = list()
         for node in intersecting_leaf_targets:
             heads = head_dict[node]
             tails = tail_dict[node]
             for head, tail in itertools.product(heads, tails):
-                path = Path(head.edges + tail.edges)
+                path = Path(head.edges + tail)
                 if not duplicates:
                     nodes = path.get_nodes()
                     if len(set(nodes)) < len(nodes):
@@ -507,21 +1079,165 @@ class Graph(BaseGraph):
 
 
 
+    def node_from_index(self, metanode, index):
+        """Return the node of metanode with node.index equal to index."""
+        return self.degree_index.metanode_to_nodes[metanode][index]
+
+    def edge_index(self, edge):
+        """Return the index of edge, shared with its inverse, for PathArrays."""
+        if edge.edge_table is None:
+            self.get_edge_table(edge.metaedge)
+        return edge.table_position
+
+    def edge_from_index(self, metaedge, index, source_index):
+        """Return the edge of metaedge at index whose source has source_index."""
+        edge = self.get_edge_table(metaedge).edges[index]
+        if edge.metaedge != metaedge or edge.source.index != source_index:
+            edge = edge.inverse
+        return edge
+
+    def path_array(self, source, target, metapath,
+                   duplicates=False, masked=True,
+                   exclude_nodes=set(), exclude_edges=set(), view=None,
+                   split_index=None, explain=None):
+        """
+        Return the paths of paths_between_tree as a PathArray, without
+        creating Tree or Path objects. The metapath is split as in
+        paths_between_tree and the trees from each side are expanded
+        depth-first into int32 arrays, which are joined on their meeting node
+        with duplicate nodes removed by comparing columns. Unlike
+        paths_between_tree, a masked source or target with masked True gives
+        no paths rather than an error.
+        """
+        if explain is not None or split_index is None:
+            plan = self.plan_split(source, target, metapath, masked, view)
+            if split_index is None:
+                split_index = plan['split_index']
+            plan['split_index'] = split_index
+            if explain is not None:
+                explain(plan)
+
+        if not isinstance(source, Node):
+            source = self.node_dict[source]
+        if not isinstance(target, Node):
+            target = self.node_dict[target]
+
+        length = len(metapath)
+        empty = PathArray(self, metapath,
+                          numpy.zeros((0, length + 1), dtype=numpy.int32),
+                          numpy.zeros((0, length), dtype=numpy.int32))
+        node_masked = (lambda node: node.masked) if view is None else view.node_masked
+        if node_masked(source) or node_masked(target):
+            return empty
+        if source in exclude_nodes or target in exclude_nodes:
+            return empty
+
+        edge_index = self.edge_index
+
+        def expand(root, metaedges, end, invert):
+            # depth-first expansion returning node and edge index arrays
+            node_buffer = array.array('i')
+            edge_buffer = array.array('i')
+            path_nodes = [root]
+            path_edges = list()
+            depth = len(metaedges)
+
+            def visit(node, i):
+                last = i + 1 == depth
+                for edge in node.edges[metaedges[i]]:
+                    edge_target = edge.target
+                    if last and end is not None and edge_target != end:
+                        continue
+                    if edge_target in exclude_nodes or edge in exclude_edges:
+                        continue
+                    if not masked and (view.edge_blocked(edge) if view else edge_target.masked or edge.masked):
+                        continue
+                    if not duplicates and edge_target in path_nodes:
+                        continue
+                    path_nodes.append(edge_target)
+                    path_edges.append(edge_index(edge.inverse if invert else edge))
+                    if last:
+                        node_buffer.extend(path_node.index for path_node in path_nodes)
+                        edge_buffer.extend(path_edges)
+                    else:
+                        visit(edge_target, i + 1)
+                    path_nodes.pop()
+                    path_edges.pop()
+
+            if depth:
+                visit(root, 0)
+            if not node_buffer:
+                return (numpy.zeros((0, depth + 1), dtype=numpy.int32),
+                        numpy.zeros((0, depth), dtype=numpy.int32))
+            nodes = numpy.frombuffer(node_buffer, dtype=numpy.int32).reshape(-1, depth + 1)
+            edges = numpy.frombuffer(edge_buffer, dtype=numpy.int32).reshape(-1, depth)
+            return nodes, edges
+
+        inverse_metaedges = tuple(metaedge.inverse for metaedge in reversed(metapath))
+        if split_index == length:
+            nodes, edges = expand(source, tuple(metapath), target, False)
+            return PathArray(self, metapath, nodes, edges)
+        if split_index == 0:
+            nodes, edges = expand(target, inverse_metaedges, source, True)
+            return PathArray(self, metapath, nodes[:, ::-1].copy(), edges[:, ::-1].copy())
+
+        head_nodes, head_edges = expand(source, tuple(metapath[:split_index]), None, False)
+        tail_nodes, tail_edges = expand(target, inverse_metaedges[:length - split_index], None, True)
+        tail_nodes = tail_nodes[:, ::-1]
+        tail_edges = tail_edges[:, ::-1]
+
+        # pair every head and tail sharing a meeting node
+        head_order = numpy.argsort(head_nodes[:, -1], kind='mergesort')
+        tail_order = numpy.argsort(tail_nodes[:, 0], kind='mergesort')
+        head_meets = head_nodes[head_order, -1]
+        tail_meets = tail_nodes[tail_order, 0]
+        meets = numpy.intersect1d(head_meets, tail_meets)
+        head_starts = numpy.searchsorted(head_meets, meets, side='left')
+        head_stops = numpy.searchsorted(head_meets, meets, side='right')
+        tail_starts = numpy.searchsorted(tail_meets, meets, side='left')
+        tail_stops = numpy.searchsorted(tail_meets, meets, side='right')
+        head_rows = list()
+        tail_rows = list()
+        for head_start, head_stop, tail_start, tail_stop in zip(head_starts, head_stops, tail_starts, tail_stops):
+            n_tails = tail_stop - tail_start
+            head_rows.append(numpy.repeat(head_order[head_start:head_stop], n_tails))
+            tail_rows.append(numpy.tile(tail_order[tail_start:tail_stop], head_stop - head_start))
+        if not head_rows:
+            return empty
+        head_rows = numpy.concatenate(head_rows)
+        tail_rows = numpy.concatenate(tail_rows)
+        nodes = numpy.hstack([head_nodes[head_rows], tail_nodes[tail_rows, 1:]])
+        edges = numpy.hstack([head_edges[head_rows], tail_edges[tail_rows]])
+
+        if not duplicates:
+            # nodes of the same metanode share an index space
+            metanodes = metapath.get_nodes()
+            keep = numpy.ones(len(nodes), dtype=bool)
+            for i in range(split_index):
+                for j in range(split_index + 1, length + 1):
+                    if metanodes[i] == metanodes[j]:
+                        keep &= nodes[:, i] != nodes[:, j]
+            nodes = nodes[keep]
+            edges = edges[keep]
+        return PathArray(self, metapath, numpy.ascontiguousarray(nodes, dtype=numpy.int32),
+                         numpy.ascontiguousarray(edges, dtype=numpy.int32))
+
     def paths_from(self, source, metapath,
                    duplicates=False, masked=True,
-                   exclude_nodes=set(), exclude_edges=set()):
+                   exclude_nodes=set(), exclude_edges=set(), view=None):
         """
         Return a list of Paths starting with source and following metapath.
         Setting duplicates False disallows paths with repeated nodes.
         Setting masked False disallows paths which traverse a masked node or edge.
         exclude_nodes and exclude_edges allow specification of additional nodes
-        and edges beyond (or independent of) masked nodes and edges.
+        and edges beyond (or independent of) masked nodes and edges. When a
+        MaskView is passed as view, masks are taken from it.
         """
 
         if not isinstance(source, Node):
             source = self.node_dict[source]
         
-        if masked and source.masked:
+        if masked and (source.masked if view is None else view.node_masked(source)):
             return None
         
         if source in exclude_nodes:
@@ -535,7 +1251,7 @@ class Graph(BaseGraph):
                 continue
             if edge in exclude_edges:
                 continue
-            if not masked and (edge_target.masked or edge.masked):
+            if not masked and (view.edge_blocked(edge) if view else edge_target.masked or edge.masked):
                 continue
             if not duplicates and edge_target == source:
                 continue
@@ -554,7 +1270,7 @@ class Graph(BaseGraph):
                         continue
                     if edge in exclude_edges:
                         continue
-                    if not masked and (edge_target.masked or edge.masked):
+                    if not masked and (view.edge_blocked(edge) if view else edge_target.masked or edge.masked):
                         continue
                     if not duplicates and edge_target in nodes:
                         continue
@@ -564,9 +1280,108 @@ class Graph(BaseGraph):
         
         return paths
     
+    def iter_paths_from(self, source, metapath,
+                        duplicates=False, masked=True,
+                        exclude_nodes=set(), exclude_edges=set(), view=None,
+                        reachable=None):
+        """
+        Generate the paths of paths_from depth-first, so that only the path
+        being extended is held in memory. reachable, if given, is a list of
+        node sets by metapath position outside of which branches are pruned,
+        as returned by reachable_nodes. When paths_from would return None,
+        nothing is generated.
+        """
+        if not isinstance(source, Node):
+            source = self.node_dict[source]
+
+        if masked and (source.masked if view is None else view.node_masked(source)):
+            return
+
+        if source in exclude_nodes:
+            return
+
+        length = len(metapath)
+        path_edges = list()
+        path_nodes = [source]
+        stack = [iter(source.edges[metapath[0]])]
+        while stack:
+            depth = len(stack)
+            for edge in stack[-1]:
+                edge_target = edge.target
+                if edge_target in exclude_nodes:
+                    continue
+                if edge in exclude_edges:
+                    continue
+                if not masked and (view.edge_blocked(edge) if view else edge_target.masked or edge.masked):
+                    continue
+                if not duplicates and edge_target in path_nodes:
+                    continue
+                if reachable is not None and edge_target not in reachable[depth]:
+                    continue
+                if depth == length:
+                    yield Path(tuple(path_edges) + (edge, ))
+                    continue
+                path_edges.append(edge)
+                path_nodes.append(edge_target)
+                stack.append(iter(edge_target.edges[metapath[depth]]))
+                break
+            else:
+                stack.pop()
+                if path_edges:
+                    path_edges.pop()
+                    path_nodes.pop()
+
+    def reachable_nodes(self, target, metapath, masked=True,
+                        exclude_nodes=set(), exclude_edges=set(), view=None):
+        """
+        Return a list of node sets by position of metapath, holding the nodes
+        from which target can be reached by following the rest of metapath.
+        Found by a backward pass over nodes, ignoring duplicate nodes.
+        """
+        if not isinstance(target, Node):
+            target = self.node_dict[target]
+        length = len(metapath)
+        reachable = [set() for i in range(length + 1)]
+        if target not in exclude_nodes:
+            reachable[length].add(target)
+        for i in reversed(range(length)):
+            inverse = metapath[i].inverse
+            for node in reachable[i + 1]:
+                for edge in node.edges[inverse]:
+                    # edge.inverse is the edge as traversed from source
+                    forward = edge.inverse
+                    if forward in exclude_edges:
+                        continue
+                    if not masked and (view.edge_blocked(forward) if view else node.masked or forward.masked):
+                        continue
+                    reachable[i].add(edge.target)
+        return reachable
+
+    def iter_paths_between(self, source, target, metapath,
+                           duplicates=False, masked=True,
+                           exclude_nodes=set(), exclude_edges=set(), view=None):
+        """
+        Generate the paths of paths_between_tree depth-first from source,
+        pruning branches that cannot reach target. Memory is bounded by the
+        path length and the reachable node sets rather than the number of
+        paths.
+        """
+        if not isinstance(source, Node):
+            source = self.node_dict[source]
+        if not isinstance(target, Node):
+            target = self.node_dict[target]
+        node_masked = (lambda node: node.masked) if view is None else view.node_masked
+        if not masked and (node_masked(source) or node_masked(target)):
+            return iter(())
+        reachable = self.reachable_nodes(target, metapath, masked, exclude_nodes, exclude_edges, view)
+        if source not in reachable[0]:
+            return iter(())
+        return self.iter_paths_from(source, metapath, duplicates, masked,
+                                    exclude_nodes, exclude_edges, view, reachable)
+
     def paths_between(self, source, target, metapath,
                       duplicates=False, masked=True,
-                      exclude_nodes=set(), exclude_edges=set()):
+                      exclude_nodes=set(), exclude_edges=set(), view=None):
         """
         Retreive the paths starting with the node source and ending on the
         node target. Future implementations should split the metapath, computing
@@ -575,7 +1390,7 @@ class Graph(BaseGraph):
         """
         if len(metapath) <= 1:
             paths = self.paths_from(source, metapath, duplicates, masked,
-                                    exclude_nodes, exclude_edges)
+                                    exclude_nodes, exclude_edges, view)
             paths = [path for path in paths if path.target() == target]
             return paths
         
@@ -585,8 +1400,8 @@ class Graph(BaseGraph):
         get_metapath = self.metagraph.get_metapath
         metapath_head = get_metapath(metapath[:split_index])
         metapath_tail = get_metapath(tuple(mp.inverse for mp in reversed(metapath[split_index:])))
-        paths_head = self.paths_from(source, metapath_head, duplicates, masked, exclude_nodes, exclude_edges)
-        paths_tail = self.paths_from(target, metapath_tail, duplicates, masked, exclude_nodes, exclude_edges)
+        paths_head = self.paths_from(source, metapath_head, duplicates, masked, exclude_nodes, exclude_edges, view)
+        paths_tail = self.paths_from(target, metapath_tail, duplicates, masked, exclude_nodes, exclude_edges, view)
         
         node_intersect = (set(path.target() for path in paths_head) & 
                           set(path.target() for path in paths_tail))
@@ -617,10 +1432,382 @@ class Graph(BaseGraph):
                 paths.append(path)
         
         return paths        
-    
-    
+
+    def count_paths_from(self, source, metapath,
+                         duplicates=False, masked=True,
+                         exclude_nodes=set(), exclude_edges=set()):
+        """
+        Return the number of paths that paths_from would return, without
+        creating Path objects. Arguments are as for paths_from.
+        """
+        return self.count_paths(source, None, metapath, duplicates, masked,
+                                exclude_nodes, exclude_edges)
+
+    def count_paths_between(self, source, target, metapath,
+                            duplicates=False, masked=True,
+                            exclude_nodes=set(), exclude_edges=set()):
+        """
+        Return the number of paths starting with source, following metapath
+        and ending on target, without creating Path or Tree objects.
+        Arguments are as for paths_from.
+        """
+        if not isinstance(target, Node):
+            target = self.node_dict[target]
+        return self.count_paths(source, target, metapath, duplicates, masked,
+                                exclude_nodes, exclude_edges)
+
+    def count_paths(self, source, target, metapath,
+                    duplicates=False, masked=True,
+                    exclude_nodes=set(), exclude_edges=set()):
+        """
+        Count paths by depth-first search over metapath. The number of
+        completions from a node at position i is memoized whenever no later
+        metanode occurs before position i, since the duplicate node check
+        cannot then depend on the nodes preceding position i. When target
+        is None, paths ending on any node are counted.
+        """
+        if not isinstance(source, Node):
+            source = self.node_dict[source]
+
+        if masked and source.masked:
+            return 0
+
+        if source in exclude_nodes:
+            return 0
+
+        length = len(metapath)
+        metanodes = metapath.get_nodes()
+        memoizable = [duplicates or not set(metanodes[i + 1:]) & set(metanodes[:i])
+                      for i in range(length)]
+        memo = dict()
+        path_nodes = [source]
+
+        def count_from(node, i):
+            if memoizable[i]:
+                key = node, i
+                if key in memo:
+                    return memo[key]
+            last = i + 1 == length
+            count = 0
+            for edge in node.edges[metapath[i]]:
+                edge_target = edge.target
+                if last and target is not None and edge_target != target:
+                    continue
+                if edge_target in exclude_nodes:
+                    continue
+                if edge in exclude_edges:
+                    continue
+                if not masked and (edge_target.masked or edge.masked):
+                    continue
+                if not duplicates and edge_target in path_nodes:
+                    continue
+                if last:
+                    count += 1
+                    continue
+                path_nodes.append(edge_target)
+                count += count_from(edge_target, i + 1)
+                path_nodes.pop()
+            if memoizable[i]:
+                memo[key] = count
+            return count
+
+        return count_from(source, 0)
+
+    def dwpc_from(self, source, metapath, damping_exponent,
+                  duplicates=False, masked=True,
+                  exclude_nodes=set(), exclude_edges=set(), exclude_masked=True):
+        """
+        Expand metapath from source a single time and return a dictionary of
+        target node to (PC, DWPC) for every target reached. Paths follow the
+        rules of paths_from and degrees are computed as in
+        hetnet.algorithms.path_degree_product, so the DWPC for a target equals
+        DWPC(paths_between_tree(source, target, metapath)) with the same
+        arguments. Where that DWPC raises ZeroDivisionError, because a path
+        has a degree of zero, the DWPC for the target is NaN.
+        """
+        metapath_to_vector = self.dwpc_from_metapaths(
+            source, [metapath], damping_exponent, duplicates, masked,
+            exclude_nodes, exclude_edges, exclude_masked)
+        return metapath_to_vector[metapath]
+
+    def top_paths(self, source, target, metapath, k, damping_exponent,
+                  duplicates=False, masked=True,
+                  exclude_nodes=set(), exclude_edges=set(), exclude_masked=True, view=None):
+        """
+        Return the k paths from source to target following metapath with the
+        largest weight, 1 / path_degree_product, as a list of (path, weight)
+        by decreasing weight. Arguments are as for paths_between_tree and
+        hetnet.algorithms.DWPC.
+
+        Paths are searched best-first from source. The bound for a partial
+        path is its weight times the largest weight of any completion from
+        its last node to target, found by a backward pass from target over
+        nodes rather than paths. Since the bound ignores duplicate nodes it
+        never underestimates, so complete paths leave the queue in order of
+        weight and branches whose bound is below the k-th weight are never
+        expanded.
+        """
+        if not isinstance(source, Node):
+            source = self.node_dict[source]
+        if not isinstance(target, Node):
+            target = self.node_dict[target]
+        if k <= 0 or source in exclude_nodes or target in exclude_nodes:
+            return list()
+        node_masked = (lambda node: node.masked) if view is None else view.node_masked
+        if not masked and (node_masked(source) or node_masked(target)):
+            return list()
+
+        if view is None:
+            exclusion_counts = DegreeIndex.exclusion_counts(exclude_edges, exclude_masked)
+        else:
+            exclusion_counts = view.exclusion_counts(exclude_edges, exclude_masked)
+        damped = dict()
+
+        def edge_factor(edge):
+            # weight contributed by edge, cached per node and metaedge
+            factor = 1.0
+            for node, metaedge in (edge.source, edge.metaedge), (edge.target, edge.metaedge.inverse):
+                key = node, metaedge
+                if key not in damped:
+                    if view is None:
+                        degree = node.get_degree(metaedge, exclude_masked, exclusion_counts)
+                    else:
+                        degree = view.get_degree(node, metaedge, exclude_masked, exclusion_counts)
+                    damped[key] = 1.0 / degree ** damping_exponent
+                factor *= damped[key]
+            return factor
+
+        def traversable(edge):
+            edge_target = edge.target
+            if edge_target in exclude_nodes or edge in exclude_edges:
+                return False
+            if not masked and (view.edge_blocked(edge) if view else edge_target.masked or edge.masked):
+                return False
+            return True
+
+        # best[i][node]: largest weight of a completion from node at position i
+        length = len(metapath)
+        best = [dict() for i in range(length + 1)]
+        best[length][target] = 1.0
+        for i in reversed(range(length)):
+            inverse = metapath[i].inverse
+            for node, completion in best[i + 1].iteritems():
+                for edge in node.edges[inverse]:
+                    if not traversable(edge):
+                        continue
+                    bound = completion * edge_factor(edge)
+                    previous = best[i].get(edge.target)
+                    if previous is None or bound > previous:
+                        best[i][edge.target] = bound
+            if not best[i]:
+                return list()
+        if source not in best[0]:
+            return list()
+
+        counter = itertools.count()
+        queue = [(-best[0][source], next(counter), source, 0, 1.0, ())]
+        top = list()
+        while queue and len(top) < k:
+            node, position, weight, edges = heapq.heappop(queue)[2:]
+            if position == length:
+                top.append((Path(edges), weight))
+                continue
+            path_nodes = {source}.union(edge.target for edge in edges)
+            next_best = best[position + 1]
+            for edge in node.edges[metapath[position]]:
+                edge_target = edge.target
+                completion = next_best.get(edge_target)
+                if completion is None or not traversable(edge):
+                    continue
+                if not duplicates and edge_target in path_nodes:
+                    continue
+                extended = weight * edge_factor(edge)
+                heapq.heappush(queue, (-extended * completion, next(counter),
+                                       edge_target, position + 1, extended, edges + (edge, )))
+        return top
+
+    def metapath_trie(self, metapaths):
+        """
+        Arrange metapaths into a prefix trie. Returns a dictionary of prefix
+        to the list of its one-edge extensions, where the root prefix is None
+        and prefixes are the MetaPaths held in metagraph.path_dict. The parent
+        of a prefix is found as prefix.inverse.sub.inverse.
+        """
+        children = dict()
+        for metapath in metapaths:
+            prefix = metapath
+            while prefix is not None:
+                parent_inverse = prefix.inverse.sub
+                parent = None if parent_inverse is None else parent_inverse.inverse
+                extensions = children.setdefault(parent, list())
+                if prefix in extensions:
+                    break
+                extensions.append(prefix)
+                prefix = parent
+        return children
+
+    def dwpc_from_metapaths(self, source, metapaths, damping_exponent,
+                            duplicates=False, masked=True,
+                            exclude_nodes=set(), exclude_edges=set(), exclude_masked=True):
+        """
+        Compute dwpc_from for several metapaths starting on the metanode of
+        source in a single traversal. Metapaths are arranged into a prefix trie
+        (metapath_trie) so each shared prefix is expanded from source only once.
+        Returns a dictionary of metapath to dwpc_from output.
+        """
+        metapath_to_vector = {metapath: dict() for metapath in metapaths}
+
+        if not isinstance(source, Node):
+            source = self.node_dict[source]
+
+        if masked and source.masked:
+            return metapath_to_vector
+
+        if source in exclude_nodes:
+            return metapath_to_vector
+
+        children = self.metapath_trie(metapaths)
+        metapath_to_pc = {metapath: dict() for metapath in metapaths}
+        metapath_to_dwpc = {metapath: dict() for metapath in metapaths}
+        degrees = dict()
+        exclusion_counts = DegreeIndex.exclusion_counts(exclude_edges, exclude_masked)
+
+        def damped_degree(node, metaedge):
+            key = node, metaedge
+            if key not in degrees:
+                degree = node.get_degree(metaedge, exclude_masked, exclusion_counts)
+                degrees[key] = degree ** damping_exponent
+            return degrees[key]
+
+        path_nodes = [source]
+
+        def expand(node, prefix, degree_product):
+            for extension in children[prefix]:
+                metaedge = extension[-1]
+                inverse = metaedge.inverse
+                source_degree = damped_degree(node, metaedge)
+                target_to_pc = metapath_to_pc.get(extension)
+                target_to_dwpc = metapath_to_dwpc.get(extension)
+                extend = extension in children
+                for edge in node.edges[metaedge]:
+                    edge_target = edge.target
+                    if edge_target in exclude_nodes:
+                        continue
+                    if edge in exclude_edges:
+                        continue
+                    if not masked and (edge_target.masked or edge.masked):
+                        continue
+                    if not duplicates and edge_target in path_nodes:
+                        continue
+                    product = degree_product * source_degree
+                    product *= damped_degree(edge_target, inverse)
+                    if target_to_pc is not None:
+                        target_to_pc[edge_target] = target_to_pc.get(edge_target, 0) + 1
+                        weight = 1.0 / product if product else float('nan')
+                        target_to_dwpc[edge_target] = target_to_dwpc.get(edge_target, 0.0) + weight
+                    if extend:
+                        path_nodes.append(edge_target)
+                        expand(edge_target, extension, product)
+                        path_nodes.pop()
+
+        expand(source, None, 1)
+        for metapath, target_to_pc in metapath_to_pc.items():
+            target_to_dwpc = metapath_to_dwpc[metapath]
+            metapath_to_vector[metapath] = {target: (target_to_pc[target], target_to_dwpc[target])
+                                            for target in target_to_pc}
+        return metapath_to_vector
+
+    def dwpc_exclusion_delta(self, source, target, metapath, damping_exponent, dwpc,
+                             exclude_edges, masked=True, exclude_masked=True):
+        """
+        Return the DWPC between source and target for metapath without
+        duplicate nodes when exclude_edges are excluded, given dwpc, the DWPC
+        without exclusions (for example from dwpc_from_metapaths). Excluding
+        edges lowers the degrees counted by DegreeIndex.exclusion_counts. A
+        lowered degree at the source or target position scales every path by
+        the same factor. Only paths through an interior node whose degree
+        changes, which include every path traversing an excluded edge, are
+        enumerated by joining the paths to and from that node. Their
+        contribution is replaced by their weight with exclusions. As for
+        DWPC, a remaining path with a degree of zero raises ZeroDivisionError.
+        """
+        if not exclude_edges:
+            return dwpc
+        exclusion_counts = DegreeIndex.exclusion_counts(exclude_edges, exclude_masked)
+
+        def path_weight(path, counts):
+            product = 1.0
+            for edge in path:
+                metaedge = edge.metaedge
+                product *= edge.source.get_degree(metaedge, exclude_masked, counts) ** damping_exponent
+                product *= edge.target.get_degree(metaedge.inverse, exclude_masked, counts) ** damping_exponent
+            return 1.0 / product
+
+        if len(metapath) == 1:
+            paths = self.paths_between_tree(source, target, metapath, False, masked,
+                                            exclude_edges=exclude_edges)
+            return sum(path_weight(path, exclusion_counts) for path in paths)
+
+        # degree changes at the endpoints scale every path
+        scale = 1.0
+        for node, metaedge in (source, metapath[0]), (target, metapath[-1].inverse):
+            count = exclusion_counts.get((node, metaedge))
+            if not count:
+                continue
+            degree = node.get_degree(metaedge, exclude_masked)
+            if degree == count:
+                # remaining paths, if any, have a zero degree
+                paths = self.paths_between_tree(source, target, metapath, False, masked,
+                                                exclude_edges=exclude_edges)
+                return sum(path_weight(path, exclusion_counts) for path in paths)
+            scale *= (float(degree) / (degree - count)) ** damping_exponent
+
+        # (node, metaedge) pairs whose paths must be reweighted
+        touched = set(exclusion_counts)
+        for edge in exclude_edges:
+            touched.add((edge.source, edge.metaedge))
+            touched.add((edge.target, edge.metaedge.inverse))
+
+        def is_touched(nodes, position):
+            node = nodes[position]
+            return ((node, metapath[position - 1].inverse) in touched or
+                    (node, metapath[position]) in touched)
+
+        get_metapath = self.metagraph.get_metapath
+        affected = list()
+        for position in range(1, len(metapath)):
+            metaedges = metapath[position - 1].inverse, metapath[position]
+            candidates = {node for node, metaedge in touched if metaedge in metaedges}
+            if not candidates:
+                continue
+            head_metapath = get_metapath(metapath[:position])
+            tail_metapath = get_metapath(metapath[position:])
+            for node in candidates:
+                heads = self.paths_between_tree(source, node, head_metapath, False, masked)
+                if not heads:
+                    continue
+                tails = self.paths_between_tree(node, target, tail_metapath, False, masked)
+                for head, tail in itertools.product(heads, tails):
+                    path = Path(head.edges + tail.edges)
+                    nodes = path.get_nodes()
+                    if len(set(nodes)) < len(nodes):
+                        continue
+                    # count each path once, at its first touched interior node
+                    if any(is_touched(nodes, i) for i in range(1, position)):
+                        continue
+                    affected.append(path)
+
+        unaffected = dwpc - sum(path_weight(path, None) for path in affected)
+        if abs(unaffected) <= 1e-12 * dwpc:
+            unaffected = 0.0
+        reweighted = sum(path_weight(path, exclusion_counts) for path in affected
+                         if not exclude_edges.intersection(path.edges))
+        return scale * unaffected + reweighted
+
+
     def unmask(self):
         """Unmask all nodes and edges contained within the graph"""
+        self.clear_edge_masks()
         for dictionary in self.node_dict, self.edge_dict:
             for value in dictionary.itervalues():
                 value.masked = False
@@ -645,11 +1832,38 @@ class Node(BaseNode):
     
     def __init__(self, id_, metanode, data):
         """ """
+        self.degree_index = None
         BaseNode.__init__(self, id_)
         self.metanode = metanode
         self.data = data
         self.edges = {metaedge: set() for metaedge in metanode.edges}
 
+    @property
+    def masked(self):
+        return self._masked
+
+    @masked.setter
+    def masked(self, masked):
+        previous = getattr(self, '_masked', False)
+        self._masked = masked
+        if self.degree_index is not None and bool(previous) != bool(masked):
+            self.degree_index.node_masking(self, masked)
+
+    def get_degree(self, metaedge, exclude_masked=True, exclusion_counts=None):
+        """
+        Return the number of edges incident to self of the specified metaedge,
+        equal to len(self.get_edges(metaedge, exclude_masked)). Edges counted
+        in exclusion_counts, as returned by DegreeIndex.exclusion_counts, are
+        subtracted.
+        """
+        if self.degree_index is None:
+            degree = len(self.get_edges(metaedge, exclude_masked))
+        else:
+            degree = self.degree_index.get(self, metaedge, exclude_masked)
+        if exclusion_counts:
+            degree -= exclusion_counts.get((self, metaedge), 0)
+        return degree
+
     def get_edges(self, metaedge, exclude_masked=True):
         """
         Returns the set of edges incident to self of the specified metaedge.
@@ -665,6 +1879,9 @@ class Node(BaseNode):
         return edges
 
 class Edge(BaseEdge):
+
+    # EdgeTable holding the edge, set by the table
+    edge_table = None
     
     def __init__(self, source, target, metaedge, data):
         """source and target are Node objects. metaedge is the MetaEdge object
@@ -674,6 +1891,26 @@ class Edge(BaseEdge):
         self.metaedge = metaedge
         self.data = data
         self.source.edges[metaedge].add(self)
+
+    @property
+    def masked(self):
+        """Whether the edge is masked itself or by its edge table predicate."""
+        if self._masked:
+            return True
+        table = self.edge_table
+        return table is not None and bool(table.mask[self.table_position])
+
+    @masked.setter
+    def masked(self, masked):
+        previous = self.masked if hasattr(self, '_masked') else False
+        self._masked = masked
+        table = self.edge_table
+        if table is not None:
+            table.element_masking(self, masked)
+        if bool(previous) != self.masked:
+            degree_index = self.source.degree_index
+            if degree_index is not None:
+                degree_index.edge_masking(self, self.masked)
     
     def get_id(self):
         return self.source.id_, self.target.id_, self.metaedge.kind, self.metaedge.direction
@@ -692,6 +1929,84 @@ class Path(BasePath):
         s = '{}{}'.format(s, self.target())
         return s
 
+
+class PathArray(object):
+
+    def __init__(self, graph, metapath, nodes, edges):
+        """
+        Paths following metapath stored as an int32 array of node indexes
+        (n_paths by len(metapath) + 1) and an int32 array of edge indexes
+        (n_paths by len(metapath)), as given by graph.edge_index for each
+        edge oriented from source to target. Path objects are only created
+        when the array is indexed or iterated.
+        """
+        self.graph = graph
+        self.metapath = metapath
+        self.nodes = nodes
+        self.edges = edges
+
+    @property
+    def nbytes(self):
+        return self.nodes.nbytes + self.edges.nbytes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __getitem__(self, i):
+        metapath = self.metapath
+        node_row = self.nodes[i]
+        edges = tuple(self.graph.edge_from_index(metaedge, int(self.edges[i, j]), int(node_row[j]))
+                      for j, metaedge in enumerate(metapath))
+        return Path(edges)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def get_degrees(self, position, metaedge, exclude_masked=True, exclusion_counts=None, view=None):
+        """
+        Return an array of the degree for metaedge of the node at position of
+        every path. Degrees are looked up once per distinct node.
+        """
+        metanode = metaedge.source
+        indexes, inverse = numpy.unique(self.nodes[:, position], return_inverse=True)
+        degrees = numpy.zeros(len(indexes), dtype=numpy.float64)
+        for i, index in enumerate(indexes):
+            node = self.graph.node_from_index(metanode, int(index))
+            if view is None:
+                degrees[i] = node.get_degree(metaedge, exclude_masked, exclusion_counts)
+            else:
+                degrees[i] = view.get_degree(node, metaedge, exclude_masked, exclusion_counts)
+        return degrees[inverse]
+
+    def edge_degrees(self, exclude_masked=True, exclusion_counts=None, view=None):
+        """
+        Return a list with an array per metaedge of metapath holding the
+        products of source and target degrees of that edge on every path.
+        """
+        products = list()
+        for j, metaedge in enumerate(self.metapath):
+            source_degrees = self.get_degrees(j, metaedge, exclude_masked, exclusion_counts, view)
+            target_degrees = self.get_degrees(j + 1, metaedge.inverse, exclude_masked, exclusion_counts, view)
+            products.append(source_degrees * target_degrees)
+        return products
+
+    def degree_products(self, damping_exponent, exclude_masked=True, exclusion_counts=None, view=None):
+        """Return the array of path_degree_product for every path."""
+        product = numpy.ones(len(self))
+        for degrees in self.edge_degrees(exclude_masked, exclusion_counts, view):
+            product *= degrees ** damping_exponent
+        return product
+
+    def log_degree_sums(self, exclude_masked=True, exclusion_counts=None, view=None):
+        """Return the array of path_log_degree_sum for every path."""
+        log_sums = numpy.zeros(len(self))
+        for degrees in self.edge_degrees(exclude_masked, exclusion_counts, view):
+            if not degrees.all():
+                raise ZeroDivisionError('path with a degree of zero')
+            log_sums += numpy.log(degrees)
+        return log_sums
+
 if __name__ == '__main__':
     """ """
     metaedges = [('gene', 'disease', 'association', 'both'),
@@ -0,0 +1,328 @@
+import itertools
+import operator
+
+import numpy
+import scipy.sparse
+
+
+def set_partitions(elements):
+    """Generate every partition of elements as a list of lists (blocks)."""
+    elements = list(elements)
+    if not elements:
+        yield list()
+        return
+    first, rest = elements[0], elements[1:]
+    for partition in set_partitions(rest):
+        yield [[first]] + partition
+        for i in range(len(partition)):
+            yield partition[:i] + [[first] + partition[i]] + partition[i + 1:]
+
+def mobius_coefficient(partition):
+    """
+    Return the Mobius function of the partition lattice from the finest
+    partition to partition. Summing mobius_coefficient(partition) times the
+    walk total where each block is forced to a single node over all partitions
+    gives the total over walks without repeated nodes.
+    """
+    coefficient = 1
+    for block in partition:
+        size = len(block)
+        coefficient *= (-1) ** (size - 1) * reduce(operator.mul, range(1, size), 1)
+    return coefficient
+
+def metapath_partitions(metapath):
+    """
+    Generate partitions of the node positions of metapath where positions
+    sharing a block also share a metanode. Positions of different metanodes
+    can never hold the same node and therefore never share a block.
+    """
+    metanode_to_positions = dict()
+    for position, metanode in enumerate(metapath.get_nodes()):
+        metanode_to_positions.setdefault(metanode, list()).append(position)
+    metanode_partitions = [list(set_partitions(positions))
+                           for positions in metanode_to_positions.values()]
+    for partitions in itertools.product(*metanode_partitions):
+        yield [block for partition in partitions for block in partition]
+
+
+class SparseDWPC(object):
+
+    def __init__(self, graph, damping_exponent, exclude_masked=True):
+        """
+        Computes degree-weighted path counts for entire metapaths as chains of
+        sparse matrix products. Each MetaEdge becomes a source by target
+        matrix whose entries are source_degree ** -damping_exponent *
+        target_degree ** -damping_exponent, matching path_degree_product in
+        hetnet.algorithms. As for paths enumerated with masked=True, every
+        edge is traversed. Degrees come from node.get_degree, so when
+        exclude_masked, masked edges and edges onto masked nodes are not
+        counted towards degrees. When a path between a pair crosses an edge
+        with a zero degree, dwpc raises ZeroDivisionError as
+        hetnet.algorithms.DWPC does. Such pairs are found by counting paths
+        over all edges and over edges with nonzero degrees.
+
+        Duplicate nodes are excluded exactly for metapaths of up to
+        max_length edges. Longer metapaths are supported only with
+        duplicates, otherwise dwpc_matrix raises ValueError.
+        """
+        self.graph = graph
+        self.damping_exponent = damping_exponent
+        self.exclude_masked = exclude_masked
+        self.metanode_to_nodes = dict()
+        self.metanode_to_index = dict()
+        self.metaedge_to_adjacency = dict()
+        self.metaedge_to_weighted = dict()
+        self.metaedge_to_undefined = dict()
+        self.metapath_to_dwpc = dict()
+        self.metapath_to_undefined = dict()
+
+    # longest metapath for which duplicate nodes can be excluded
+    max_length = 4
+
+    def get_nodes(self, metanode):
+        """Return the nodes of metanode, sorted, defining the matrix order."""
+        if metanode not in self.metanode_to_nodes:
+            nodes = [node for node in self.graph.node_dict.itervalues()
+                     if node.metanode == metanode]
+            nodes.sort()
+            self.metanode_to_nodes[metanode] = nodes
+            self.metanode_to_index[metanode] = {node: i for i, node in enumerate(nodes)}
+        return self.metanode_to_nodes[metanode]
+
+    def get_index(self, metanode):
+        """Return a dictionary of node to matrix position for metanode."""
+        self.get_nodes(metanode)
+        return self.metanode_to_index[metanode]
+
+    def get_adjacency(self, metaedge):
+        """Return the binary source by target csr_matrix of all metaedge edges."""
+        if metaedge in self.metaedge_to_adjacency:
+            return self.metaedge_to_adjacency[metaedge]
+        sources = self.get_nodes(metaedge.source)
+        target_index = self.get_index(metaedge.target)
+        rows = list()
+        cols = list()
+        for i, node in enumerate(sources):
+            for edge in node.edges[metaedge]:
+                rows.append(i)
+                cols.append(target_index[edge.target])
+        data = numpy.ones(len(rows), dtype=numpy.float64)
+        shape = len(sources), len(target_index)
+        adjacency = scipy.sparse.csr_matrix((data, (rows, cols)), shape=shape)
+        self.metaedge_to_adjacency[metaedge] = adjacency
+        return adjacency
+
+    def get_degrees(self, metaedge):
+        """Return the array of degrees for metaedge in get_nodes order."""
+        return numpy.array([node.get_degree(metaedge, self.exclude_masked)
+                            for node in self.get_nodes(metaedge.source)], dtype=numpy.float64)
+
+    def damp(self, degrees):
+        """Raise degrees to -damping_exponent, mapping zero degrees to zero."""
+        degrees = numpy.asarray(degrees, dtype=numpy.float64).ravel()
+        damped = numpy.zeros_like(degrees)
+        nonzero = degrees > 0
+        damped[nonzero] = degrees[nonzero] ** -self.damping_exponent
+        return damped
+
+    def get_weighted(self, metaedge):
+        """Return the degree-weighted csr_matrix for metaedge."""
+        if metaedge in self.metaedge_to_weighted:
+            return self.metaedge_to_weighted[metaedge]
+        adjacency = self.get_adjacency(metaedge)
+        source_degrees = self.get_degrees(metaedge)
+        target_degrees = self.get_degrees(metaedge.inverse)
+        source_scale = scipy.sparse.diags(self.damp(source_degrees))
+        target_scale = scipy.sparse.diags(self.damp(target_degrees))
+        weighted = source_scale.dot(adjacency).dot(target_scale).tocsr()
+        weighted.eliminate_zeros()
+        self.metaedge_to_weighted[metaedge] = weighted
+        return weighted
+
+    def get_defined(self, metaedge):
+        """Return the binary csr_matrix of metaedge edges with nonzero degrees."""
+        defined = self.get_weighted(metaedge).copy()
+        defined.data[:] = 1
+        return defined
+
+    def has_undefined(self, metaedge):
+        """Return whether an edge of metaedge has a zero degree."""
+        if metaedge not in self.metaedge_to_undefined:
+            self.metaedge_to_undefined[metaedge] = (
+                self.get_adjacency(metaedge).nnz > self.get_weighted(metaedge).nnz)
+        return self.metaedge_to_undefined[metaedge]
+
+    def dwpc_matrix(self, metapath, duplicates=False):
+        """
+        Return the source by target csr_matrix of DWPCs for metapath. Row and
+        column order are given by get_nodes of the metapath source and target.
+        When duplicates is False, paths with repeated nodes are excluded
+        exactly by inclusion-exclusion over the positions of each metanode,
+        which requires a metapath of at most max_length edges.
+        """
+        key = metapath, duplicates
+        if key not in self.metapath_to_dwpc:
+            self.metapath_to_dwpc[key] = self.chain_matrix(metapath, duplicates, self.get_weighted)
+        return self.metapath_to_dwpc[key]
+
+    def undefined_matrix(self, metapath, duplicates=False):
+        """
+        Return the source by target csr_matrix counting paths that cross an
+        edge with a zero degree, or None when metapath has no such edges.
+        """
+        key = metapath, duplicates
+        if key not in self.metapath_to_undefined:
+            undefined = None
+            if any(self.has_undefined(metaedge) for metaedge in metapath):
+                undefined = (self.chain_matrix(metapath, duplicates, self.get_adjacency) -
+                             self.chain_matrix(metapath, duplicates, self.get_defined))
+            self.metapath_to_undefined[key] = undefined
+        return self.metapath_to_undefined[key]
+
+    def chain_matrix(self, metapath, duplicates, get_matrix):
+        """
+        Return the source by target csr_matrix summing, over the paths
+        following metapath, the product of the get_matrix(metaedge) entries
+        of their edges.
+        """
+        if not duplicates and len(metapath) > self.max_length:
+            raise ValueError('Excluding duplicate nodes requires metapaths of at most '
+                             '{} edges: {}'.format(self.max_length, metapath))
+        positions = range(len(metapath) + 1)
+        if duplicates:
+            partitions = [[[position] for position in positions]]
+        else:
+            partitions = metapath_partitions(metapath)
+        dwpc = None
+        for partition in partitions:
+            term = self.constrained_walks(metapath, partition, get_matrix)
+            if term is None:
+                continue
+            term = term * mobius_coefficient(partition)
+            dwpc = term if dwpc is None else dwpc + term
+        if dwpc is None:
+            shape = (len(self.get_nodes(metapath.source())),
+                     len(self.get_nodes(metapath.target())))
+            dwpc = scipy.sparse.csr_matrix(shape)
+        dwpc = dwpc.tocsr()
+        dwpc.eliminate_zeros()
+        return dwpc
+
+    def constrained_walks(self, metapath, partition, get_matrix):
+        """
+        Return the source by target matrix of weighted walks following
+        metapath where positions sharing a block of partition are forced to
+        be the same node. Returns None when the total is known to be zero.
+        Interior blocks are summed out one at a time, choosing the block whose
+        elimination yields the smallest matrix.
+        """
+        position_to_block = dict()
+        for i, block in enumerate(partition):
+            for position in block:
+                position_to_block[position] = i
+        source_block = position_to_block[0]
+        target_block = position_to_block[len(metapath)]
+        block_to_metanode = {position_to_block[i]: metanode
+            for i, metanode in enumerate(metapath.get_nodes())}
+
+        # factors are (block, block, matrix) or (block, vector)
+        factors = list()
+        for i, metaedge in enumerate(metapath):
+            weighted = get_matrix(metaedge)
+            u, v = position_to_block[i], position_to_block[i + 1]
+            if u == v:
+                diagonal = weighted.diagonal()
+                if not diagonal.any():
+                    return None
+                factors.append((u, diagonal))
+            else:
+                factors.append((u, v, weighted))
+
+        interior = set(range(len(partition))) - {source_block, target_block}
+        while interior:
+            def elimination_size(block):
+                neighbors = {f[0] if f[1] == block else f[1] for f in factors
+                             if len(f) == 3 and block in f[:2]}
+                size = 1
+                for neighbor in neighbors:
+                    size *= len(self.get_nodes(block_to_metanode[neighbor]))
+                return len(neighbors), size
+            block = min(interior, key=elimination_size)
+            interior.remove(block)
+            factors = self.eliminate(block, factors, block_to_metanode)
+
+        return self.combine(source_block, target_block, factors, block_to_metanode)
+
+    def eliminate(self, block, factors, block_to_metanode):
+        """Sum out block from factors, returning the new list of factors."""
+        n = len(self.get_nodes(block_to_metanode[block]))
+        vector = numpy.ones(n)
+        neighbor_to_matrix = dict()
+        remaining = list()
+        for factor in factors:
+            if len(factor) == 2 and factor[0] == block:
+                vector = vector * factor[1]
+            elif len(factor) == 3 and block in factor[:2]:
+                u, v, matrix = factor
+                # orient as neighbor by block
+                neighbor, matrix = (u, matrix) if v == block else (v, matrix.T.tocsr())
+                if neighbor in neighbor_to_matrix:
+                    matrix = neighbor_to_matrix[neighbor].multiply(matrix).tocsr()
+                neighbor_to_matrix[neighbor] = matrix
+            else:
+                remaining.append(factor)
+
+        neighbors = neighbor_to_matrix.keys()
+        if len(neighbors) == 1:
+            neighbor, = neighbors
+            reduced = neighbor_to_matrix[neighbor].dot(vector)
+            remaining.append((neighbor, numpy.asarray(reduced).ravel()))
+        elif len(neighbors) == 2:
+            u, v = neighbors
+            scale = scipy.sparse.diags(vector)
+            reduced = neighbor_to_matrix[u].dot(scale).dot(neighbor_to_matrix[v].T)
+            remaining.append((u, v, reduced.tocsr()))
+        else:
+            assert False, 'eliminating a node position with {} neighbors'.format(len(neighbors))
+        return remaining
+
+    def combine(self, source_block, target_block, factors, block_to_metanode):
+        """Combine factors on the source and target blocks into a matrix."""
+        n_source = len(self.get_nodes(block_to_metanode[source_block]))
+        n_target = len(self.get_nodes(block_to_metanode[target_block]))
+        if source_block == target_block:
+            vector = numpy.ones(n_source)
+            for factor in factors:
+                if len(factor) == 2:
+                    vector = vector * factor[1]
+                else:
+                    vector = vector * factor[2].diagonal()
+            return scipy.sparse.diags(vector).tocsr()
+
+        matrix = None
+        source_vector = numpy.ones(n_source)
+        target_vector = numpy.ones(n_target)
+        for factor in factors:
+            if len(factor) == 2:
+                if factor[0] == source_block:
+                    source_vector = source_vector * factor[1]
+                else:
+                    target_vector = target_vector * factor[1]
+                continue
+            u, v, factor_matrix = factor
+            if u != source_block:
+                factor_matrix = factor_matrix.T.tocsr()
+            matrix = factor_matrix if matrix is None else matrix.multiply(factor_matrix).tocsr()
+        source_scale = scipy.sparse.diags(source_vector)
+        target_scale = scipy.sparse.diags(target_vector)
+        return source_scale.dot(matrix).dot(target_scale).tocsr()
+
+    def dwpc(self, source, target, metapath, duplicates=False):
+        """Return the DWPC between source and target for metapath."""
+        dwpc_matrix = self.dwpc_matrix(metapath, duplicates)
+        i = self.get_index(metapath.source())[source]
+        j = self.get_index(metapath.target())[target]
+        undefined = self.undefined_matrix(metapath, duplicates)
+        if undefined is not None and undefined[i, j] > 0.5:
+            raise ZeroDivisionError('path through an edge with a zero degree')
+        return dwpc_matrix[i, j]
@@ -4,20 +4,10 @@ import collections
 import itertools
 import random
 import operator
-import gc
 import os
 
 import hetnet
-
-
-cache_gets = 0
-cache_sets = 0
-i_memcheck = 0
-max_MB = 60 * 1024
-prune_fraction = 0.2
-memcheck_interval = 1000
-cache = collections.OrderedDict()
-
+import hetnet.graph
 
 
 # Set memory_usage to a function that returns memory usage in MB.
@@ -50,70 +40,131 @@ except ImportError:
     memory_usage = memory_usage_ps
 
 
-def cache_get(key):
-    global cache_gets
-    cache_gets += 1
-    value = cache.pop(key)
-    cache[key] = value
-    return value
-
-def cache_set(key, value):
-    cache[key] = value
-    global cache_sets
-    global i_memcheck
-    cache_sets += 1
-    if i_memcheck < memcheck_interval:
-        i_memcheck += 1
-        return
-    i_memcheck = 0
-    if memory_usage() > max_MB:
-        n_remove = int(len(cache) * prune_fraction)
-        remove_keys = tuple(itertools.islice(cache.iterkeys(), n_remove))
-        for key in remove_keys:
-            del cache[key]
-        gc.collect()
-        memory = memory_usage()
-        hitrate = cache_hit_rate()
-        print_str = 'Deleted {} cached items. Using {:.1f}GB for {:.2f} item cache. Hitrate {:.5f}'
-        print(print_str.format(n_remove, memory / 1024.0, len(cache), hitrate))
-
-
-def cache_hit_rate():
-    """
-    Returns the cache hit rate, which is the percent of lookups
-    that succeed (where the result is cached).
-    """
-    return float(cache_gets) / (cache_sets + cache_gets)
+class PathCache(object):
 
+    # bytes per tuple header and per tuple slot, used to estimate entry cost
+    tuple_bytes = sys.getsizeof(tuple())
+    pointer_bytes = sys.getsizeof((None, )) - tuple_bytes
 
-def crdfs_paths_from(node, metapath):
+    def __init__(self, max_bytes=4 * 2 ** 30):
+        """
+        Least recently used cache of paths keyed by (node, metapath) with a
+        budget of max_bytes. Entry cost is estimated from the number and
+        length of the cached paths rather than measured from process memory,
+        so the footprint of each cache is predictable regardless of how many
+        caches or graphs share the process. Edges are owned by the graph and
+        are not counted.
+        """
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.entry_to_bytes = dict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def estimate_bytes(self, paths):
+        """Return the estimated size of a tuple of tuple paths."""
+        n_bytes = self.tuple_bytes + self.pointer_bytes * len(paths)
+        for path in paths:
+            n_bytes += self.tuple_bytes + self.pointer_bytes * len(path)
+        return n_bytes
+
+    def get(self, key):
+        """Return the paths cached for key or None, counting a hit or miss."""
+        paths = self.entries.pop(key, None)
+        if paths is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = paths
+        return paths
+
+    def set(self, key, paths):
+        """
+        Cache paths for key, evicting least recently used entries to stay
+        within max_bytes. Entries larger than max_bytes are not cached.
+        """
+        if key in self.entries:
+            self.remove(key)
+        n_bytes = self.estimate_bytes(paths)
+        if n_bytes > self.max_bytes:
+            return
+        while self.n_bytes + n_bytes > self.max_bytes:
+            lru_key = next(self.entries.iterkeys())
+            self.remove(lru_key)
+            self.evictions += 1
+        self.entries[key] = paths
+        self.entry_to_bytes[key] = n_bytes
+        self.n_bytes += n_bytes
+
+    def remove(self, key):
+        del self.entries[key]
+        self.n_bytes -= self.entry_to_bytes.pop(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.entry_to_bytes.clear()
+        self.n_bytes = 0
+
+    def hit_rate(self):
+        """
+        Returns the cache hit rate, which is the fraction of lookups
+        that succeed (where the result is cached).
+        """
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else None
+
+    def get_stats(self):
+        stats = collections.OrderedDict()
+        stats['entries'] = len(self)
+        stats['bytes'] = self.n_bytes
+        stats['max_bytes'] = self.max_bytes
+        stats['hits'] = self.hits
+        stats['misses'] = self.misses
+        stats['evictions'] = self.evictions
+        stats['hit_rate'] = self.hit_rate()
+        return stats
+
+
+def crdfs_paths_from(node, metapath, cache=None):
     """
     Cached recursive depth-first-search: computes all paths from
     source_node of kind metapath. Paths with duplicate nodes are excluded.
     Returns a tuple of tuple paths where the elements of the tuple path are
-    hetnet.Edge() objects. Refer to the cache_get and cache_set functions for
-    the specifics of the caching algorithm.
+    hetnet.Edge() objects. Results are stored in cache, a PathCache. Without
+    one, a cache is made for this call only and freed on return, so callers
+    reusing paths across calls must pass their own.
     """
     if not metapath:
         return tuple(),
+    if cache is None:
+        cache = PathCache()
     args = node, metapath
-    if args in cache:
-        return cache_get(args)
+    paths = cache.get(args)
+    if paths is not None:
+        return paths
     paths = list()
     metapath_tail = metapath.sub
     for edge in node.edges[metapath[0]]:
-        for tail in crdfs_paths_from(edge.target, metapath_tail):
+        for tail in crdfs_paths_from(edge.target, metapath_tail, cache):
             if node in (e.target for e in tail):
                 continue
             paths.append((edge, ) + tail)
     paths = tuple(paths)
-    cache_set(args, paths)
+    cache.set(args, paths)
     return paths
 
 def filtered_crdfs_paths_from(node, metapath, exclude_masked=False,
-                              exclude_nodes=set(), exclude_edges=set()):
+                              exclude_nodes=set(), exclude_edges=set(), cache=None):
     paths = list()
-    for edge_list in crdfs_paths_from(node, metapath):
+    for edge_list in crdfs_paths_from(node, metapath, cache):
         if exclude_edges and exclude_edges & set(edge_list):
             continue
         path = hetnet.Path(edge_list)
@@ -124,7 +175,7 @@ def filtered_crdfs_paths_from(node, metapath, exclude_masked=False,
         paths.append(path)
     return tuple(paths)
 
-def crdfs_paths_fromto(source_node, target_node, metapath, exclude_nodes=set(), exclude_edges=set()):
+def crdfs_paths_fromto(source_node, target_node, metapath, exclude_nodes=set(), exclude_edges=set(), cache=None):
     """
     Cached recursive depth-first-search: computes all paths from
     source_node to target_node of kind metapath. Paths with duplicate
@@ -132,7 +183,7 @@ def crdfs_paths_fromto(source_node, target_node, metapath, exclude_nodes=set(),
     Returns of tuple of hetnet.Path() objects.
     """
     paths = list()
-    for edge_list in crdfs_paths_from(source_node, metapath):
+    for edge_list in crdfs_paths_from(source_node, metapath, cache):
         if edge_list[-1].target != target_node:
             continue
         if exclude_edges and exclude_edges & set(edge_list):
@@ -190,7 +241,7 @@ def rdfs_paths_fromto(source_node, target_node, metapath, exclude_masked=False,
     return tuple(paths)
 
 def path_based_features(source_node, target_node, metapath, exclude_masked=False,
-                        exclude_nodes=set(), exclude_edges=set()):
+                        exclude_nodes=set(), exclude_edges=set(), cache=None):
     """
     Return a dictionary where items store:
     -- paths between the source and target node
@@ -198,23 +249,26 @@ def path_based_features(source_node, target_node, metapath, exclude_masked=False
     -- paths from the target
     where paths follow the provided metapath.
     """
-    paths_s = filtered_crdfs_paths_from(source_node, metapath, exclude_masked, exclude_nodes, exclude_edges)
-    paths_t = filtered_crdfs_paths_from(target_node, metapath.inverse, exclude_masked, exclude_nodes, exclude_edges)
+    paths_s = filtered_crdfs_paths_from(source_node, metapath, exclude_masked, exclude_nodes, exclude_edges, cache)
+    paths_t = filtered_crdfs_paths_from(target_node, metapath.inverse, exclude_masked, exclude_nodes, exclude_edges, cache)
     paths_st = tuple(path for path in paths_s if path[-1].target == target_node)
     return {'source_target': paths_st, 'from_source': paths_s, 'from_target': paths_t}
 
 
-def path_degree_product(path, damping_exponent, exclude_edges=set(), exclude_masked=True):
-    """ """
+def path_degree_product(path, damping_exponent, exclude_edges=set(), exclude_masked=True,
+                        exclusion_counts=None):
+    """
+    Degrees are read from the graph's degree index. exclusion_counts, as
+    returned by hetnet.graph.DegreeIndex.exclusion_counts(exclude_edges,
+    exclude_masked), may be passed to avoid recomputing it for every path.
+    """
+    if exclusion_counts is None:
+        exclusion_counts = hetnet.graph.DegreeIndex.exclusion_counts(exclude_edges, exclude_masked)
     degrees = list()
     for edge in path:
-        source_edges = edge.source.get_edges(edge.metaedge, exclude_masked)
-        target_edges = edge.target.get_edges(edge.metaedge.inverse, exclude_masked)
-        if exclude_edges:
-            source_edges -= exclude_edges
-            target_edges -= exclude_edges
-        source_degree = len(source_edges)
-        target_degree = len(target_edges)
+        metaedge = edge.metaedge
+        source_degree = edge.source.get_degree(metaedge, exclude_masked, exclusion_counts)
+        target_degree = edge.target.get_degree(metaedge.inverse, exclude_masked, exclusion_counts)
         degrees.append(source_degree)
         degrees.append(target_degree)
 
@@ -224,7 +278,8 @@ def path_degree_product(path, damping_exponent, exclude_edges=set(), exclude_mas
 
 
 def degree_weighted_path_count(paths, damping_exponent, exclude_edges=set(), exclude_masked=True):
-    degree_products = (path_degree_product(path, damping_exponent, exclude_edges=exclude_edges, exclude_masked=exclude_masked) for path in paths)
+    exclusion_counts = hetnet.graph.DegreeIndex.exclusion_counts(exclude_edges, exclude_masked)
+    degree_products = (path_degree_product(path, damping_exponent, exclusion_counts=exclusion_counts, exclude_masked=exclude_masked) for path in paths)
     path_weights = (1.0 / degree_product for degree_product in degree_products)
     dwpc = sum(path_weights)
     return dwpc
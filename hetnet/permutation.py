@@ -1,11 +1,18 @@
+import collections
+import multiprocessing
+import os
 import random
+import shutil
 
 import hetnet.graph
+import hetnet.readwrite.graph
 
-def permute_graph(graph, multiplier=10, seed=0, metaedge_to_excluded=dict(), verbose=False):
+def permute_graph(graph, multiplier=10, seed=0, metaedge_to_excluded=dict(), verbose=False,
+                  adaptive=False, tolerance=0.01):
     """
     Shuffle edges within metaedge category. Preserves node degree but randomizes
-    edges.
+    edges. Returns the permuted graph and a list with the permute_pair_list
+    statistics of each metaedge.
     """
 
     if verbose: print 'Creating permuted graph template'
@@ -17,118 +24,274 @@ def permute_graph(graph, multiplier=10, seed=0, metaedge_to_excluded=dict(), ver
     metaedge_to_edges = graph.get_metaedge_to_edges(exclude_inverts=True)
 
     if verbose: print 'Adding permuted edges'
+    all_stats = list()
     for metaedge, edges in metaedge_to_edges.items():
         if verbose: print metaedge
 
         excluded_pair_set = metaedge_to_excluded.get(metaedge, set())
         pair_list = [(edge.source.id_, edge.target.id_) for edge in edges]
         directed = metaedge.direction != 'both'
-        permuted_pair_list = permute_pair_list(
+        permuted_pair_list, stats = permute_pair_list(
             pair_list, directed=directed, multiplier=multiplier,
-            excluded_pair_set=excluded_pair_set, seed=seed, verbose=verbose)
+            excluded_pair_set=excluded_pair_set, seed=seed, verbose=verbose,
+            adaptive=adaptive, tolerance=tolerance)
+        stats['metaedge'] = str(metaedge)
+        all_stats.append(stats)
 
         kind = metaedge.kind
         direction = metaedge.direction
         for pair in permuted_pair_list:
             permuted_graph.add_edge(pair[0], pair[1], kind, direction)
 
-    return permuted_graph
+    return permuted_graph, all_stats
 
 
-def permute_pair_list(pair_list, directed=False, multiplier=10, excluded_pair_set=set(), seed=0, verbose=False):
+# Input shared with forked workers by permute_graphs. Set before the pool is
+# created so that workers inherit it copy-on-write.
+shared_permutation_input = None
+
+def permute_graphs(graph, directories, seeds=None, multiplier=10, metaedge_to_excluded=dict(),
+                   processes=None, verbose=False, adaptive=False, tolerance=0.01):
+    """
+    Write an independent permutation of graph to each of directories using a
+    process pool. Permutation i uses seeds[i] (default i). Permuted graphs
+    are written in the columnar format of hetnet.readwrite.graph, so no
+    permuted Graph is materialised. The node table and the integer pair
+    lists of graph are built once and shared with the forked workers. The
+    node table is written once and hard linked (or copied) into each
+    directory. Returns a list with the per-metaedge statistics of each
+    permutation, as returned by permute_graph.
+    """
+    global shared_permutation_input
+    if seeds is None:
+        seeds = range(len(directories))
+    assert len(seeds) == len(directories)
+
+    if verbose: print 'Building node table and pair lists'
+    node_ids, node_kinds, node_data = hetnet.readwrite.graph.columnar_node_table(graph)
+    id_to_int = {id_: i for i, id_ in enumerate(node_ids)}
+    metaedges = list(graph.metagraph.get_edges(exclude_inverts=True))
+    metaedge_to_pairs = {metaedge: list() for metaedge in metaedges}
+    for edge in graph.get_edges(exclude_inverts=True):
+        pair = id_to_int[edge.source.id_], id_to_int[edge.target.id_]
+        metaedge_to_pairs[edge.metaedge].append(pair)
+    metaedge_to_excluded_pairs = dict()
+    for metaedge, excluded_pair_set in metaedge_to_excluded.items():
+        metaedge_to_excluded_pairs[metaedge] = {
+            (id_to_int[source], id_to_int[target]) for source, target in excluded_pair_set
+            if source in id_to_int and target in id_to_int}
+
+    nodes_path = None
+    for directory in directories:
+        if nodes_path is None:
+            hetnet.readwrite.graph.write_columnar_nodes(directory, node_ids, node_kinds, node_data)
+            nodes_path = os.path.join(directory, 'nodes.json.gz')
+            continue
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        path = os.path.join(directory, 'nodes.json.gz')
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            os.link(nodes_path, path)
+        except OSError:
+            shutil.copyfile(nodes_path, path)
+
+    shared_permutation_input = (metaedges, metaedge_to_pairs, metaedge_to_excluded_pairs,
+                                len(node_ids), multiplier, verbose, adaptive, tolerance)
+    pool = multiprocessing.Pool(processes)
+    directory_to_stats = dict()
+    for directory, all_stats in pool.imap_unordered(permute_columnar, zip(directories, seeds)):
+        if verbose: print 'Wrote permuted graph to {}'.format(directory)
+        directory_to_stats[directory] = all_stats
+    pool.close()
+    pool.join()
+    shared_permutation_input = None
+    return [directory_to_stats[directory] for directory in directories]
+
+def permute_columnar(task):
+    """
+    Write the edges of one permutation of shared_permutation_input. Returns
+    the directory and the per-metaedge statistics.
+    """
+    directory, seed = task
+    (metaedges, metaedge_to_pairs, metaedge_to_excluded_pairs, n_nodes,
+     multiplier, verbose, adaptive, tolerance) = shared_permutation_input
+    metaedge_to_permuted = dict()
+    all_stats = list()
+    for metaedge in metaedges:
+        if verbose: print metaedge
+        directed = metaedge.direction != 'both'
+        metaedge_to_permuted[metaedge], stats = permute_pair_list(
+            metaedge_to_pairs[metaedge], directed=directed, multiplier=multiplier,
+            excluded_pair_set=metaedge_to_excluded_pairs.get(metaedge, set()),
+            seed=seed, verbose=verbose, adaptive=adaptive, tolerance=tolerance)
+        stats['metaedge'] = str(metaedge)
+        all_stats.append(stats)
+    hetnet.readwrite.graph.write_columnar_edges(directory, metaedges, metaedge_to_permuted, n_nodes)
+    return directory, all_stats
+
+def expected_unchanged(pair_list):
+    """
+    Return the expected fraction of pairs in pair_list that are present after
+    complete randomization preserving source and target degrees, which is
+    the sum of source_degree * target_degree / n_edges ** 2 over pairs.
+    """
+    edge_number = len(pair_list)
+    if not edge_number:
+        return None
+    source_degrees = collections.Counter(pair[0] for pair in pair_list)
+    target_degrees = collections.Counter(pair[1] for pair in pair_list)
+    total = sum(source_degrees[source] * target_degrees[target] for source, target in pair_list)
+    return float(total) / edge_number ** 2
+
+def permute_pair_list(pair_list, directed=False, multiplier=10, excluded_pair_set=set(), seed=0,
+                      verbose=False, adaptive=False, tolerance=0.01):
     """
     If n_perm is not specific, perform 10 times the number of edges of permutations
     May not work for directed edges
+
+    Nodes are encoded as integers and edges are kept as parallel source and
+    target lists, so each swap exchanges two targets in place. Pairs are
+    hashed as the integer source * n_nodes + target. Returns a new list of
+    pairs, leaving pair_list unmodified, and a dictionary of convergence
+    statistics.
+
+    The statistics trace records, at checkpoints every min(n_perm / 10,
+    n_edges) attempts, the attempts since the last checkpoint by outcome and
+    the fraction of original pairs unchanged. When adaptive, permutation
+    stops at the first checkpoint where the unchanged fraction is within
+    tolerance of expected_unchanged, so multiplier acts as a cap.
     """
     random.seed(seed)
 
-    pair_set = set(pair_list)
+    node_ids = sorted({node for pair in pair_list for node in pair})
+    id_to_int = {node: i for i, node in enumerate(node_ids)}
+    n_nodes = len(node_ids)
+    sources = [id_to_int[pair[0]] for pair in pair_list]
+    targets = [id_to_int[pair[1]] for pair in pair_list]
+
+    pair_set = {source * n_nodes + target for source, target in zip(sources, targets)}
     assert len(pair_set) == len(pair_list)
+    excluded_codes = {id_to_int[pair[0]] * n_nodes + id_to_int[pair[1]]
+                      for pair in excluded_pair_set
+                      if pair[0] in id_to_int and pair[1] in id_to_int}
+    orig_pair_set = pair_set.copy()
 
     edge_number = len(pair_list)
     n_perm = int(edge_number * multiplier)
+    checkpoint_interval = max(min(n_perm / 10, edge_number), 1)
+    unchanged_floor = expected_unchanged(pair_list)
 
     count_same_edge = 0
     count_self_loop = 0
     count_duplicate = 0
     count_undir_dup = 0
     count_excluded = 0
+    count_accepted = 0
+
+    stats = collections.OrderedDict()
+    stats['edges'] = edge_number
+    stats['seed'] = seed
+    stats['directed'] = directed
+    stats['multiplier'] = multiplier
+    stats['max_attempts'] = n_perm
+    stats['excluded_pairs'] = len(excluded_pair_set)
+    stats['adaptive'] = adaptive
+    stats['tolerance'] = tolerance
+    stats['expected_unchanged'] = unchanged_floor
+    trace = list()
 
     if verbose:
-        orig_pair_set = pair_set.copy()
         print '{} edges, {} permutations (seed = {}, directed = {}, {} excluded_edges)'.format(
             edge_number, n_perm, seed, directed, len(excluded_pair_set))
-        print_at = range(0, n_perm, n_perm / 10) + [n_perm - 1]
 
+    randrange = random.randrange
+    attempts = 0
+    previous_checkpoint = 0
     for i in xrange(n_perm):
 
         # Same two random edges
-        i_0 = random.randrange(edge_number)
-        i_1 = random.randrange(edge_number)
+        i_0 = randrange(edge_number)
+        i_1 = randrange(edge_number)
 
         # Same edge selected twice
         if i_0 == i_1:
             count_same_edge += 1
-            continue
-        pair_0 = pair_list.pop(i_0)
-        pair_1 = pair_list.pop(i_1 - 1 if i_0 < i_1 else i_1)
-
-        new_pair_0 = pair_0[0], pair_1[1]
-        new_pair_1 = pair_1[0], pair_0[1]
-
-        valid = False
-        for pair in new_pair_0, new_pair_1:
-            if pair[0] == pair[1]:
-                count_self_loop += 1
-                break  # edge is a self-loop
-            if pair in pair_set:
-                count_duplicate += 1
-                break  # edge is a duplicate
-            if not directed and (pair[1], pair[0]) in pair_set:
-                count_undir_dup += 1
-                break  # edge is a duplicate
-            if pair in excluded_pair_set:
-                count_excluded += 1
-                break  # edge is excluded
         else:
-            # edge passed all validity conditions
-            valid = True
+            source_0, target_0 = sources[i_0], targets[i_0]
+            source_1, target_1 = sources[i_1], targets[i_1]
 
-        # If new edges are invalid
-        if not valid:
-            for pair in pair_0, pair_1:
-                pair_list.append(pair)
+            # new pairs are (source_0, target_1) and (source_1, target_0)
+            for source, target in (source_0, target_1), (source_1, target_0):
+                if source == target:
+                    count_self_loop += 1
+                    break  # edge is a self-loop
+                if source * n_nodes + target in pair_set:
+                    count_duplicate += 1
+                    break  # edge is a duplicate
+                if not directed and target * n_nodes + source in pair_set:
+                    count_undir_dup += 1
+                    break  # edge is a duplicate
+                if source * n_nodes + target in excluded_codes:
+                    count_excluded += 1
+                    break  # edge is excluded
+            else:
+                # edge passed all validity conditions
+                pair_set.remove(source_0 * n_nodes + target_0)
+                pair_set.remove(source_1 * n_nodes + target_1)
+                pair_set.add(source_0 * n_nodes + target_1)
+                pair_set.add(source_1 * n_nodes + target_0)
+                targets[i_0] = target_1
+                targets[i_1] = target_0
+                count_accepted += 1
 
-        # If new edges are valid
-        else:
-            for pair in pair_0, pair_1:
-                pair_set.remove(pair)
-            for pair in new_pair_0, new_pair_1:
-                pair_set.add(pair)
-                pair_list.append(pair)
-
-        # print updates
-        if verbose and i in print_at:
-            percent_done = 100.0 * float(i) / n_perm
-            percent_same = 100.0 * float(len(orig_pair_set & pair_set)) / len(pair_set)
-            print '{:.1f}% complete: {:.1f}% unchanged'.format(percent_done, percent_same)
+        attempts = i + 1
+        if attempts % checkpoint_interval and attempts != n_perm:
+            continue
+
+        # record checkpoint
+        checkpoint = collections.OrderedDict()
+        checkpoint['attempts'] = attempts
+        checkpoint['interval_attempts'] = attempts - previous_checkpoint
+        checkpoint['accepted'] = count_accepted
+        checkpoint['same_edge'] = count_same_edge
+        checkpoint['self_loop'] = count_self_loop
+        checkpoint['duplicate'] = count_duplicate
+        checkpoint['undirected_duplicate'] = count_undir_dup
+        checkpoint['excluded'] = count_excluded
+        checkpoint['unchanged'] = float(len(orig_pair_set & pair_set)) / edge_number
+        trace.append(checkpoint)
+        previous_checkpoint = attempts
+
+        if verbose:
+            percent_done = 100.0 * attempts / n_perm
+            print '{:.1f}% complete: {:.1f}% unchanged'.format(percent_done, 100.0 * checkpoint['unchanged'])
             counts = [count_same_edge, count_self_loop, count_duplicate,
                       count_undir_dup, count_excluded]
-            index = print_at.index(i)
-            iterations = i if index == 0 else print_at[index] - print_at[index - 1]
-            if iterations:
-                percents = [100.0 * count / float(iterations) for count in counts]
-                count_str = 'Counts last {} iterations: same_edge {:.1f}%; self_loop {:.1f}%; ' \
-                            'duplicate {:.1f}%; undirected_duplicate {:.1f}%; excluded {:.1f}%'
-                print count_str.format(iterations, *percents)
-            count_same_edge = 0
-            count_self_loop = 0
-            count_duplicate = 0
-            count_undir_dup = 0
-            count_excluded = 0
-
-    assert len(pair_set) == edge_number
-    return pair_list
+            iterations = checkpoint['interval_attempts']
+            percents = [100.0 * count / float(iterations) for count in counts]
+            count_str = 'Counts last {} iterations: same_edge {:.1f}%; self_loop {:.1f}%; ' \
+                        'duplicate {:.1f}%; undirected_duplicate {:.1f}%; excluded {:.1f}%'
+            print count_str.format(iterations, *percents)
+        count_same_edge = 0
+        count_self_loop = 0
+        count_duplicate = 0
+        count_undir_dup = 0
+        count_excluded = 0
+        count_accepted = 0
 
+        if adaptive and checkpoint['unchanged'] <= unchanged_floor + tolerance:
+            if verbose: print 'Stopping at expected unchanged floor of {:.1f}%'.format(100.0 * unchanged_floor)
+            break
 
+    stats['attempts'] = attempts
+    stats['stopped_early'] = attempts < n_perm
+    for key in 'accepted', 'same_edge', 'self_loop', 'duplicate', 'undirected_duplicate', 'excluded':
+        stats[key] = sum(checkpoint[key] for checkpoint in trace)
+    stats['unchanged'] = trace[-1]['unchanged'] if trace else None
+    stats['trace'] = trace
 
+    assert len(pair_set) == edge_number
+    permuted_pair_list = [(node_ids[source], node_ids[target]) for source, target in zip(sources, targets)]
+    return permuted_pair_list, stats
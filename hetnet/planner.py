@@ -0,0 +1,137 @@
+import collections
+import csv
+
+import numpy
+
+
+class MetapathPlanner(object):
+
+    def __init__(self, graph, exclude_masked=True):
+        """
+        Estimates path counts and traversal costs of metapaths before
+        computing features, from per-metaedge degree distributions. A walk
+        entering a node through one metaedge reaches nodes in proportion to
+        their degree for that metaedge, so the expected number of ways to
+        continue is the size-biased mean sum(d_in * d_out) / sum(d_in) rather
+        than the mean out degree. Walks from source to target are estimated
+        as the degree of the source, times the size-biased degrees of the
+        interior positions, times the share of edges of the final metaedge
+        that end on target. Duplicate nodes are not accounted for, so path
+        counts are slightly overestimated.
+        """
+        self.graph = graph
+        self.exclude_masked = exclude_masked
+        self.metaedge_to_degrees = dict()
+        self.continuation_cache = dict()
+
+    def get_degrees(self, metaedge):
+        """Return the array of degrees for metaedge by node.index."""
+        if metaedge not in self.metaedge_to_degrees:
+            self.metaedge_to_degrees[metaedge] = self.graph.degree_array(metaedge, self.exclude_masked)
+        return self.metaedge_to_degrees[metaedge]
+
+    def continuation(self, in_metaedge, out_metaedge):
+        """
+        Return the expected out degree for out_metaedge of a node reached by
+        following an in_metaedge edge.
+        """
+        key = in_metaedge, out_metaedge
+        if key not in self.continuation_cache:
+            d_in = self.get_degrees(in_metaedge.inverse).astype(numpy.float64)
+            d_out = self.get_degrees(out_metaedge).astype(numpy.float64)
+            total = d_in.sum()
+            self.continuation_cache[key] = (d_in * d_out).sum() / total if total else 0.0
+        return self.continuation_cache[key]
+
+    def metapath_factors(self, metapath):
+        """Return the size-biased continuations at the interior positions."""
+        return [self.continuation(metapath[i - 1], metapath[i]) for i in range(1, len(metapath))]
+
+    def mean_walks(self, metapath):
+        """Return the expected number of walks from a source node."""
+        degrees = self.get_degrees(metapath[0])
+        n_sources = self.graph.metanode_count(metapath.source())
+        if not n_sources:
+            return 0.0
+        walks = float(degrees.sum()) / n_sources
+        for factor in self.metapath_factors(metapath):
+            walks *= factor
+        return walks
+
+    def pair_walks(self, source, target, metapath):
+        """Return the expected number of walks from source to target."""
+        last = metapath[-1]
+        n_last = float(self.get_degrees(last).sum())
+        if not n_last:
+            return 0.0
+        walks = self.get_degrees(metapath[0])[source.index]
+        for factor in self.metapath_factors(metapath):
+            walks *= factor
+        return walks * self.get_degrees(last.inverse)[target.index] / n_last
+
+    def plan(self, metapaths, pairs, approximate_threshold=100000, drop_threshold=None):
+        """
+        Return a list with an OrderedDict per metapath summarising estimates
+        over pairs, a list of (source, target) nodes such as the rows of a
+        partition file. cost is the traversal cost of the cheapest split as
+        estimated by Graph.plan_split. action is 'drop' when the mean pair
+        path estimate exceeds drop_threshold, 'approximate' when any pair
+        exceeds approximate_threshold and 'exact' otherwise.
+        """
+        masked = not self.exclude_masked
+        plan_rows = list()
+        for metapath in metapaths:
+            pair_paths = numpy.array([self.pair_walks(source, target, metapath)
+                                      for source, target in pairs], dtype=numpy.float64)
+            costs = numpy.array([min(self.graph.plan_split(source, target, metapath, masked)['costs'])
+                                 for source, target in pairs], dtype=numpy.float64)
+            mean_paths = pair_paths.mean() if len(pairs) else 0.0
+            max_paths = pair_paths.max() if len(pairs) else 0.0
+            if drop_threshold is not None and mean_paths > drop_threshold:
+                action = 'drop'
+            elif max_paths > approximate_threshold:
+                action = 'approximate'
+            else:
+                action = 'exact'
+            row = collections.OrderedDict()
+            row['metapath'] = str(metapath)
+            row['length'] = len(metapath)
+            row['source_walks'] = self.mean_walks(metapath)
+            row['mean_pair_paths'] = mean_paths
+            row['max_pair_paths'] = max_paths
+            row['total_paths'] = pair_paths.sum()
+            row['mean_pair_cost'] = costs.mean() if len(pairs) else 0.0
+            row['total_cost'] = costs.sum()
+            row['action'] = action
+            plan_rows.append(row)
+        return plan_rows
+
+
+def record_actual(plan_rows, metapath_to_actual):
+    """
+    Add the actual cost of a run to plan_rows. metapath_to_actual maps
+    metapath strings to Counters of pairs, seconds and paths, as filled by
+    compute_features. Ratios of predicted to actual paths and of seconds to
+    predicted cost are added so the estimates can be checked.
+    """
+    for row in plan_rows:
+        actual = metapath_to_actual.get(row['metapath'], collections.Counter())
+        row['actual_pairs'] = actual['pairs']
+        row['actual_seconds'] = actual['seconds']
+        row['actual_paths'] = actual['paths'] if 'paths' in actual else None
+        row['paths_ratio'] = (row['total_paths'] / actual['paths']
+                              if actual.get('paths') else None)
+        row['seconds_per_cost'] = (actual['seconds'] / row['total_cost']
+                                   if row['total_cost'] else None)
+    return plan_rows
+
+
+def write_plan(plan_rows, path):
+    """Write plan_rows as a tab-separated table."""
+    with open(path, 'w') as plan_file:
+        if not plan_rows:
+            return
+        writer = csv.DictWriter(plan_file, fieldnames=plan_rows[0].keys(), delimiter='\t')
+        writer.writeheader()
+        for row in plan_rows:
+            writer.writerow(row)
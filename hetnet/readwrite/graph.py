@@ -6,9 +6,11 @@ import os
 import re
 import operator
 import csv
+import itertools
 import random
 import simplejson
 
+import numpy
 import yaml
 
 import hetnet
@@ -66,6 +68,213 @@ def write_yaml(graph, path):
     yaml.dump(writable, write_file, Dumper=dumper)
     write_file.close()
 
+def write_columnar(graph, directory, masked=True):
+    """
+    Write graph to directory in a columnar format. The directory contains
+    metagraph.json, a node table (nodes.json.gz) whose order defines node
+    integers, and for each non-inverted metaedge an int32 .npy array of
+    (source_int, target_int) rows. Edge data keys whose values are all
+    integers are stored as int64 .npy columns, keys whose values are numeric
+    as float64 .npy columns (NaN when missing), and other keys as json lists.
+    """
+    node_ids, node_kinds, node_data = columnar_node_table(graph, masked)
+    id_to_int = {id_: i for i, id_ in enumerate(node_ids)}
+
+    metaedges = list(graph.metagraph.get_edges(exclude_inverts=True))
+    metaedge_to_pairs = {metaedge: list() for metaedge in metaedges}
+    metaedge_to_data = {metaedge: list() for metaedge in metaedges}
+    for edge in graph.get_edges(exclude_inverts=True):
+        if not masked and edge.is_masked():
+            continue
+        if edge.source.id_ not in id_to_int or edge.target.id_ not in id_to_int:
+            continue
+        pair = id_to_int[edge.source.id_], id_to_int[edge.target.id_]
+        metaedge_to_pairs[edge.metaedge].append(pair)
+        metaedge_to_data[edge.metaedge].append(edge.data)
+
+    write_columnar_nodes(directory, node_ids, node_kinds, node_data)
+    write_columnar_edges(directory, metaedges, metaedge_to_pairs, len(node_ids), metaedge_to_data)
+
+def columnar_node_table(graph, masked=True):
+    """
+    Return (node_ids, node_kinds, node_data) lists for graph. Positions in
+    these lists are the node integers of the columnar format.
+    """
+    node_ids = list()
+    node_kinds = list()
+    node_data = list()
+    for node in graph.node_dict.itervalues():
+        if not masked and node.is_masked():
+            continue
+        node_ids.append(node.id_)
+        node_kinds.append(node.metanode.id_)
+        node_data.append(node.data)
+    return node_ids, node_kinds, node_data
+
+def write_columnar_nodes(directory, node_ids, node_kinds, node_data):
+    """Write the node table of a columnar graph directory."""
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+    nodes = collections.OrderedDict([('id_', node_ids), ('kind', node_kinds), ('data', node_data)])
+    with gzip.open(os.path.join(directory, 'nodes.json.gz'), 'w') as write_file:
+        json.dump(nodes, write_file)
+
+def write_columnar_edges(directory, metaedges, metaedge_to_pairs, n_nodes, metaedge_to_data=None):
+    """
+    Write the edges and metagraph.json of a columnar graph directory.
+    metaedges are the non-inverted metaedges of the metagraph.
+    metaedge_to_pairs maps each to a sequence of (source_int, target_int)
+    pairs and the optional metaedge_to_data to a list of aligned edge data
+    dictionaries.
+    """
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+    metaedge_infos = list()
+    for i, metaedge in enumerate(metaedges):
+        pairs = numpy.asarray(metaedge_to_pairs.get(metaedge, ()), dtype=numpy.int32).reshape(-1, 2)
+        prefix = 'metaedge-{}'.format(i)
+        numpy.save(os.path.join(directory, prefix + '.npy'), pairs)
+        edge_data = metaedge_to_data.get(metaedge, ()) if metaedge_to_data else ()
+        keys = sorted({key for data in edge_data for key in data})
+        attributes = collections.OrderedDict()
+        for key in keys:
+            values = [data.get(key) for data in edge_data]
+            present = [value for value in values if value is not None]
+            numeric = all(isinstance(value, (int, long, float)) and not isinstance(value, bool)
+                          for value in present)
+            integer = numeric and len(present) == len(values) and all(
+                isinstance(value, (int, long)) for value in present)
+            if integer:
+                column = numpy.array(values, dtype=numpy.int64)
+            elif numeric:
+                column = numpy.array([numpy.nan if value is None else value for value in values],
+                                     dtype=numpy.float64)
+            if numeric:
+                path = '{}.{}.npy'.format(prefix, len(attributes))
+                numpy.save(os.path.join(directory, path), column)
+            else:
+                path = '{}.{}.json'.format(prefix, len(attributes))
+                with open(os.path.join(directory, path), 'w') as write_file:
+                    json.dump(values, write_file)
+            attributes[key] = path
+        metaedge_info = collections.OrderedDict()
+        metaedge_info['id'] = metaedge.get_id()
+        metaedge_info['path'] = prefix + '.npy'
+        metaedge_info['n_edges'] = len(pairs)
+        metaedge_info['attributes'] = attributes
+        metaedge_infos.append(metaedge_info)
+
+    metagraph_info = collections.OrderedDict()
+    metagraph_info['metaedge_tuples'] = [metaedge.get_id() for metaedge in metaedges]
+    metagraph_info['n_nodes'] = n_nodes
+    metagraph_info['metaedges'] = metaedge_infos
+    with open(os.path.join(directory, 'metagraph.json'), 'w') as write_file:
+        json.dump(metagraph_info, write_file, indent=2)
+
+def read_columnar_edges(directory, metaedge_info, mmap=True):
+    """
+    Return (pairs, attributes) for a metaedge of a columnar graph directory,
+    where pairs is an n_edges by 2 array of node integers and attributes is
+    a dictionary of key to column (numpy array or list). Arrays are memory
+    mapped when mmap.
+    """
+    mmap_mode = 'r' if mmap else None
+    path = os.path.join(directory, metaedge_info['path'])
+    pairs = numpy.load(path, mmap_mode=mmap_mode)
+    if metaedge_info['n_edges'] == 0:
+        pairs = numpy.zeros((0, 2), dtype=numpy.int32)
+    attributes = dict()
+    for key, path in metaedge_info['attributes'].iteritems():
+        path = os.path.join(directory, path)
+        if path.endswith('.npy'):
+            attributes[key] = numpy.load(path, mmap_mode=mmap_mode)
+        else:
+            with open(path) as read_file:
+                attributes[key] = simplejson.load(read_file)
+    return pairs, attributes
+
+def columnar_edge_data(attributes, n_edges):
+    """Return a list of n_edges data dictionaries built from columns."""
+    edge_data = [dict() for i in xrange(n_edges)]
+    for key, column in attributes.iteritems():
+        if isinstance(column, numpy.ndarray):
+            if column.dtype.kind == 'i':
+                column = [int(value) for value in column]
+            else:
+                column = [None if numpy.isnan(value) else float(value) for value in column]
+        for data, value in itertools.izip(edge_data, column):
+            if value is not None:
+                data[key] = value
+    return edge_data
+
+def read_columnar(directory, metapaths=None, compact=False, mmap=True, node_template=None):
+    """
+    Read a graph written by write_columnar. When metapaths is specified,
+    only edges of metaedges in metapaths (or their inverses) are loaded,
+    although all nodes and the full metagraph are. When compact, a
+    hetnet.compact.CompactGraph is built directly from the edge arrays
+    rather than adding edges one by one to a hetnet.Graph.
+
+    node_template is an optional CompactGraph, such as another permutation
+    of the same network, with the same metagraph and node table as
+    directory. When given, a CompactGraph is returned that shares the
+    metagraph and node table of node_template rather than reading its own.
+    """
+    with open(os.path.join(directory, 'metagraph.json')) as read_file:
+        metagraph_info = simplejson.load(read_file)
+    metaedge_tuples = map(tuple, metagraph_info['metaedge_tuples'])
+    if node_template is not None:
+        metagraph = node_template.metagraph
+        assert set(metaedge_tuples) == {metaedge.get_id() for metaedge in
+                                        metagraph.get_edges(exclude_inverts=True)}
+        assert metagraph_info['n_nodes'] == len(node_template.node_ids)
+    else:
+        metagraph = hetnet.MetaGraph.from_edge_tuples(metaedge_tuples)
+
+    include_ids = None
+    if metapaths is not None:
+        include_ids = set()
+        for metapath in metapaths:
+            for metaedge in metapath:
+                if metaedge.inverted:
+                    metaedge = metaedge.inverse
+                include_ids.add(metaedge.get_id())
+
+    compact = compact or node_template is not None
+    if compact:
+        # imported here since hetnet.graph imports this module
+        from hetnet.compact import CompactGraph
+        graph = CompactGraph(metagraph)
+    else:
+        graph = hetnet.Graph(metagraph)
+
+    if node_template is not None:
+        graph.share_node_table(node_template)
+        node_ids = graph.node_ids
+    else:
+        with gzip.open(os.path.join(directory, 'nodes.json.gz')) as read_file:
+            nodes = simplejson.load(read_file)
+        node_ids = nodes['id_']
+        for id_, kind, data in itertools.izip(node_ids, nodes['kind'], nodes['data']):
+            graph.add_node(id_, kind, data)
+
+    for metaedge_info in metagraph_info['metaedges']:
+        metaedge_id = tuple(metaedge_info['id'])
+        if include_ids is not None and metaedge_id not in include_ids:
+            continue
+        pairs, attributes = read_columnar_edges(directory, metaedge_info, mmap)
+        edge_data = columnar_edge_data(attributes, len(pairs)) if attributes else None
+        if compact:
+            metaedge = metagraph.edge_dict[metaedge_id]
+            graph.set_pairs(metaedge, pairs[:, 0], pairs[:, 1], edge_data)
+            continue
+        source_kind, target_kind, kind, direction = metaedge_id
+        for i, (source, target) in enumerate(pairs):
+            data = edge_data[i] if edge_data is not None else dict()
+            graph.add_edge(node_ids[source], node_ids[target], kind, direction, data)
+
+    return graph
+
 def graph_from_writable(writable):
     """ """
     metaedge_tuples = writable['metaedge_tuples']
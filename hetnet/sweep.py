@@ -0,0 +1,109 @@
+import numpy
+
+
+class ThresholdSweep(object):
+
+    def __init__(self, graph, sweeps, damping_exponent, exclude_masked=True):
+        """
+        Computes DWPCs at every threshold of one or more edge attributes from
+        a single enumeration of paths. sweeps is a list of (key, metaedges,
+        thresholds). At threshold t, edges of metaedges (and their inverses)
+        whose data[key] < t are removed, which lowers node degrees, as when
+        such edges are masked before computing the DWPC.
+
+        Each path survives the thresholds at or below the minimum of key
+        along its edges. Because degrees change with the threshold, each
+        path contributes a vector of weights over the thresholds of each
+        sweep rather than a single weight. Degrees at every threshold are
+        found by searchsorted over the sorted attributes of a node's edges.
+        """
+        self.graph = graph
+        self.damping_exponent = damping_exponent
+        self.exclude_masked = exclude_masked
+        self.sweeps = list()
+        self.metaedge_to_sweep = dict()
+        for i, (key, metaedges, thresholds) in enumerate(sweeps):
+            thresholds = numpy.asarray(thresholds, dtype=numpy.float64)
+            self.sweeps.append((key, thresholds))
+            for metaedge in metaedges:
+                self.metaedge_to_sweep[metaedge] = i
+                self.metaedge_to_sweep[metaedge.inverse] = i
+        self.degree_cache = dict()
+
+    def metapath_sweeps(self, metapath):
+        """Return the sorted indexes of sweeps applying to metapath."""
+        return sorted({self.metaedge_to_sweep[metaedge] for metaedge in metapath
+                       if metaedge in self.metaedge_to_sweep})
+
+    def get_degrees(self, node, metaedge):
+        """
+        Return the degree of node for metaedge as an int when metaedge is not
+        swept, or an array of the degree at each threshold of its sweep.
+        """
+        cache_key = node, metaedge
+        if cache_key in self.degree_cache:
+            return self.degree_cache[cache_key]
+        sweep = self.metaedge_to_sweep.get(metaedge)
+        if sweep is None:
+            degrees = node.get_degree(metaedge, self.exclude_masked)
+        else:
+            key, thresholds = self.sweeps[sweep]
+            edges = node.get_edges(metaedge, self.exclude_masked)
+            values = numpy.sort(numpy.array([edge.data[key] for edge in edges], dtype=numpy.float64))
+            degrees = len(values) - numpy.searchsorted(values, thresholds, side='left')
+        self.degree_cache[cache_key] = degrees
+        return degrees
+
+    def edge_passes(self, edge, sweep):
+        """Return a boolean array of whether edge is kept at each threshold."""
+        key, thresholds = self.sweeps[sweep]
+        return edge.data[key] >= thresholds
+
+    def dwpc(self, source, target, metapath, exclude_edges=set()):
+        """
+        Return an array of the DWPC between source and target for metapath at
+        every combination of thresholds of the sweeps applying to metapath,
+        with one axis per sweep in the order of metapath_sweeps. Masked
+        elements are not traversed. Paths have no duplicate nodes and
+        exclude_edges are excluded from paths and degrees.
+        """
+        damping_exponent = self.damping_exponent
+        sweeps = self.metapath_sweeps(metapath)
+        sweep_to_axis = {sweep: axis for axis, sweep in enumerate(sweeps)}
+        shape = tuple(len(self.sweeps[sweep][1]) for sweep in sweeps)
+
+        # decrements of degrees by excluded edges, at each threshold if swept
+        exclusions = dict()
+        for edge in exclude_edges:
+            if self.exclude_masked and (edge.masked or edge.target.masked):
+                continue
+            sweep = self.metaedge_to_sweep.get(edge.metaedge)
+            decrement = 1 if sweep is None else self.edge_passes(edge, sweep).astype(int)
+            key = edge.source, edge.metaedge
+            exclusions[key] = exclusions.get(key, 0) + decrement
+
+        def get_degrees(node, metaedge):
+            degrees = self.get_degrees(node, metaedge)
+            return degrees - exclusions.get((node, metaedge), 0)
+
+        paths = self.graph.iter_paths_between(source, target, metapath,
+            duplicates=False, masked=False, exclude_nodes=set(), exclude_edges=exclude_edges)
+        dwpc = numpy.zeros(shape)
+        for path in paths:
+            weight = 1.0
+            factors = [numpy.ones(n) for n in shape]
+            for edge in path:
+                metaedge = edge.metaedge
+                degree_product = get_degrees(edge.source, metaedge) * get_degrees(edge.target, metaedge.inverse)
+                sweep = self.metaedge_to_sweep.get(metaedge)
+                if sweep is None:
+                    weight /= float(degree_product) ** damping_exponent
+                    continue
+                passes = self.edge_passes(edge, sweep)
+                factor = numpy.zeros(len(passes))
+                factor[passes] = degree_product[passes].astype(numpy.float64) ** -damping_exponent
+                factors[sweep_to_axis[sweep]] *= factor
+            for factor in reversed(factors):
+                weight = numpy.multiply.outer(factor, weight)
+            dwpc += weight
+        return dwpc
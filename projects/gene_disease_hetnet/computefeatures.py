@@ -3,12 +3,35 @@ import collections
 import os
 import gzip
 import csv
+import math
+import filecmp
+import multiprocessing
+import shutil
+import sys
+import time
+
+import numpy
 
 import hetnet
 import hetnet.algorithms
+import hetnet.dependency
+import hetnet.matrix
+import hetnet.planner
 import hetnet.readwrite
 
-def compute_features(graph, part_rows, feature_path, dwpc_exponent, network_status=False):
+def count_runs(part_rows, key):
+    """Return the number of runs of consecutive rows sharing a value of key."""
+    values = [row[key] for row in part_rows]
+    return sum(1 for i, value in enumerate(values) if i == 0 or value != values[i - 1])
+
+def compute_features(graph, part_rows, feature_path, dwpc_exponent, network_status=False, sparse=False, vectors=False,
+                     approximate=False, path_threshold=100000, relative_error=0.05, metapath_costs=None):
+    """
+    Compute features for part_rows and write them to feature_path. When
+    metapath_costs is a dictionary, the pairs, seconds and, for enumerated
+    DWPCs, paths spent on each metapath are accumulated into it by metapath
+    string, for hetnet.planner.record_actual.
+    """
 
     # Define Metapaths
     metagraph = graph.metagraph
@@ -16,6 +39,24 @@ def compute_features(graph, part_rows, feature_path, dwpc_exponent, network_stat
     metapath_GaD = metapaths.pop(0)
     metapath_DaG = metapath_GaD.inverse
 
+    # Sparse engine computes unexcluded DWPCs for all pairs at once
+    sparse_dwpc = hetnet.matrix.SparseDWPC(graph, dwpc_exponent) if sparse else None
+
+    # Single-source DWPC vectors are computed once per run of rows sharing a
+    # gene or disease, choosing whichever side yields fewer runs. All
+    # metapaths are evaluated in one prefix-sharing traversal. Rows with
+    # excluded edges correct the unexcluded DWPC with dwpc_exclusion_delta.
+    group_key = None
+    if vectors:
+        group_key = min(['disease_code', 'gene_symbol'], key=lambda key: count_runs(part_rows, key))
+        print 'Computing DWPC vectors grouped by {}'.format(group_key)
+        vector_metapaths = metapaths if group_key == 'gene_symbol' else [
+            metapath.inverse for metapath in metapaths]
+    group_node = None
+
+    # With approximate, DWPC_sample estimates the DWPC for metapaths where a
+    # pair has more than path_threshold walks and is exact otherwise.
+
     # open output_file
     feature_file = gzip.open(feature_path, 'w')
 
@@ -43,17 +84,53 @@ def compute_features(graph, part_rows, feature_path, dwpc_exponent, network_stat
         features['percentile'] = part_row['percentile']
         features['part'] = part_row['part']
 
-        features['PC_s|G-a-D'] = len(graph.paths_from(source, metapath_GaD, masked=False, exclude_edges=exclude_edges))
-        features['PC_t|G-a-D'] = len(graph.paths_from(target, metapath_DaG, masked=False, exclude_edges=exclude_edges))
+        features['PC_s|G-a-D'] = graph.count_paths_from(source, metapath_GaD, masked=False, exclude_edges=exclude_edges)
+        features['PC_t|G-a-D'] = graph.count_paths_from(target, metapath_DaG, masked=False, exclude_edges=exclude_edges)
+
+        if group_key is not None:
+            row_group_node = source if group_key == 'gene_symbol' else target
+            if row_group_node != group_node:
+                group_node = row_group_node
+                metapath_to_vector = graph.dwpc_from_metapaths(
+                    group_node, vector_metapaths, dwpc_exponent,
+                    duplicates=False, masked=True)
 
         for metapath in metapaths:
             feature_name = 'DWPC_{}|{}'.format(dwpc_exponent, metapath)
-            paths = graph.paths_between_tree(source, target, metapath,
-                duplicates=False, masked=True,
-                exclude_nodes=set(), exclude_edges=exclude_edges)
-            dwpc = hetnet.algorithms.DWPC(paths,
-                damping_exponent=dwpc_exponent, exclude_edges=exclude_edges)
+            start = time.time()
+            n_paths = None
+            if sparse_dwpc is not None and not exclude_edges:
+                dwpc = sparse_dwpc.dwpc(source, target, metapath)
+            elif group_key is not None:
+                vector_metapath = metapath if group_key == 'gene_symbol' else metapath.inverse
+                other_node = target if group_key == 'gene_symbol' else source
+                pc, dwpc = metapath_to_vector[vector_metapath].get(other_node, (0, 0.0))
+                if math.isnan(dwpc):
+                    # a path has a zero degree, which exclude_edges may remove
+                    paths = graph.path_array(source, target, metapath, exclude_edges=exclude_edges)
+                    dwpc = hetnet.algorithms.DWPC(paths, dwpc_exponent, exclude_edges=exclude_edges)
+                elif exclude_edges:
+                    dwpc = graph.dwpc_exclusion_delta(source, target, metapath,
+                        dwpc_exponent, dwpc, exclude_edges)
+            elif approximate:
+                result = hetnet.algorithms.DWPC_sample(graph, source, target, metapath,
+                    dwpc_exponent, relative_error=relative_error,
+                    exact_threshold=path_threshold, exclude_edges=exclude_edges)
+                dwpc = result['dwpc']
+            else:
+                paths = graph.path_array(source, target, metapath,
+                    duplicates=False, masked=True,
+                    exclude_nodes=set(), exclude_edges=exclude_edges)
+                n_paths = len(paths)
+                dwpc = hetnet.algorithms.DWPC(paths,
+                    damping_exponent=dwpc_exponent, exclude_edges=exclude_edges)
             features[feature_name] = dwpc
+            if metapath_costs is not None:
+                actual = metapath_costs.setdefault(str(metapath), collections.Counter())
+                actual['pairs'] += 1
+                actual['seconds'] += time.time() - start
+                if n_paths is not None:
+                    actual['paths'] += n_paths
         if writer is None:
             print 'Initializing writer'
             fieldnames = features.keys()
@@ -66,14 +143,275 @@ def compute_features(graph, part_rows, feature_path, dwpc_exponent, network_stat
 
     feature_file.close()
 
+def graph_dwpcs(graph, gene_symbol, disease_code, metapath_keys, dwpc_exponent, cache):
+    """
+    Return a list of DWPCs between gene_symbol and disease_code on graph for
+    the metapaths whose str is in metapath_keys, excluding their association.
+    cache is a dictionary kept per graph. It holds the graph's metapaths and
+    the DWPC vectors of the last disease, so a run of rows sharing a disease
+    traverses graph once. Rows with an association correct the unexcluded
+    DWPC with dwpc_exclusion_delta.
+    """
+    if 'metapaths' not in cache:
+        metapaths = graph.metagraph.extract_metapaths('gene', 'disease', max_length=3)
+        key_to_metapath = {str(metapath): metapath for metapath in metapaths}
+        cache['metapaths'] = [key_to_metapath[key] for key in metapath_keys]
+        cache['node'] = None
+    metapaths = cache['metapaths']
+    source = graph.node_dict[gene_symbol]
+    target = graph.node_dict[disease_code]
+
+    if cache['node'] != target:
+        cache['node'] = target
+        cache['vectors'] = graph.dwpc_from_metapaths(
+            target, [metapath.inverse for metapath in metapaths], dwpc_exponent,
+            duplicates=False, masked=True)
+    vectors = cache['vectors']
+    dwpcs = [vectors[metapath.inverse].get(source, (0, 0.0))[1] for metapath in metapaths]
+
+    edge = graph.edge_dict.get((gene_symbol, disease_code, 'association', 'both'))
+    exclude_edges = {edge, edge.inverse} if edge else set()
+    for i, (metapath, dwpc) in enumerate(zip(metapaths, dwpcs)):
+        if math.isnan(dwpc):
+            # a path has a zero degree, which exclude_edges may remove
+            paths = graph.path_array(source, target, metapath, exclude_edges=exclude_edges)
+            dwpcs[i] = hetnet.algorithms.DWPC(paths, dwpc_exponent, exclude_edges=exclude_edges)
+        elif exclude_edges:
+            dwpcs[i] = graph.dwpc_exclusion_delta(source, target, metapath, dwpc_exponent, dwpc, exclude_edges)
+    return dwpcs
+
+def compute_null_features(graph, permuted_graphs, part_rows, feature_path, dwpc_exponent):
+    """
+    Compute DWPC features on graph and on each of permuted_graphs in a single
+    pass over part_rows. For each metapath, the observed DWPC is written
+    with the mean and standard deviation of the permuted DWPCs and the
+    empirical p-value (count(permuted >= observed) + 1) / (K + 1), where K is
+    the number of permuted graphs.
+    """
+    metapaths = graph.metagraph.extract_metapaths('gene', 'disease', max_length=3)
+    metapaths.pop(0)
+    metapath_keys = [str(metapath) for metapath in metapaths]
+    graphs = [graph] + list(permuted_graphs)
+    caches = [dict() for g in graphs]
+    n_permuted = len(permuted_graphs)
+
+    feature_file = gzip.open(feature_path, 'w')
+    total_edges = len(part_rows)
+    writer = None
+    for i, part_row in enumerate(part_rows):
+        disease_code = part_row['disease_code']
+        gene_symbol = part_row['gene_symbol']
+
+        features = collections.OrderedDict()
+        for key in 'gene_code', 'gene_symbol', 'disease_code', 'disease_name', 'status', 'status_int', 'percentile', 'part':
+            features[key] = part_row[key]
+
+        dwpcs = numpy.array([graph_dwpcs(g, gene_symbol, disease_code, metapath_keys, dwpc_exponent, cache)
+                             for g, cache in zip(graphs, caches)])
+        for j, metapath_key in enumerate(metapath_keys):
+            observed = dwpcs[0, j]
+            permuted = dwpcs[1:, j]
+            feature_name = 'DWPC_{}|{}'.format(dwpc_exponent, metapath_key)
+            features[feature_name] = observed
+            features[feature_name + '|perm_mean'] = permuted.mean() if n_permuted else None
+            features[feature_name + '|perm_sd'] = permuted.std(ddof=1) if n_permuted > 1 else None
+            # values equal up to summation order count as ties
+            extreme = (permuted >= observed) | numpy.isclose(permuted, observed, rtol=1e-9, atol=0)
+            features[feature_name + '|perm_p'] = (numpy.sum(extreme) + 1.0) / (n_permuted + 1)
+
+        if writer is None:
+            writer = csv.DictWriter(feature_file, fieldnames=features.keys(), delimiter='\t')
+            writer.writeheader()
+        writer.writerow(features)
+
+        percent = 100.0 * i / total_edges
+        print '{:.1f}% -  {:10}{}'.format(percent, gene_symbol, part_row['disease_name'])
+
+    feature_file.close()
+
+def read_permuted_graphs(network_dirs):
+    """
+    Read the graphs of permuted network_dirs. Networks in the columnar format
+    are read as CompactGraphs sharing one node table when their node table
+    files are identical, as for networks written by permute_graphs.
+    """
+    graphs = list()
+    template = None
+    for network_dir in network_dirs:
+        columnar_path = os.path.join(network_dir, 'graph', 'graph.columnar')
+        if not os.path.isdir(columnar_path):
+            graphs.append(read_graph(network_dir))
+            continue
+        nodes_path = os.path.join(columnar_path, 'nodes.json.gz')
+        node_template = None
+        if template is not None and filecmp.cmp(template_nodes_path, nodes_path, shallow=False):
+            node_template = template
+        print 'loading permuted graph {}'.format(network_dir)
+        graph = hetnet.readwrite.graph.read_columnar(columnar_path, compact=True, node_template=node_template)
+        if template is None:
+            template = graph
+            template_nodes_path = nodes_path
+        graphs.append(graph)
+    return graphs
+
+# Graph shared with forked workers. Set before the pool is created so that
+# workers inherit it copy-on-write rather than receiving a pickled copy.
+shared_graph = None
+
+def shard_complete(shard_path, n_rows):
+    """Return whether shard_path exists and holds a header and n_rows rows."""
+    if not os.path.exists(shard_path):
+        return False
+    try:
+        shard_file = gzip.open(shard_path)
+        n_lines = sum(1 for line in shard_file)
+        shard_file.close()
+    except (IOError, EOFError):
+        return False
+    return n_lines == (n_rows + 1 if n_rows else 0)
+
+def compute_shard(shard):
+    """
+    Compute features for a single partition file using shared_graph. Output is
+    written to a temporary file and renamed once complete, so an interrupted
+    shard is never mistaken for a finished one. Returns the shard path and
+    whether it was computed rather than skipped.
+    """
+    partition_path, shard_path, dwpc_exponent, options = shard
+    part_rows = read_part(partition_path)
+    if shard_complete(shard_path, len(part_rows)):
+        return shard_path, False
+    temp_path = '{}.{}.tmp'.format(shard_path, os.getpid())
+    compute_features(shared_graph, part_rows, temp_path, dwpc_exponent, **options)
+    os.rename(temp_path, shard_path)
+    return shard_path, True
+
+def merge_shards(shard_paths, feature_path):
+    """Concatenate shard_paths, in order, into feature_path with one header."""
+    temp_path = '{}.tmp'.format(feature_path)
+    feature_file = gzip.open(temp_path, 'w')
+    header = None
+    for shard_path in shard_paths:
+        shard_file = gzip.open(shard_path)
+        shard_header = shard_file.readline()
+        if shard_header:
+            if header is None:
+                header = shard_header
+                feature_file.write(header)
+            assert shard_header == header, 'shard fields differ: {}'.format(shard_path)
+            shutil.copyfileobj(shard_file, feature_file)
+        shard_file.close()
+    feature_file.close()
+    os.rename(temp_path, feature_path)
+
+def compute_features_parallel(graph, partition_dir, shard_dir, feature_path, dwpc_exponent, workers, **options):
+    """
+    Compute features for every partition file in partition_dir using workers
+    forked processes, writing one shard per partition to shard_dir. Shards
+    complete from a previous run are skipped. Shards are merged into
+    feature_path in partition filename order.
+    """
+    global shared_graph
+    shared_graph = graph
+    if not os.path.isdir(shard_dir):
+        os.mkdir(shard_dir)
+    partition_names = sorted(name for name in os.listdir(partition_dir) if name.endswith('.txt.gz'))
+    shards = [(os.path.join(partition_dir, name), os.path.join(shard_dir, name), dwpc_exponent, options)
+              for name in partition_names]
+    pool = multiprocessing.Pool(workers)
+    for i, (shard_path, computed) in enumerate(pool.imap_unordered(compute_shard, shards)):
+        status = 'computed' if computed else 'skipped'
+        print '{} of {} shards - {} {}'.format(i + 1, len(shards), status, shard_path)
+    pool.close()
+    pool.join()
+    merge_shards([shard[1] for shard in shards], feature_path)
+
 def read_graph(network_dir):
     # Load graph
     print 'loading graph'
+    columnar_path = os.path.join(network_dir, 'graph', 'graph.columnar')
     pkl_path = os.path.join(network_dir, 'graph', 'graph.pkl.gz')
-    graph = hetnet.readwrite.graph.read_pickle(pkl_path)
+    if os.path.isdir(columnar_path):
+        graph = hetnet.readwrite.graph.read_columnar(columnar_path)
+    else:
+        graph = hetnet.readwrite.graph.read_pickle(pkl_path)
     print 'graph loaded'
     return graph
 
+def plan_features(graph, part_rows, path_threshold=100000):
+    """
+    Return hetnet.planner plan rows estimating the paths and traversal cost
+    of each DWPC metapath of compute_features over part_rows.
+    """
+    metapaths = graph.metagraph.extract_metapaths('gene', 'disease', max_length=3)[1:]
+    pairs = [(graph.node_dict[row['gene_symbol']], graph.node_dict[row['disease_code']])
+             for row in part_rows]
+    planner = hetnet.planner.MetapathPlanner(graph)
+    return planner.plan(metapaths, pairs, approximate_threshold=path_threshold)
+
+def read_features(feature_path):
+    """Return the fieldnames and rows keyed by (gene_symbol, disease_code)."""
+    feature_file = gzip.open(feature_path)
+    reader = csv.DictReader(feature_file, delimiter='\t')
+    rows = collections.OrderedDict(((row['gene_symbol'], row['disease_code']), row) for row in reader)
+    feature_file.close()
+    return reader.fieldnames, rows
+
+def update_features(graph, part_rows, feature_path, previous_feature_path, changelog, dwpc_exponent, **options):
+    """
+    Write features for part_rows to feature_path, computing only rows that
+    are missing from previous_feature_path or whose features are affected by
+    changelog, the hetnet.graph.GraphChangelog from the graph of the previous
+    features to graph. Other rows are copied from previous_feature_path with
+    their partition columns taken from part_rows. options are passed to
+    compute_features and should match the previous run. Returns the number
+    of rows copied and computed.
+    """
+    fieldnames, previous_rows = read_features(previous_feature_path)
+    metapaths = graph.metagraph.extract_metapaths('gene', 'disease', max_length=3)
+    metapath_GaD = metapaths.pop(0)
+    for metapath in metapaths:
+        assert 'DWPC_{}|{}'.format(dwpc_exponent, metapath) in fieldnames
+
+    # PC_s and PC_t change with the G-a-D degrees of the gene and disease
+    tracker = hetnet.dependency.DependencyTracker(graph, changelog)
+    stale_pairs = set()
+    keys = list()
+    for row in part_rows:
+        pair = row['gene_symbol'], row['disease_code']
+        if (pair not in previous_rows or
+                tracker.node_touched(pair[0], metapath_GaD) or
+                tracker.node_touched(pair[1], metapath_GaD.inverse)):
+            stale_pairs.add(pair)
+            continue
+        keys.extend(pair + (metapath, ) for metapath in metapaths)
+    stale_pairs.update(key[:2] for key in tracker.affected(keys))
+    stale_rows = [row for row in part_rows if (row['gene_symbol'], row['disease_code']) in stale_pairs]
+    print '{} of {} rows affected by {}'.format(len(stale_rows), len(part_rows), changelog)
+
+    computed_rows = dict()
+    if stale_rows:
+        temp_path = '{}.stale.tmp'.format(feature_path)
+        compute_features(graph, stale_rows, temp_path, dwpc_exponent, **options)
+        computed_fieldnames, computed_rows = read_features(temp_path)
+        os.remove(temp_path)
+        assert computed_fieldnames == fieldnames, 'features differ from {}'.format(previous_feature_path)
+
+    feature_file = gzip.open(feature_path, 'w')
+    writer = csv.DictWriter(feature_file, fieldnames=fieldnames, delimiter='\t')
+    writer.writeheader()
+    for part_row in part_rows:
+        pair = part_row['gene_symbol'], part_row['disease_code']
+        if pair in computed_rows:
+            writer.writerow(computed_rows[pair])
+            continue
+        row = previous_rows[pair]
+        for key in 'gene_code', 'disease_name', 'status', 'status_int', 'percentile', 'part':
+            row[key] = part_row[key]
+        writer.writerow(row)
+    feature_file.close()
+    return len(part_rows) - len(stale_rows), len(stale_rows)
+
 def read_part(partition_path):
     partition_file = gzip.open(partition_path)
     part_rows = list(csv.DictReader(partition_file, delimiter='\t'))
@@ -92,6 +430,27 @@ if __name__ == '__main__':
     parser.add_argument('--feature-path', type=os.path.expanduser)
     parser.add_argument('--dwpc-exponent', default=0.4, type=float)
     parser.add_argument('--network-status', action='store_true')
+    parser.add_argument('--sparse', action='store_true')
+    parser.add_argument('--vectors', action='store_true')
+    parser.add_argument('--approximate', action='store_true',
+        help='estimate DWPCs by sampling walks for pairs with more than PATH_THRESHOLD walks')
+    parser.add_argument('--path-threshold', default=100000, type=int)
+    parser.add_argument('--relative-error', default=0.05, type=float)
+    parser.add_argument('--plan-path', type=os.path.expanduser,
+        help='write estimated metapath costs here, with actual costs after the run')
+    parser.add_argument('--plan-only', action='store_true',
+        help='exit after writing PLAN_PATH')
+    parser.add_argument('--workers', default=0, type=int,
+        help='compute disease partitions in this many forked processes')
+    parser.add_argument('--partition-dir', type=os.path.expanduser,
+        help='directory of partition files (default: NETWORK_DIR/disease-partitions)')
+    parser.add_argument('--shard-dir', type=os.path.expanduser,
+        help='directory of per-partition outputs (default: next to FEATURE_PATH)')
+    parser.add_argument('--previous-network-dir', type=os.path.expanduser,
+        help='network of PREVIOUS_FEATURE_PATH, for recomputing only rows affected by changes since')
+    parser.add_argument('--previous-feature-path', type=os.path.expanduser)
+    parser.add_argument('--permuted-network-dirs', type=os.path.expanduser, nargs='+',
+        help='compute observed features with their null distribution across these networks')
     args = parser.parse_args()
 
     # filesystem
@@ -102,7 +461,39 @@ if __name__ == '__main__':
 
     # Read Objects
     graph = read_graph(network_dir)
-    part_rows = read_part(args.partition_path)
 
     # Compute features
-    compute_features(graph, part_rows, args.feature_path, args.dwpc_exponent, args.network_status)
+    if args.permuted_network_dirs:
+        permuted_graphs = read_permuted_graphs(args.permuted_network_dirs)
+        part_rows = read_part(args.partition_path)
+        compute_null_features(graph, permuted_graphs, part_rows, args.feature_path, args.dwpc_exponent)
+    elif args.previous_feature_path:
+        previous_graph = read_graph(args.previous_network_dir)
+        changelog = hetnet.graph.GraphChangelog.from_graphs(previous_graph, graph)
+        del previous_graph
+        part_rows = read_part(args.partition_path)
+        update_features(graph, part_rows, args.feature_path, args.previous_feature_path, changelog,
+            args.dwpc_exponent, network_status=args.network_status, sparse=args.sparse,
+            vectors=args.vectors, approximate=args.approximate,
+            path_threshold=args.path_threshold, relative_error=args.relative_error)
+    elif args.workers:
+        partition_dir = args.partition_dir or os.path.join(network_dir, 'disease-partitions')
+        shard_dir = args.shard_dir or os.path.join(path_head, 'feature-shards')
+        compute_features_parallel(graph, partition_dir, shard_dir, args.feature_path,
+            args.dwpc_exponent, args.workers, network_status=args.network_status,
+            sparse=args.sparse, vectors=args.vectors, approximate=args.approximate,
+            path_threshold=args.path_threshold, relative_error=args.relative_error)
+    else:
+        part_rows = read_part(args.partition_path)
+        metapath_costs = None
+        if args.plan_path:
+            plan_rows = plan_features(graph, part_rows, args.path_threshold)
+            hetnet.planner.write_plan(plan_rows, args.plan_path)
+            if args.plan_only:
+                sys.exit()
+            metapath_costs = dict()
+        compute_features(graph, part_rows, args.feature_path, args.dwpc_exponent, args.network_status, args.sparse, args.vectors,
+                         args.approximate, args.path_threshold, args.relative_error, metapath_costs)
+        if args.plan_path:
+            hetnet.planner.record_actual(plan_rows, metapath_costs)
+            hetnet.planner.write_plan(plan_rows, args.plan_path)
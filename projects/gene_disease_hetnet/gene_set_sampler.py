@@ -3,6 +3,7 @@ import csv
 import gzip
 import random
 
+import numpy
 import yard.curve
 
 import hetnet
@@ -114,6 +115,7 @@ for metapath in gene_set_metapaths:
 
     all_nodes = metanode_to_nodes[metanode]
     all_edges = metaedge_to_edges[metaedge]
+    edge_table = graph.get_edge_table(metaedge)
 
     n_nodes = len(all_nodes)
     n_edges = len(all_edges)
@@ -159,13 +161,12 @@ for metapath in gene_set_metapaths:
 
         for repetition in range(repetitions):
 
-            # randomly calculate edges to mask
-            mask_edges = random.sample(all_edges, n_edges - edge_number)
+            # randomly calculate edges to keep
+            keep = numpy.ones(len(edge_table), dtype=bool)
+            keep[random.sample(xrange(len(edge_table)), n_edges - edge_number)] = False
 
             # mask edges
-            for edge in mask_edges:
-                edge.mask()
-                edge.inverse.mask()
+            graph.mask_edges(metaedge, lambda table: keep)
 
             # calculate number of nodes with any unmasked edges
             node_number = sum(bool(node.get_edges(metaedge, exclude_masked=True)) for node in all_nodes)
@@ -174,9 +175,7 @@ for metapath in gene_set_metapaths:
             auroc = get_auroc(dgs_tuples, cache=cache)
 
             # unmask edges
-            for edge in mask_edges:
-                edge.unmask()
-                edge.inverse.unmask()
+            graph.clear_edge_masks()
 
             result = {'metanode': metanode, 'metaedge': metaedge,
                       'total_nodes': n_nodes, 'total_edges': n_edges,
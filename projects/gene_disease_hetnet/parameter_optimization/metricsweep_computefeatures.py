@@ -61,8 +61,9 @@ part_file.close()
 total_edges = len(dgs_tuples)
 
 
-feature_names = ['{}:{}'.format(metric['name'], metapath)
-    for metapath, metric in itertools.product(metapaths, metrics)]
+feature_names = ['{}:{}'.format(name, metapath)
+    for metapath, metric in itertools.product(metapaths, metrics)
+    for name in hetnet.algorithms.get_metric_names(metric)]
 fieldnames = ['source', 'target', 'target_name', 'status'] + feature_names
 
 feature_path = os.path.join(args.network_dir, 'features.txt.gz')
@@ -84,18 +85,21 @@ for i, (disease, gene, status) in enumerate(dgs_tuples):
     results['status'] = status
 
     for metapath in metapaths:
-        paths_s = graph.paths_from(gene, metapath, exclude_edges=exclude_edges)
-        paths_t = graph.paths_from(disease, metapath.inverse, exclude_edges=exclude_edges)
-        paths = [path for path in paths_s if path.target() == disease]
-        arg_dict = {'paths_s': paths_s, 'paths_t': paths_t, 'paths': paths,
-                    'exclude_edges': exclude_edges}
+        count_s = graph.count_paths_from(gene, metapath, exclude_edges=exclude_edges)
+        count_t = graph.count_paths_from(disease, metapath.inverse, exclude_edges=exclude_edges)
+        paths = graph.paths_between_tree(gene, disease, metapath, exclude_edges=exclude_edges)
+        arg_dict = {'count_s': count_s, 'count_t': count_t, 'count': len(paths),
+                    'paths': paths, 'exclude_edges': exclude_edges}
         for metric in metrics:
             arguments = metric['arguments']
             for key in set(arg_dict) & set(arguments):
                 arguments[key] = arg_dict[key]
             feature = metric['fxn'](**arguments)
-            feature_key = '{}:{}'.format(metric['name'], metapath)
-            results[feature_key] = feature
+            if 'names' not in metric:
+                feature = [feature]
+            for name, value in zip(hetnet.algorithms.get_metric_names(metric), feature):
+                feature_key = '{}:{}'.format(name, metapath)
+                results[feature_key] = value
 
     percent = 100.0 * i / total_edges
     writer.writerow(results)
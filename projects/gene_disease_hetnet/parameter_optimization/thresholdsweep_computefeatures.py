@@ -7,8 +7,8 @@ import csv
 import argparse
 
 import hetnet
-import hetnet.algorithms
 import hetnet.readwrite
+import hetnet.sweep
 import utilities.floats
 
 
@@ -74,62 +74,54 @@ part_file.close()
 
 
 
-def get_gte_mask(key, threshold):
-    return lambda edge_data: edge_data[key] >= threshold
-
-
 features = list()
 
 #GeT
-for log10_expr_threshold in log10_expr_thresholds:
-    mask = get_gte_mask('log10_expr', log10_expr_threshold)
+for i, log10_expr_threshold in enumerate(log10_expr_thresholds):
     feature = dict()
     feature['metapath'] = metapath_GeTeGaD
-    feature['metaedge_to_mask'] = {metaedge_GeT: mask, metaedge_TeG: mask}
+    feature['index'] = i,
     feature['name'] = 'GeTeGaD_GeT={}'.format(log10_expr_threshold)
     features.append(feature)
 
 #DlT
-for r_scaled_threshold in r_scaled_thresholds:
-    mask = get_gte_mask('r_scaled', r_scaled_threshold)
+for j, r_scaled_threshold in enumerate(r_scaled_thresholds):
     feature = dict()
     feature['metapath'] = metapath_GaDlTlD
-    feature['metaedge_to_mask'] = {metaedge_DlT: mask, metaedge_TlD: mask}
+    feature['index'] = j,
     feature['name'] = 'GaDlTlD_DlT={}'.format(r_scaled_threshold)
     features.append(feature)
 
 #GeT and TlD
-for log10_expr_threshold, r_scaled_threshold in itertools.product(log10_expr_thresholds, r_scaled_thresholds):
-    mask_GeT = get_gte_mask('log10_expr', log10_expr_threshold)
-    mask_TlD = get_gte_mask('r_scaled', r_scaled_threshold)
+for (i, log10_expr_threshold), (j, r_scaled_threshold) in itertools.product(
+    enumerate(log10_expr_thresholds), enumerate(r_scaled_thresholds)):
     feature = dict()
     feature['metapath'] = metapath_GeTlD
-    feature['metaedge_to_mask'] = {metaedge_GeT: mask_GeT, metaedge_TlD: mask_TlD}
+    feature['index'] = i, j
     feature['name'] = 'GeTlD_GeT={}_TlD={}'.format(log10_expr_threshold, r_scaled_threshold)
     features.append(feature)
 
-feature_array = [[0 for i in xrange(len(features))] for j in xrange(len(dgs_tuples))]
-
+# Edges failing a threshold are removed at that threshold. Paths for each
+# pair are enumerated once and weighted at every threshold.
 damping_exponent = 0.4
-metaedge_to_edges = graph.get_metaedge_to_edges()
-for feature_index, feature in enumerate(features):
-    graph.unmask()
-    # mask
-    for metaedge, mask in feature['metaedge_to_mask'].items():
-        for edge in metaedge_to_edges[metaedge]:
-            if not mask(edge.data):
-                edge.mask()
-    print feature['name']
-    for edge_index, (disease, gene, status) in enumerate(dgs_tuples):
-        if status:
-            edge = graph.edge_dict[(gene.id_, disease.id_, 'association', 'both')]
-            exclude_edges = {edge, edge.inverse}
-        else:
-            exclude_edges = set()
-        paths = graph.paths_between_tree(gene, disease, feature['metapath'],
-            duplicates=False, masked=False, exclude_nodes=set(), exclude_edges=exclude_edges)
-        dwpc = hetnet.algorithms.DWPC(paths, damping_exponent=damping_exponent, exclude_edges=exclude_edges)
-        feature_array[edge_index][feature_index] = dwpc
+graph.unmask()
+sweep = hetnet.sweep.ThresholdSweep(graph, [
+    ('log10_expr', [metaedge_GeT], log10_expr_thresholds),
+    ('r_scaled', [metaedge_DlT], r_scaled_thresholds)], damping_exponent)
+metapaths = [metapath_GeTeGaD, metapath_GaDlTlD, metapath_GeTlD]
+
+feature_array = list()
+for edge_index, (disease, gene, status) in enumerate(dgs_tuples):
+    if status:
+        edge = graph.edge_dict[(gene.id_, disease.id_, 'association', 'both')]
+        exclude_edges = {edge, edge.inverse}
+    else:
+        exclude_edges = set()
+    metapath_to_dwpcs = {metapath: sweep.dwpc(gene, disease, metapath, exclude_edges)
+                         for metapath in metapaths}
+    dwpc_list = [metapath_to_dwpcs[feature['metapath']][feature['index']] for feature in features]
+    feature_array.append(dwpc_list)
+    print '{:.1f}% -  {:10}{}'.format(100.0 * edge_index / len(dgs_tuples), gene.id_, disease.data['name'])
 
 feature_path = os.path.join(args.network_dir,
     'features-exp{}.txt.gz'.format(damping_exponent))
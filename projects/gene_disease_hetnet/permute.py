@@ -1,6 +1,8 @@
 import argparse
 import os
+import sys
 import gzip
+import json
 import csv
 import random
 import itertools
@@ -99,6 +101,63 @@ def mask_testing_edges(graph, all_rows):
         edge.mask()
         edge.inverse.mask()
 
+def write_permutation_stats(all_stats, graph_dir):
+    """Write per-metaedge permutation statistics to graph_dir."""
+    path = os.path.join(graph_dir, 'permutation-stats.json')
+    with open(path, 'w') as write_file:
+        json.dump(all_stats, write_file, indent=2)
+
+def permute_batch(graph, args):
+    """
+    Write args.network_number independent permutations of graph in parallel,
+    seeded by network number, as graph/graph.columnar directories. Only the
+    association edges of each permuted network are loaded to compute
+    partitions. The full first network is loaded to save its training graph.
+    """
+    network_dirs = [os.path.join(args.networks_dir, '{}-{}'.format(args.prefix, i))
+                    for i in range(args.network_number)]
+    columnar_dirs = list()
+    for network_dir in network_dirs:
+        graph_dir = os.path.join(network_dir, 'graph')
+        for directory in (network_dir, graph_dir):
+            if not os.path.isdir(directory):
+                os.mkdir(directory)
+        columnar_dir = os.path.join(graph_dir, 'graph.columnar')
+        if not args.overwrite:
+            assert not os.path.exists(columnar_dir)
+        columnar_dirs.append(columnar_dir)
+
+    permutation_stats = hetnet.permutation.permute_graphs(
+        graph, columnar_dirs, seeds=range(args.network_number),
+        multiplier=args.multiplier, processes=args.processes, verbose=True,
+        adaptive=args.adaptive, tolerance=args.tolerance)
+    for network_dir, all_stats in zip(network_dirs, permutation_stats):
+        write_permutation_stats(all_stats, os.path.join(network_dir, 'graph'))
+
+    metaedge_DaG = graph.metagraph.edge_dict[('disease', 'gene', 'association', 'both')]
+    metapath_DaG = graph.metagraph.get_metapath((metaedge_DaG, ))
+    for i, (network_dir, columnar_dir) in enumerate(zip(network_dirs, columnar_dirs)):
+        print 'Partitioning network {}'.format(i).center(60, '#')
+        association_graph = hetnet.readwrite.graph.read_columnar(columnar_dir, metapaths=[metapath_DaG])
+        all_rows, diseases = get_part_rows(
+            association_graph, percent_training=args.percent_training, min_genes=args.min_genes, seed=i)
+        write_partition_file(all_rows, network_dir)
+        write_partition_files(all_rows, network_dir, diseases=diseases)
+        if i != 0:
+            continue
+        training_dir = '{}-training'.format(network_dir)
+        training_graph_dir = os.path.join(training_dir, 'graph')
+        for directory in (training_dir, training_graph_dir):
+            if not os.path.isdir(directory):
+                os.mkdir(directory)
+        print 'saving permuted training graph'
+        permuted_graph = hetnet.readwrite.graph.read_columnar(columnar_dir)
+        mask_testing_edges(permuted_graph, all_rows)
+        hetnet.readwrite.graph.write_columnar(
+            permuted_graph, os.path.join(training_graph_dir, 'graph.columnar'), masked=False)
+        write_partition_file(all_rows, training_dir)
+        write_partition_files(all_rows, training_dir, diseases=diseases)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--origin-dir', type=os.path.expanduser,
@@ -111,6 +170,12 @@ if __name__ == '__main__':
     parser.add_argument('--multiplier', type=int, default=10)
     parser.add_argument('--overwrite', action='store_true')
     parser.add_argument('--prefix', default='140615')
+    parser.add_argument('--batch', action='store_true',
+        help='permute the original graph independently per network in a process pool')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--adaptive', action='store_true',
+        help='stop permuting a metaedge once its unchanged fraction reaches the expected floor')
+    parser.add_argument('--tolerance', type=float, default=0.01)
 
     args = parser.parse_args()
 
@@ -118,6 +183,10 @@ if __name__ == '__main__':
     origin_pkl_path = os.path.join(args.origin_dir, 'graph', 'graph.pkl.gz')
     graph = hetnet.readwrite.graph.read_pickle(origin_pkl_path)
 
+    if args.batch:
+        permute_batch(graph, args)
+        sys.exit()
+
     current_graph = graph
 
     # Permute graph
@@ -145,8 +214,10 @@ if __name__ == '__main__':
                 assert not os.path.exists(pkl_path)
             pkl_paths.append(pkl_path)
 
-        current_graph = hetnet.permutation.permute_graph(
-            current_graph, multiplier=args.multiplier, seed=i, verbose=True)
+        current_graph, all_stats = hetnet.permutation.permute_graph(
+            current_graph, multiplier=args.multiplier, seed=i, verbose=True,
+            adaptive=args.adaptive, tolerance=args.tolerance)
+        write_permutation_stats(all_stats, os.path.dirname(pkl_paths[0]))
         print 'Permuted graph metrics'.center(60, '-')
         print hetnet.display.graph_metrics(current_graph)
 